@@ -0,0 +1,167 @@
+import math
+import torch
+import torch.nn.functional as F
+from memory_format import is_channels_last, memory_format_of
+
+"""
+Batched version of the dataset transforms.
+Instead of calling TF.hflip/vflip/rotate/resize on one sample at a time in the dataset,
+the transforms are applied after collation on whole (B, C, H, W) batches, on the device of the batch.
+The 90 degree rotations and flips are exact (a single gather), and the random resized crops
+of a batch are done with a single resample.
+The transformed batches keep the memory format of their input (e.g. channels-last, see memory_format.py).
+"""
+
+# Index of the D4 symmetry matching each mode of the datasets' `transform` method:
+# 0. No transform, 1. Horizontal flip, 2. Vertical flip, 3. -90 degree rotation,
+# 4. 90 degree rotation, 5. Random crop (no symmetry, the crop is applied on top of it)
+SIX_TO_D4 = [0, 4, 6, 3, 1, 0]
+N_TRANSFORMS = len(SIX_TO_D4)
+N_D4 = 8
+
+_D4_MAPS = {}
+
+
+def d4_transform(x, k: int):
+    """
+    Applies the k-th symmetry of the square (0 <= k < 8) to the last two dims of x:
+    a counter-clockwise rotation of (k % 4) * 90 degrees, followed by a horizontal flip if k >= 4.
+    """
+    x = torch.rot90(x, k % 4, dims=(-2, -1))
+    return torch.flip(x, dims=(-1,)) if k >= 4 else x
+
+
+def d4_inverse(x, k: int):
+    # Rotations are inverted by the opposite rotation, flips (k >= 4) are their own inverse
+    if k >= 4:
+        return d4_transform(x, k)
+    return torch.rot90(x, -k, dims=(-2, -1))
+
+
+def _d4_maps(size: int, device):
+    # (8, size * size) maps giving, for each output pixel, the flat index of the source pixel
+    key = (size, str(device))
+    if key not in _D4_MAPS:
+        idx = torch.arange(size * size, device=device).view(size, size)
+        _D4_MAPS[key] = torch.stack(
+            [d4_transform(idx, k).flatten() for k in range(N_D4)]
+        )
+    return _D4_MAPS[key]
+
+
+def batch_d4_transform(x, ks):
+    """
+    Applies the symmetry ks[i] to the sample x[i], for a whole (B, C, H, W) batch at once.
+    This is exact (no interpolation): every output pixel is gathered from one input pixel.
+    """
+    b, c, h, w = x.shape
+    assert h == w, f"Rotations need square samples, but got {h}x{w}"
+    index = _d4_maps(h, x.device)[ks]  # (B, H * W)
+    if is_channels_last(x):
+        # gathered in NHWC order, the C channels of each pixel being contiguous
+        nhwc = x.permute(0, 2, 3, 1).reshape(b, h * w, c)
+        out = torch.gather(nhwc, 1, index.unsqueeze(2).expand(-1, -1, c))
+        return out.view(b, h, w, c).permute(0, 3, 1, 2)
+    out = torch.gather(x.flatten(2), 2, index.unsqueeze(1).expand(-1, c, -1))
+    return out.view(b, c, h, w)
+
+
+def batch_random_resized_crop(x, scale=(0.7, 0.9), ratio=(0.9, 1.1)):
+    """
+    Same parameters as `transforms.RandomResizedCrop.get_params` (without its fallback), but the crops of
+    all the samples of the batch are resized back to (H, W) with one bilinear resample.
+    """
+    b, _, h, w = x.shape
+    device = x.device
+    area = torch.empty(b, device=device).uniform_(*scale)
+    log_ratio = torch.empty(b, device=device).uniform_(
+        math.log(ratio[0]), math.log(ratio[1])
+    )
+    aspect = torch.exp(log_ratio)
+    crop_w = torch.sqrt(area * aspect).clamp(max=1.0)  # relative to w
+    crop_h = torch.sqrt(area / aspect).clamp(max=1.0)  # relative to h
+    # top left corner, relative to the image size
+    left = torch.rand(b, device=device) * (1 - crop_w)
+    top = torch.rand(b, device=device) * (1 - crop_h)
+
+    # affine_grid works in [-1, 1] coordinates
+    theta = torch.zeros(b, 2, 3, device=device)
+    theta[:, 0, 0] = crop_w
+    theta[:, 0, 2] = 2 * left + crop_w - 1
+    theta[:, 1, 1] = crop_h
+    theta[:, 1, 2] = 2 * top + crop_h - 1
+    grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+    return F.grid_sample(
+        x, grid.to(x.dtype), mode="bilinear", padding_mode="border", align_corners=False
+    )
+
+
+def six_to_d4(modes):
+    # D4 symmetries and random crop flags matching the dataset transform modes (see SIX_TO_D4)
+    ks = torch.tensor(SIX_TO_D4, device=modes.device)[modes]
+    return ks, modes == N_TRANSFORMS - 1
+
+
+def apply_batch_transforms(x, y, ks, crop, scale=(0.7, 0.9), ratio=(0.9, 1.1)):
+    """
+    Applies the symmetry ks[i] to the sample x[i] (and its mask y[i]), followed by a random resized
+    crop if crop[i]. If y is not a batch of masks of the same size as x (e.g. patch labels), only x is transformed.
+    """
+    with_mask = y.dim() == 4 and y.shape[-2:] == x.shape[-2:]
+
+    # image and mask go through the exact same ops
+    xy = torch.cat([x, y.to(x.dtype)], dim=1) if with_mask else x
+    xy = batch_d4_transform(xy, ks)
+
+    crop_idx = crop.nonzero(as_tuple=True)[0]
+    if len(crop_idx) > 0:
+        xy[crop_idx] = batch_random_resized_crop(xy[crop_idx], scale=scale, ratio=ratio)
+
+    memory_format = memory_format_of(x)
+    if with_mask:
+        c = x.shape[1]
+        return (
+            xy[:, :c].contiguous(memory_format=memory_format),
+            xy[:, c:].to(y.dtype).contiguous(memory_format=memory_format),
+        )
+    return xy.contiguous(memory_format=memory_format), y
+
+
+class BatchAugmentation:
+    """
+    Augments a batch of images and masks together, with a transform drawn at random for each sample.
+    mode:
+        - "six": the six transforms of the datasets (see SIX_TO_D4), the 6th one being a random resized crop
+        - "d4": the eight symmetries of the square, plus a random resized crop with probability crop_prob
+    If y is not a batch of masks of the same size as x (e.g. patch labels), only x is transformed.
+    """
+
+    def __init__(
+        self,
+        mode: str = "six",
+        crop_prob: float = 1 / N_TRANSFORMS,
+        scale=(0.7, 0.9),
+        ratio=(0.9, 1.1),
+    ):
+        assert mode in {"six", "d4"}, f"Unknown augmentation mode {mode}"
+        self.mode = mode
+        self.crop_prob = crop_prob
+        self.scale = scale
+        self.ratio = ratio
+
+    def __repr__(self) -> str:
+        return f"BatchAugmentation(mode={self.mode})"
+
+    def __call__(self, x, y):
+        b = x.shape[0]
+        device = x.device
+
+        if self.mode == "six":
+            ks, crop = six_to_d4(torch.randint(N_TRANSFORMS, (b,), device=device))
+        else:
+            ks = torch.randint(N_D4, (b,), device=device)
+            crop = torch.rand(b, device=device) < self.crop_prob
+
+        return apply_batch_transforms(
+            x, y, ks, crop, scale=self.scale, ratio=self.ratio
+        )
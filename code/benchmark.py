@@ -0,0 +1,183 @@
+from utils import *
+import argparse
+import multiprocessing as mp
+import resource
+import time
+import torch
+from models.swin_unet import SwinUNet
+from models.unet import UNet
+from models.losses.bce_loss import SafeBCELoss
+from memory_format import model_memory_format, to_channels_last
+from metrics import StepStats
+from precision import PRECISIONS, autocast, autocast_dtype
+
+"""
+Peak memory and time of a training step for each activation checkpointing setting (Swin-UNet only) and
+memory format (see memory_format.py), e.g. to check that channels-last speeds up the convolutions.
+Each (setting, memory format) runs in its own process, so that the peak of one does not hide the others.
+The peak memory is the one allocated by torch on GPU, and the peak resident memory of the process on CPU.
+"""
+
+SETTINGS = {
+    "none": dict(),
+    "stage": dict(encoder="stage"),
+    "blocks-1": dict(encoder="blocks", every=1),
+    "blocks-2": dict(encoder="blocks", every=2),
+    "decoder": dict(decoder=True),
+    "stage+decoder": dict(encoder="stage", decoder=True),
+}
+MODELS = ["swin-unet", "unet"]
+MEMORY_FORMATS = ["contiguous", "channels_last"]
+
+
+def measure(
+    model_name,
+    setting,
+    memory_format,
+    model_type,
+    batch_size,
+    size,
+    n_steps,
+    precision,
+    queue,
+):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    channels_last = memory_format == "channels_last"
+    torch.manual_seed(0)
+    if model_name == "swin-unet":
+        model = SwinUNet(model_type=model_type, pretrained=False)
+        model.set_activation_checkpointing(**SETTINGS[setting])
+    else:
+        model = UNet()
+    model = model.to(device, memory_format=model_memory_format(channels_last))
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters())
+    loss_fn = SafeBCELoss()
+    dtype = autocast_dtype(precision, device)
+    x = torch.rand(batch_size, 3, size, size, device=device)
+    y = (torch.rand(batch_size, 1, size, size, device=device) > 0.5).float()
+    if channels_last:
+        # as the loaders do (see loaders.to_device)
+        x, y = to_channels_last(x), to_channels_last(y)
+
+    def step():
+        optimizer.zero_grad()
+        with autocast(device, dtype):
+            logits = model(x)
+        # as in train()
+        y_hat = torch.sigmoid(logits)
+        with StepStats(y_hat, y, logits=logits):
+            loss = loss_fn(y_hat, y)
+        loss.backward()
+        optimizer.step()
+
+    step()  # warm-up, e.g. the optimizer states are allocated
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(n_steps):
+        step()
+    if device == "cuda":
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        )  # in kB on Linux
+    queue.put((peak, (time.time() - start) / n_steps))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model",
+        type=str,
+        choices=MODELS,
+        default="swin-unet",
+        help="Model to benchmark",
+    )
+    parser.add_argument(
+        "--model-type",
+        type=str,
+        choices=["small", "base"],
+        default="base",
+        help="Swin encoder to benchmark",
+    )
+    parser.add_argument("--batch-size", type=int, default=4, help="Batch size")
+    parser.add_argument(
+        "--size", type=int, default=208, help="Size of the (square) input crops"
+    )
+    parser.add_argument(
+        "--steps", type=int, default=5, help="Number of timed training steps"
+    )
+    parser.add_argument(
+        "--settings",
+        type=str,
+        nargs="+",
+        choices=list(SETTINGS),
+        default=list(SETTINGS),
+        help="Activation checkpointing settings to compare (Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--memory-formats",
+        type=str,
+        nargs="+",
+        choices=MEMORY_FORMATS,
+        default=MEMORY_FORMATS,
+        help="Memory formats of the model and the batches to compare",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=PRECISIONS,
+        default="fp32",
+        help="Precision of the forward pass, channels-last mostly pays off in bf16/fp16",
+    )
+    args = parser.parse_args()
+    log(vars(args))
+    settings = args.settings if args.model == "swin-unet" else ["none"]
+
+    # a fresh process per run (spawned, so that CUDA can be used in it)
+    ctx = mp.get_context("spawn")
+    results = {}
+    for setting in settings:
+        for memory_format in args.memory_formats:
+            queue = ctx.Queue()
+            p = ctx.Process(
+                target=measure,
+                args=(
+                    args.model,
+                    setting,
+                    memory_format,
+                    args.model_type,
+                    args.batch_size,
+                    args.size,
+                    args.steps,
+                    args.precision,
+                    queue,
+                ),
+            )
+            p.start()
+            results[setting, memory_format] = peak, step_time = queue.get()
+            p.join()
+            log(
+                f"{setting} ({memory_format}): peak memory {peak / 2**20:.0f} MiB, {step_time:.3f} s/step"
+            )
+
+    # relative to the first memory format without checkpointing
+    reference = results.get(
+        ("none", args.memory_formats[0]), next(iter(results.values()))
+    )
+    name = (
+        f"Swin-{args.model_type.capitalize()}-UNet"
+        if args.model == "swin-unet"
+        else "UNet"
+    )
+    log(f"{name}, {args.batch_size}x{args.size}x{args.size}, {args.precision}:")
+    log(
+        f"{'setting':<15}{'format':<15}{'peak (MiB)':>12}{'saving':>10}{'s/step':>10}{'slowdown':>10}"
+    )
+    for (setting, memory_format), (peak, step_time) in results.items():
+        log(
+            f"{setting:<15}{memory_format:<15}{peak / 2**20:>12.0f}{1 - peak / reference[0]:>10.1%}{step_time:>10.3f}{step_time / reference[1]:>9.2f}x"
+        )
@@ -0,0 +1,178 @@
+import inspect
+import json
+import os
+import shutil
+import uuid
+from datetime import datetime
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from utils import log
+
+"""
+Checkpoints written in the background: the state is first copied to the CPU on the training thread,
+then saved by a writer thread, so that training goes on while the file is written.
+- each file is written to a temporary file then renamed, so a checkpoint is never left half-written
+- only the top_k best checkpoints are kept, plus a rolling last.pt
+- index.json lists the kept checkpoints with their metric, e.g. to find the best one of a run
+Each run writes to its own directory (see run_directory), only a resumed run ranking its checkpoints
+with the ones already listed in the index.json of its directory.
+"""
+
+INDEX = "index.json"
+LAST = "last.pt"
+
+
+def to_cpu(state):
+    # copy of the tensors of a (nested) state dict, which training can no longer modify
+    if torch.is_tensor(state):
+        state = state.detach()
+        return state.clone() if state.device.type == "cpu" else state.cpu()
+    if isinstance(state, dict):
+        return type(state)((k, to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(v) for v in state)
+    return state
+
+
+def load_checkpoint(path: str, map_location=None):
+    # the checkpoints are full pickles (metric objects, RNG states), not only weights
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+
+def run_directory(root: str, checkpoint_path: str = None) -> str:
+    # directory of the checkpoint resumed from if it was written by a CheckpointManager, else a new one per run
+    if checkpoint_path:
+        directory = os.path.dirname(os.path.abspath(checkpoint_path))
+        if os.path.exists(os.path.join(directory, INDEX)):
+            return directory
+    # e.g. the sequential trials of a sweep start in the same process and possibly the same second
+    run_id = f"{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}_{uuid.uuid4().hex[:8]}"
+    return os.path.join(root, run_id)
+
+
+def atomic_save(obj, path: str):
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    def __init__(
+        self,
+        directory: str,
+        metric: str,
+        top_k: int = 3,
+        mode: str = "max",
+        resume: bool = False,
+    ):
+        assert mode in {"max", "min"}
+        self.directory = directory
+        # the checkpoints are ranked by this metric, the ones of other metrics are kept as they are
+        self.metric = metric
+        self.top_k = top_k
+        self.mode = mode
+        # a single writer, the checkpoints are written in order
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        os.makedirs(directory, exist_ok=True)
+        # the checkpoints of the run resumed from are still ranked
+        self.index = {"best": [], "last": None}
+        if resume and os.path.exists(self.path(INDEX)):
+            with open(self.path(INDEX)) as f:
+                self.index = json.load(f)
+
+    def path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _best(self, metric: str):
+        return [e for e in self.index["best"] if e["metric"] == metric]
+
+    @property
+    def best_path(self):
+        # path of the best checkpoint, None if there is none
+        best = self._best(self.metric)
+        return self.path(best[0]["file"]) if best else None
+
+    def _is_better(self, value, other) -> bool:
+        return value > other if self.mode == "max" else value < other
+
+    def is_top_k(self, value: float, metric: str = None) -> bool:
+        best = self._best(metric or self.metric)
+        return len(best) < self.top_k or self._is_better(value, best[-1]["value"])
+
+    def save(
+        self,
+        state: dict,
+        epoch: int,
+        metric: str = None,
+        value: float = None,
+        last=True,
+        step: int = None,
+    ):
+        """
+        Saves state as best_{metric}_{value}_epoch_{epoch}.pt (metric defaulting to self.metric) (with _step_{step} when validating
+        every few steps) if value is among the top_k ones,
+        and as last.pt if last (e.g. the snapshots in the middle of an epoch have no value).
+        Returns the path of the best checkpoint (once written)
+        """
+        metric = metric or self.metric
+        is_top_k = value is not None and self.is_top_k(value, metric)
+        if not is_top_k and not last:
+            return self.best_path
+        # at most one snapshot waits for the writer, bounding the memory used by the copies
+        self.wait()
+        state = to_cpu(state)
+
+        removed = []
+        if is_top_k:
+            filename = f"best_{metric}_{value:4f}_epoch_{epoch}"
+            filename += f"_step_{step}.pt" if step is not None else ".pt"
+            entry = {"file": filename, "metric": metric, "value": value, "epoch": epoch}
+            if step is not None:
+                entry["step"] = step
+            best = self._best(metric) + [entry]
+            best.sort(key=lambda e: e["value"], reverse=self.mode == "max")
+            best, removed = best[: self.top_k], best[self.top_k :]
+            others = [e for e in self.index["best"] if e["metric"] != metric]
+            self.index["best"] = best + others
+        if last:
+            self.index["last"] = {"file": LAST, "epoch": epoch}
+        index = json.loads(json.dumps(self.index))
+        self.pending = self.executor.submit(
+            self._write, state, filename if is_top_k else None, last, removed, index
+        )
+        return self.best_path
+
+    def _write(self, state, filename, last, removed, index):
+        if filename:
+            atomic_save(state, self.path(filename))
+        if last:
+            if filename:
+                # same state, copied instead of serialized again
+                shutil.copyfile(self.path(filename), self.path(f"{LAST}.tmp"))
+                os.replace(self.path(f"{LAST}.tmp"), self.path(LAST))
+            else:
+                atomic_save(state, self.path(LAST))
+        for entry in removed:
+            if os.path.exists(self.path(entry["file"])):
+                os.remove(self.path(entry["file"]))
+        tmp_index = self.path(f"{INDEX}.tmp")
+        with open(tmp_index, "w") as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_index, self.path(INDEX))
+
+    def wait(self):
+        # waits for the pending write, raising its error if it failed
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            try:
+                pending.result()
+            except Exception as e:
+                log(f"WARNING: checkpoint could not be written: {e}")
+                raise
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
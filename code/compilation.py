@@ -0,0 +1,104 @@
+import warnings
+from contextlib import nullcontext
+import torch
+from torch import nn
+from utils import log
+
+"""
+Opt-in graph compilation of the models, sharing their parameters with the eager model:
+- "trace": TorchScript traces, one per input shape, dtype, device, train/eval mode and autocast dtype,
+  as a trace freezes the Python control flow and the shapes it was recorded with
+- "compile": torch.compile (torch >= 2.0, the models are traced instead on older versions)
+The forward of the model must not keep state in attributes (see SwinUNet.forward) to be captured.
+The activations of the traced graphs are not checkpointed (see activation_checkpointing.py).
+"""
+
+COMPILE_MODES = ["trace", "compile"]
+
+
+def _autocast_dtype(device_type: str):
+    # dtype of the enclosing autocast region, None outside of autocast
+    try:
+        enabled = torch.is_autocast_enabled(device_type)
+        return torch.get_autocast_dtype(device_type) if enabled else None
+    except TypeError:  # torch < 2.4
+        if device_type == "cpu":
+            enabled = torch.is_autocast_cpu_enabled()
+            return torch.get_autocast_cpu_dtype() if enabled else None
+        return torch.get_autocast_gpu_dtype() if torch.is_autocast_enabled() else None
+
+
+class CompiledModel(nn.Module):
+    """
+    Runs `model` through its compiled graphs, which are built on the first call for each kind of input.
+    check_parity should be called on a first input before training or predicting with it.
+    """
+
+    def __init__(self, model: nn.Module, mode: str = "trace"):
+        super().__init__()
+        assert mode in COMPILE_MODES, f"Unknown compile mode {mode}"
+        if mode == "compile" and not hasattr(torch, "compile"):
+            log("WARNING: torch.compile needs torch >= 2.0, tracing the model instead")
+            mode = "trace"
+        self.model = model
+        self.mode = mode
+        # not registered as submodules, their parameters being the ones of model
+        self._graphs = {}
+
+    def _trace(self, x):
+        # tracing runs the model once, which must neither update its BatchNorm statistics nor draw random numbers
+        buffers = [b.clone() for b in self.model.buffers()]
+        devices = [x.device] if x.device.type == "cuda" else []
+        # the weights cast by autocast must not be cached, or the trace would hold them as constants
+        dtype = _autocast_dtype(x.device.type)
+        uncached = torch.autocast(x.device.type, dtype=dtype, cache_enabled=False)
+        with torch.random.fork_rng(devices=devices), torch.no_grad():
+            with warnings.catch_warnings(), uncached if dtype else nullcontext():
+                # the shapes frozen in the trace are part of its key
+                warnings.simplefilter("ignore", torch.jit.TracerWarning)
+                graph = torch.jit.trace(self.model, x, check_trace=False)
+        with torch.no_grad():
+            for b, saved in zip(self.model.buffers(), buffers):
+                b.copy_(saved)
+        return graph
+
+    def forward(self, x):
+        if self.mode == "compile":
+            # recompiled by torch itself when the input or the mode changes
+            key = "compile"
+            if key not in self._graphs:
+                self._graphs[key] = torch.compile(self.model)
+        else:
+            key = (
+                tuple(x.shape),
+                x.dtype,
+                x.device,
+                self.training,
+                _autocast_dtype(x.device.type),
+            )
+            if key not in self._graphs:
+                self._graphs[key] = self._trace(x)
+        return self._graphs[key](x)
+
+    def check_parity(self, x, rtol: float = 1e-3, atol: float = 1e-4) -> float:
+        """
+        Compares the compiled and eager outputs on x in eval mode (deterministic) and raises a RuntimeError
+        if they differ, the tolerances being loosened under autocast. Returns the max absolute difference.
+        """
+        training = self.training
+        self.eval()
+        try:
+            with torch.no_grad():
+                expected = self.model(x).float()
+                actual = self(x).float()
+        finally:
+            self.train(training)
+        if _autocast_dtype(x.device.type) is not None:
+            rtol, atol = 1e-2, 1e-2
+        diff = (actual - expected).abs().max().item()
+        if not torch.allclose(actual, expected, rtol=rtol, atol=atol):
+            raise RuntimeError(
+                f"The outputs of the {self.mode} model differ from the eager ones (max abs difference {diff:.2e})"
+            )
+        log(f"Outputs of the {self.mode} model checked (max abs difference {diff:.2e})")
+        return diff
@@ -0,0 +1,29 @@
+from utils import *
+import argparse
+from shards import write_shards
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        required=True,
+        help="Path to the split to pack (with images/ and groundtruth/)",
+    )
+    parser.add_argument(
+        "--out-dir",
+        type=str,
+        required=True,
+        help="Path where the shards will be written",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=1024,
+        help="Number of tiles per shard",
+    )
+
+    args = parser.parse_args()
+    log(vars(args))
+
+    write_shards(args.data_dir, args.out_dir, shard_size=args.shard_size)
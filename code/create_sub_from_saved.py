@@ -1,6 +1,7 @@
 from utils import *
 import argparse
 import models.swin_unet as swin_unet
+from compilation import COMPILE_MODES
 
 # TODO import models.unet as unet
 
@@ -38,6 +39,18 @@ if __name__ == "__main__":
         default=False,
         help="If we just resize the image",
     )
+    parser.add_argument(
+        "--uint8-storage",
+        action="store_true",
+        default=False,
+        help="Keep the test images as uint8 until they are fed to the model",
+    )
+    parser.add_argument(
+        "--compile",
+        type=str,
+        choices=COMPILE_MODES,
+        help="Predict through TorchScript traces or torch.compile graphs of the model, checked against the eager outputs",
+    )
 
     args = parser.parse_args()
     log(vars(args))
@@ -49,6 +62,8 @@ if __name__ == "__main__":
             model_path=args.model_weights_path,
             model_type=args.model_type,
             just_resize=args.just_resize,
+            as_uint8=args.uint8_storage,
+            compile_mode=args.compile,
         )
     else:
         raise NotImplementedError("Not implemented yet")
@@ -0,0 +1,129 @@
+import numpy as np
+import torch
+
+"""
+Sampling of square training crops (windows) out of the tiles.
+A CropSampler gives the top-left corners of the crops of every image, for an epoch:
+- "corners": the 4 corners of the image (as crop_to_size_with_crop_index)
+- "grid": crops_per_image random cells of a grid of stride size / 2 covering the whole image (its last row
+  and column flush with the bottom and right edges), a different subset every epoch
+- "random": crops_per_image uniformly random windows
+The positions of all the crops of an epoch are drawn at once (see positions_table) and only depend on
+(seed, epoch, size, image size, number of images), so that they are reproducible and the same in every
+DataLoader worker. crop_batch then gathers all the windows of a batch at once.
+"""
+
+CROP_MODES = ["corners", "grid", "random"]
+
+
+class CropSampler:
+    def __init__(
+        self, size: int, crops_per_image: int = None, mode: str = "corners", seed=0
+    ):
+        assert mode in CROP_MODES, f"Unknown crop mode {mode}"
+        crops_per_image = crops_per_image or 4
+        assert (
+            mode != "corners" or crops_per_image == 4
+        ), "There are only 4 crops per image in corners mode"
+        self.size = size
+        self.crops_per_image = crops_per_image
+        self.mode = mode
+        self.seed = seed
+        # in shared memory so that set_epoch also reaches persistent DataLoader workers
+        self._epoch = torch.zeros((), dtype=torch.int64).share_memory_()
+        self._table = None
+
+    def __len__(self):
+        return self.crops_per_image
+
+    @property
+    def epoch(self):
+        return int(self._epoch)
+
+    def set_epoch(self, epoch: int):
+        self._epoch.fill_(epoch)
+
+    def _grid(self, h: int, w: int):
+        # (n_cells, 2) corners of the grid of stride size / 2 covering the whole image
+        stride = max(self.size // 2, 1)
+        tops = np.unique(
+            np.append(np.arange(0, h - self.size + 1, stride), h - self.size)
+        )
+        lefts = np.unique(
+            np.append(np.arange(0, w - self.size + 1, stride), w - self.size)
+        )
+        return np.stack(np.meshgrid(tops, lefts, indexing="ij"), -1).reshape(-1, 2)
+
+    def _draw(self, h: int, w: int, n_images: int):
+        n, k = n_images, self.crops_per_image
+        if self.mode == "corners":
+            corners = np.array(
+                [
+                    [0, 0],
+                    [0, w - self.size],
+                    [h - self.size, 0],
+                    [h - self.size, w - self.size],
+                ]
+            )
+            return np.ascontiguousarray(np.broadcast_to(corners, (n, 4, 2)))
+        rng = np.random.default_rng((self.seed, self.epoch))
+        if self.mode == "grid":
+            grid = self._grid(h, w)
+            if k <= len(grid):
+                # k distinct cells per image: the first k of a random permutation of the cells
+                cells = rng.random((n, len(grid))).argsort(1)[:, :k]
+            else:
+                cells = rng.integers(0, len(grid), (n, k))
+            return grid[cells]
+        return np.stack(
+            [
+                rng.integers(0, h - self.size + 1, (n, k)),
+                rng.integers(0, w - self.size + 1, (n, k)),
+            ],
+            -1,
+        )
+
+    def positions_table(self, h: int, w: int, n_images: int):
+        """
+        (n_images, crops_per_image, 2) array of the (top, left) corners of all the crops of the epoch,
+        drawn at once and kept until the epoch, the crop size or the image size changes.
+        """
+        assert (
+            h >= self.size and w >= self.size
+        ), f"Cannot crop {self.size}x{self.size} windows out of a {h}x{w} image"
+        key = (self.epoch, self.size, h, w, n_images)
+        if self._table is None or self._table[0] != key:
+            self._table = (key, self._draw(h, w, n_images))
+        return self._table[1]
+
+    def crop(self, x, y, index: int, crop_index: int, n_images: int):
+        # single crop of a (C, H, W) image and its (C', H, W) mask, out of the positions of the epoch
+        table = self.positions_table(x.shape[-2], x.shape[-1], n_images)
+        top, left = table[index, crop_index]
+        window = (..., slice(top, top + self.size), slice(left, left + self.size))
+        return x[window], y[window]
+
+
+def crop_batch(x, positions, size: int):
+    """
+    Gathers the (size, size) windows at `positions` (B, n, 2) out of the batch x (B, [C,] H, W).
+    Returns a (B * n, [C,] size, size) tensor (or array if x is one), ordered image by image.
+    The windows are read from an unfolded view of x, so only the crops themselves are copied.
+    """
+    is_numpy = isinstance(x, np.ndarray)
+    if is_numpy:
+        x = torch.from_numpy(x)
+    if not isinstance(positions, torch.Tensor):
+        positions = torch.tensor(np.array(positions))
+    positions = positions.to(device=x.device, dtype=torch.long)
+    b, n, _ = positions.shape
+    # (B, [C,] H - size + 1, W - size + 1, size, size)
+    windows = x.unfold(-2, size, 1).unfold(-2, size, 1)
+    batch_index = torch.arange(b, device=x.device)[:, None].expand(b, n)
+    tops, lefts = positions[..., 0], positions[..., 1]
+    if x.dim() == 4:
+        crops = windows[batch_index, :, tops, lefts]
+    else:
+        crops = windows[batch_index, tops, lefts]
+    crops = crops.flatten(0, 1)
+    return crops.numpy() if is_numpy else crops
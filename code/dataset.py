@@ -5,6 +5,11 @@ import torch
 import os
 import cv2
 from utils import *
+from tile_cache import TileCache
+from manifest import manifest_files, load_images
+from augmentation import six_to_d4, apply_batch_transforms
+from loaders import to_shared_memory
+from resume import seeded
 
 
 class ImageDataset(torch.utils.data.Dataset):
@@ -17,7 +22,14 @@ class ImageDataset(torch.utils.data.Dataset):
         resize_to=(400, 400),
         crop=False,
         verbose=False,
+        defer_transforms=False,
+        as_uint8=False,
+        crop_size=208,
+        crops_per_image=None,
+        crop_mode="corners",
+        seed=0,
     ):
+        assert not (use_patches and crop), "Patches cannot be cropped"
         self.path = path
         self.device = device
         self.use_patches = use_patches
@@ -26,23 +38,47 @@ class ImageDataset(torch.utils.data.Dataset):
         self.augment = augment
         self.crop = crop
         self.verbose = verbose
+        # If set, the transforms are left to a BatchAugmentation applied on the collated batches
+        self.defer_transforms = defer_transforms
+        # If set, images and masks are kept as uint8 (and patch labels as bool) until they reach the device
+        self.as_uint8 = as_uint8
+        # Crops are taken on the fly, a different set every epoch in "grid" and "random" modes
+        self.crop_sampler = (
+            CropSampler(crop_size, crops_per_image, crop_mode, seed) if crop else None
+        )
         self.N_TRANSFORMS = 6
+        # the random transforms are seeded per (seed, epoch, index), so that they do not depend on the
+        # DataLoader worker (see resume.py), the epoch is in shared memory to reach persistent workers
+        self.seed = seed
+        self._epoch = torch.zeros((), dtype=torch.int64).share_memory_()
         self._load_data()
 
     def __repr__(self) -> str:
         return super().__repr__()
 
-    def _load_data(self):  # not very scalable, but good enough for now
-        self.x = load_all_from_path(os.path.join(self.path, "images"))[:, :, :, :3]
-        self.y = load_all_from_path(os.path.join(self.path, "groundtruth"))
+    @property
+    def epoch(self):
+        return int(self._epoch)
 
-        if self.use_patches:  # split each image into patches
-            self.x, self.y = image_to_patches(self.x, self.y)
+    def set_epoch(self, epoch: int):
+        self._epoch.fill_(epoch)
+        if self.crop_sampler is not None:
+            self.crop_sampler.set_epoch(epoch)
 
-        if self.crop:
-            self.x, self.y = crop_to_size(self.x, self.y)
-        # resize images
-        elif self.resize_to != (self.x.shape[1], self.x.shape[2]):
+    def _load_data(self):  # not very scalable, but good enough for now
+        self.x = load_all_from_path(os.path.join(self.path, "images"), self.as_uint8)[
+            :, :, :, :3
+        ]
+        self.y = load_all_from_path(
+            os.path.join(self.path, "groundtruth"), self.as_uint8
+        )
+
+        if self.use_patches:
+            # split each image into patches, as strided views only copied when a sample is read
+            self.patches = PatchIndex(self.x, self.y)
+            self.y = self.patches.labels
+        # resize images (patches are classified at their own size)
+        elif not self.crop and self.resize_to != (self.x.shape[1], self.x.shape[2]):
             self.x = np.stack(
                 [cv2.resize(img, dsize=self.resize_to) for img in self.x], 0
             )
@@ -50,12 +86,15 @@ class ImageDataset(torch.utils.data.Dataset):
                 [cv2.resize(mask, dsize=self.resize_to) for mask in self.y], 0
             )
 
-        self.x = np.moveaxis(
-            self.x, -1, 1
-        )  # pytorch works with CHW format instead of HWC
-        self.n_samples = len(self.x)
+        if self.use_patches:
+            self.n_samples = len(self.patches)
+        else:
+            self.x = np.moveaxis(
+                self.x, -1, 1
+            )  # pytorch works with CHW format instead of HWC
+            self.n_samples = len(self.x) * (len(self.crop_sampler) if self.crop else 1)
         log(
-            f"Using {'AUGMENTED' if self.augment else 'REGULAR'} dataset {'WITH' if self.use_patches else 'WITHOUT'} patches, with {len(self)} samples in total"
+            f"Using {'AUGMENTED' if self.augment else 'REGULAR'} {'UINT8' if self.as_uint8 else 'FLOAT'} dataset {'WITH' if self.use_patches else 'WITHOUT'} patches, with {len(self)} samples in total"
         )
 
     def transform(self, image, mask, index):
@@ -136,23 +175,29 @@ class ImageDataset(torch.utils.data.Dataset):
             ), f"Mod {mod}\tt_mask should be a tensor, but is {type(t_mask)}"
             return t_image, t_mask
 
+    def _sample(self, index):
+        if self.use_patches:
+            return np.moveaxis(self.patches[index], -1, 0), self.y[[index]]
+        if not self.crop:
+            return self.x[index], self.y[[index]]
+        img_index, crop_index = divmod(index, len(self.crop_sampler))
+        return self.crop_sampler.crop(
+            self.x[img_index], self.y[[img_index]], img_index, crop_index, len(self.x)
+        )
+
     def __getitem__(self, index):
-        if self.augment:
-            image, mask = (
-                self.x[index // self.N_TRANSFORMS],
-                self.y[[index // self.N_TRANSFORMS]],
-            )
-        else:
-            image, mask = self.x[index], self.y[[index]]
+        image, mask = self._sample(
+            index // self.N_TRANSFORMS if self.augment else index
+        )
 
-        image_tensor = np_to_tensor(image, self.device)
-        mask_tensor = np_to_tensor(mask, self.device)
+        # CPU tensors, the whole batch is moved to the device by the DeviceLoader
+        image_tensor = torch.from_numpy(np.ascontiguousarray(image))
+        mask_tensor = torch.from_numpy(np.ascontiguousarray(mask))
 
-        return (
-            self.transform(image_tensor, mask_tensor, index=index)
-            if self.augment
-            else (image_tensor, mask_tensor)
-        )
+        if not self.augment or self.defer_transforms:
+            return image_tensor, mask_tensor
+        with seeded(self.seed, self.epoch, index):
+            return self.transform(image_tensor, mask_tensor, index=index)
 
     def __len__(self):
         return self.n_samples * self.N_TRANSFORMS if self.augment else self.n_samples
@@ -169,7 +214,19 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
         resize_to=None,
         crop_size=None,
         verbose=False,
+        cache_dir=None,
+        defer_transforms=False,
+        as_uint8=False,
+        crops_per_image=None,
+        crop_mode="corners",
+        seed=0,
+        resident=None,
     ):
+        assert resident in {
+            None,
+            "device",
+            "shared",
+        }, f"Unknown resident mode {resident}"
         if crop and not crop_size:
             print("Crop size not set, default to 208")
             crop_size = 208
@@ -188,14 +245,33 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
         self.crop_size = crop_size
         self.type = type_
         self.verbose = verbose
+        self.defer_transforms = defer_transforms
+        self.as_uint8 = as_uint8
+        self.cache_dir = cache_dir
+        self.cache = None
+        # If set, the whole split is kept as uint8 tensors on the device ("device") or in shared memory
+        # ("shared"), and batches are gathered with get_batch
+        self.resident = resident
+        self.images, self.masks = None, None
+        self._positions = None
+        self.crop_sampler = (
+            CropSampler(crop_size, crops_per_image, crop_mode, seed) if crop else None
+        )
+        self.n_crops = len(self.crop_sampler) if crop else 1
         self.N_TRANSFORMS = 6
+        # the random transforms are seeded per (seed, epoch, index), so that they do not depend on the
+        # DataLoader worker (see resume.py), the epoch is in shared memory to reach persistent workers
+        self.seed = seed
+        self._epoch = torch.zeros((), dtype=torch.int64).share_memory_()
         self._load_data()
 
         s = f"""
         {self.type.upper()} dataset, with:
-        - {'TRANSFORMED' if self.augment else 'REGULAR'} dataset
-        - {f'CROPPED TO {self.crop_size}' if self.crop else 'UNCROPPED'} dataset
+        - {('TRANSFORMED ON BATCHES' if self.defer_transforms else 'TRANSFORMED') if self.augment else 'REGULAR'} dataset
+        - {f'CROPPED TO {self.crop_size} ({self.n_crops} {self.crop_sampler.mode.upper()} CROPS PER IMAGE)' if self.crop else 'UNCROPPED'} dataset
         - {f'RESIZED TO {self.resize_to}' if self.resize_to else 'UNRESIZED'} dataset
+        - {f'CACHED IN {self.cache.cache_dir}' if self.cache else 'DECODED ON THE FLY'}{f', RESIDENT ON {self.images.device}' if self.resident else ''}
+        - {'UINT8' if self.as_uint8 else 'FLOAT'} samples
         - {len(self)} SAMPLES in total
         """
 
@@ -204,10 +280,72 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
     def __repr__(self) -> str:
         return super().__repr__()
 
+    @property
+    def epoch(self):
+        return int(self._epoch)
+
+    def set_epoch(self, epoch: int):
+        self._epoch.fill_(epoch)
+        if self.crop_sampler is not None:
+            self.crop_sampler.set_epoch(epoch)
+
+    def set_size(self, crop_size: int = None, resize_to=None):
+        # e.g. the stages of a progressive-resolution schedule (see progressive.py), the DataLoader workers
+        # only seeing the new sizes once they are started again
+        if crop_size is not None:
+            assert self.crop, "Only the crops of a cropped dataset can be resized"
+            self.crop_size = crop_size
+            self.crop_sampler.size = crop_size
+            self._positions = None
+        if resize_to is not None:
+            self.resize_to = resize_to
+
     def _load_data(self):  # not very scalable, but good enough for now
-        self.x = glob(os.path.join(self.path, "images") + "/*.png")
-        self.y = glob(os.path.join(self.path, "groundtruth") + "/*.png")
-        self.n_samples = len(self.x)
+        if self.cache_dir:
+            self.cache = TileCache(self.path, self.cache_dir)
+            self.n_samples = len(self.cache)
+        else:
+            # images and masks paired by id
+            self.x, self.y = manifest_files(self.path)
+            self.n_samples = len(self.x)
+        if self.resident:
+            self._load_resident()
+
+    def _load_resident(self):
+        # The whole split as uint8 tensors: (N, 3, H, W) images and (N, 1, H, W) masks
+        if self.cache is not None:
+            images, masks = self.cache.images, self.cache.masks
+        else:
+            images = load_images(self.x, transform=lambda img: img[:, :, :3])
+            masks = load_images(self.y)
+        self.images = torch.from_numpy(np.ascontiguousarray(np.moveaxis(images, -1, 1)))
+        self.masks = torch.from_numpy(np.array(masks)[:, None])
+        if self.resident == "device":
+            self.images = self.images.to(self.device)
+            self.masks = self.masks.to(self.device)
+        else:
+            self.images = to_shared_memory(self.images)
+            self.masks = to_shared_memory(self.masks)
+
+    def _read_sample(self, img_index):
+        # Returns the image (3, H, W) and the mask (1, H, W) as float arrays in [0, 1]
+        # or as uint8 arrays in [0, 255] if self.as_uint8
+        if self.resident:
+            image = np.moveaxis(self.images[img_index].cpu().numpy(), 0, -1)
+            mask = self.masks[img_index, 0].cpu().numpy()
+        elif self.cache is not None:
+            # No decoding: we only slice the memory-mapped uint8 arrays
+            image = np.array(self.cache.images[img_index])
+            mask = np.array(self.cache.masks[img_index])
+        else:
+            image = np.array(Image.open(self.x[img_index]))[:, :, :3]
+            mask = np.array(Image.open(self.y[img_index]))
+        if not self.as_uint8:
+            image = image.astype(np.float32) / 255.0
+            mask = mask.astype(np.float32) / 255.0
+        image = np.moveaxis(image, -1, 0)
+        mask = np.expand_dims(mask, axis=0)
+        return image, mask
 
     def transform(self, image, mask, index):
         """
@@ -272,7 +410,7 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
         # Unravel index
         if self.crop and self.augment:
             img_index, transform_index, crop_index = np.unravel_index(
-                index, (self.n_samples, self.N_TRANSFORMS, 4)
+                index, (self.n_samples, self.N_TRANSFORMS, self.n_crops)
             )
 
             if self.verbose:
@@ -289,7 +427,9 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
                 print(f"img_index: {img_index}, transform_index: {transform_index}")
 
         elif self.crop:
-            img_index, crop_index = np.unravel_index(index, (self.n_samples, 4))
+            img_index, crop_index = np.unravel_index(
+                index, (self.n_samples, self.n_crops)
+            )
             if self.verbose:
                 print(f"img_index: {img_index}, crop_index: {crop_index}")
 
@@ -297,25 +437,22 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
             img_index = index
 
         # Select image and mask
-        image = (
-            np.array(Image.open(self.x[img_index])).astype(np.float32)[:, :, :3] / 255.0
-        )
-        image = np.moveaxis(image, -1, 0)
-        mask = np.array(Image.open(self.y[img_index])).astype(np.float32) / 255.0
-        mask = np.expand_dims(mask, axis=0)
+        image, mask = self._read_sample(img_index)
 
-        image_tensor = np_to_tensor(image, self.device)
-        mask_tensor = np_to_tensor(mask, self.device)
+        # CPU tensors, the whole batch is moved to the device by the DeviceLoader
+        image_tensor = torch.from_numpy(image)
+        mask_tensor = torch.from_numpy(mask)
 
         if self.crop:
-            image_tensor, mask_tensor = crop_to_size_with_crop_index(
-                image_tensor, mask_tensor, crop_index, size=self.crop_size
+            image_tensor, mask_tensor = self.crop_sampler.crop(
+                image_tensor, mask_tensor, img_index, crop_index, self.n_samples
             )
 
-        if self.augment:
-            image_tensor, mask_tensor = self.transform(
-                image_tensor, mask_tensor, transform_index
-            )
+        if self.augment and not self.defer_transforms:
+            with seeded(self.seed, self.epoch, index):
+                image_tensor, mask_tensor = self.transform(
+                    image_tensor, mask_tensor, transform_index
+                )
 
         if self.resize_to:
             image_tensor = TF.resize(image_tensor, self.resize_to)
@@ -323,11 +460,56 @@ class OptimizedImageDataset(torch.utils.data.Dataset):
 
         return image_tensor, mask_tensor
 
+    def _crop_positions(self, h: int, w: int):
+        # (n_samples, n_crops, 2) positions of the crops of the epoch, computed once per epoch
+        epoch = self.crop_sampler.epoch
+        if self._positions is None or self._positions[0] != epoch:
+            table = self.crop_sampler.positions_table(h, w, self.n_samples)
+            self._positions = (
+                epoch,
+                torch.from_numpy(table).to(self.images.device),
+            )
+        return self._positions[1]
+
+    def get_batch(self, indices):
+        """
+        Resident mode only: the samples `indices` (a tensor), gathered and transformed at once with tensor ops.
+        Returns (B, 3, H, W) images and (B, 1, H, W) masks as floats on self.device.
+        """
+        # Unravel index, in the same order as __getitem__
+        indices = indices.to(self.images.device)
+        crop_index = indices % self.n_crops
+        indices = indices // self.n_crops
+        transform_index = indices % self.N_TRANSFORMS if self.augment else None
+        img_index = indices // self.N_TRANSFORMS if self.augment else indices
+
+        x, y = self.images[img_index], self.masks[img_index]
+        if self.crop:
+            positions = self._crop_positions(*x.shape[-2:])[img_index, crop_index]
+            x = crop_batch(x, positions[:, None], self.crop_size)
+            y = crop_batch(y, positions[:, None], self.crop_size)
+
+        if x.device != torch.device(self.device):
+            # "shared" mode, only the gathered (and cropped) batch is copied
+            if torch.device(self.device).type == "cuda":
+                x, y = x.pin_memory(), y.pin_memory()
+            x = x.to(self.device, non_blocking=True)
+            y = y.to(self.device, non_blocking=True)
+        x, y = to_float_tensor(x), to_float_tensor(y)
+
+        if self.augment and not self.defer_transforms:
+            ks, crop = six_to_d4(transform_index.to(x.device))
+            x, y = apply_batch_transforms(x, y, ks, crop)
+
+        if self.resize_to:
+            x, y = TF.resize(x, self.resize_to), TF.resize(y, self.resize_to)
+        return x, y
+
     def __len__(self):
         if self.augment and self.crop:
-            return self.n_samples * 4 * self.N_TRANSFORMS
+            return self.n_samples * self.n_crops * self.N_TRANSFORMS
         elif self.crop:
-            return self.n_samples * 4
+            return self.n_samples * self.n_crops
         elif self.augment:
             return self.n_samples * self.N_TRANSFORMS
         else:
@@ -0,0 +1,107 @@
+import os
+import torch
+import torch.distributed as dist
+from torch import nn
+from utils import log
+
+"""
+DistributedDataParallel training, one process per device (or per CPU socket), launched with torchrun, e.g.
+    torchrun --nproc_per_node 2 code/run.py --model unet ...
+torchrun sets RANK, LOCAL_RANK and WORLD_SIZE, from which init_distributed joins the process group.
+Every rank trains on its own part of the samples (see resume.ResumableSampler); only rank 0 logs,
+writes the checkpoints and the tensorboard logs, and predicts on the test set.
+The gloo backend also works on CPU (e.g. to test locally), but SyncBatchNorm then falls back to
+the statistics of each rank, as torch only synchronizes them on GPU.
+"""
+
+BACKENDS = ["nccl", "gloo"]
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+    return get_rank() == 0
+
+
+def init_distributed(backend: str = None):
+    # joins the process group when launched by torchrun, returns (rank, world size)
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return 0, 1
+    backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    if torch.cuda.is_available():
+        # "cuda" is then the device of the rank
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+    dist.init_process_group(backend)
+    log(f"Distributed training on {dist.get_world_size()} processes ({backend})")
+    return dist.get_rank(), dist.get_world_size()
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def broadcast_object(obj, src: int = 0):
+    # obj of rank src, on every rank
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_object(obj) -> list:
+    # [obj of rank 0, obj of rank 1, ...] on every rank
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def any_rank(flag: bool, device="cpu") -> bool:
+    # True on every rank if flag is True on any rank
+    if not is_distributed():
+        return bool(flag)
+    t = torch.tensor(int(bool(flag)), device=device)
+    dist.all_reduce(t, op=dist.ReduceOp.MAX)
+    return bool(t.item())
+
+
+def average_gradients(model):
+    # averages the gradients of the ranks, for a step whose micro-batches were all run under DDP no_sync
+    if not is_distributed():
+        return
+    for p in model.parameters():
+        if p.grad is not None:
+            dist.all_reduce(p.grad)
+            p.grad /= get_world_size()
+
+
+def wrap_model(model):
+    """
+    Returns the DDP model used for the training steps, the BatchNorm layers being synchronized across
+    ranks on GPU. The returned model shares its parameters with `model`, which is still used to save
+    the checkpoints (without the "module." prefix) and for validation.
+    """
+    if not is_distributed():
+        return model
+    device = next(model.parameters()).device
+    if device.type == "cuda":
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+        return nn.parallel.DistributedDataParallel(model, device_ids=[device.index])
+    if any(isinstance(m, nn.modules.batchnorm._BatchNorm) for m in model.modules()):
+        log(
+            "WARNING: the BatchNorm statistics are not synchronized across ranks on CPU"
+        )
+    return nn.parallel.DistributedDataParallel(model)
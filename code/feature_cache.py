@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+from tqdm import tqdm
+from utils import log
+from manifest import build_manifest
+from loaders import make_dataloader
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+"""
+On-disk cache of the features of a frozen Swin encoder, to train only the decoder part of a SwinUNet
+(tail, decoder and head) without running the encoder at every step.
+The encoder is run once over every sample of an augmented and cropped OptimizedImageDataset, i.e. every
+(image, transform, crop), and the transformed image, the encoder output and its skip pyramid are stored as
+fp16 memory-mapped arrays (and the mask as uint8). FeatureDataset then reads them back in the same order,
+a sample being ((image, output, *skips), mask), which SwinUNet.forward decodes without its encoder.
+This needs augmentations that are the same every epoch: the "corners" crops, and the random resized crop of the
+6th transform is drawn once (the one of epoch 0) instead of every epoch.
+The cache is keyed by the split (and its files), the dataset settings and a hash of the encoder weights,
+so that a fine-tuned encoder gets its own cache.
+"""
+
+CACHE_VERSION = 1
+INDEX_FILE = "index.json"
+MASKS_FILE = "masks.u8"
+
+
+def _weights_hash(module) -> str:
+    h = hashlib.sha1()
+    for name, t in module.state_dict().items():
+        h.update(name.encode())
+        h.update(t.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def _feature_file(i: int) -> str:
+    # 0: transformed image, 1: encoder output, 2...: skips (first stage first)
+    return f"features_{i}.f16"
+
+
+class FeatureCache:
+    def __init__(self, dataset, encoder, cache_dir: str, batch_size: int = 32):
+        assert (
+            dataset.augment and dataset.crop and not dataset.defer_transforms
+        ), "The features are cached for the transformed crops of the dataset"
+        assert not dataset.resident, "Resident datasets are sampled per rank"
+        assert (
+            dataset.crop_sampler.mode == "corners"
+        ), "Only the corners crops are the same every epoch"
+        key = {
+            "source": os.path.abspath(dataset.path),
+            "files": [
+                [e["image"], e["image_stat"]] for e in build_manifest(dataset.path)
+            ],
+            "n_samples": len(dataset),
+            "crop_size": dataset.crop_size,
+            "resize_to": dataset.resize_to,
+            "seed": dataset.seed,
+            "encoder": _weights_hash(encoder),
+        }
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:12]
+        self.cache_dir = os.path.join(
+            cache_dir, f"{os.path.basename(os.path.abspath(dataset.path))}_{digest}"
+        )
+        self.index = self._read_index()
+        if self.index is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                # another run (or rank) may have built the cache while we were waiting for the lock
+                self.index = self._read_index() or self._build(
+                    dataset, encoder, batch_size
+                )
+        else:
+            log(f"Using feature cache {self.cache_dir} ({len(self)} samples)")
+        self._features, self._masks = None, None
+
+    def __len__(self):
+        return self.index["n_samples"]
+
+    def __getstate__(self):
+        # memmaps are re-opened lazily in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_features"], state["_masks"] = None, None
+        return state
+
+    @property
+    def features(self):
+        # [(N, C, H, W) float16] transformed images, encoder outputs and skips
+        if self._features is None:
+            self._features = [
+                np.memmap(
+                    os.path.join(self.cache_dir, _feature_file(i)),
+                    dtype=np.float16,
+                    mode="r",
+                    shape=(len(self), *shape),
+                )
+                for i, shape in enumerate(self.index["shapes"])
+            ]
+        return self._features
+
+    @property
+    def masks(self):
+        # (N, 1, H, W) uint8
+        if self._masks is None:
+            self._masks = np.memmap(
+                os.path.join(self.cache_dir, MASKS_FILE),
+                dtype=np.uint8,
+                mode="r",
+                shape=(len(self), *self.index["mask_shape"]),
+            )
+        return self._masks
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return index if index.get("version") == CACHE_VERSION else None
+
+    @torch.no_grad()
+    def _build(self, dataset, encoder, batch_size: int):
+        log(f"Building the feature cache of {dataset.path} in {self.cache_dir}...")
+        device = next(encoder.parameters()).device
+        # every sample in order, whatever the rank
+        loader = make_dataloader(
+            dataset,
+            batch_size,
+            device,
+            sampler=torch.utils.data.SequentialSampler(dataset),
+        )
+        training = encoder.training
+        encoder.eval()
+        pid = os.getpid()
+        files, arrays = None, None
+        start = 0
+        for x, y in tqdm(loader, desc="Caching features"):
+            out, x_skips = encoder(x)
+            batch = [x, out, *x_skips, (y * 255).round().to(torch.uint8)]
+            if arrays is None:
+                # allocated once the shapes of the features are known
+                names = [_feature_file(i) for i in range(len(batch) - 1)] + [MASKS_FILE]
+                files = [os.path.join(self.cache_dir, f"{n}.{pid}.tmp") for n in names]
+                arrays = [
+                    np.memmap(
+                        file,
+                        dtype=np.float16 if t.dtype != torch.uint8 else np.uint8,
+                        mode="w+",
+                        shape=(len(dataset), *t.shape[1:]),
+                    )
+                    for file, t in zip(files, batch)
+                ]
+            for array, t in zip(arrays, batch):
+                t = t if t.dtype == torch.uint8 else t.half()
+                array[start : start + len(x)] = t.cpu().numpy()
+            start += len(x)
+        encoder.train(training)
+
+        shapes = [list(a.shape[1:]) for a in arrays]
+        for array, file, name in zip(arrays, files, names):
+            array.flush()
+            os.replace(file, os.path.join(self.cache_dir, name))
+        size_gb = sum(a.nbytes for a in arrays) / 2**30
+        del arrays
+
+        index = {
+            "version": CACHE_VERSION,
+            "n_samples": len(dataset),
+            "shapes": shapes[:-1],
+            "mask_shape": shapes[-1],
+        }
+        # the index is written last (and atomically): a cache without index is never used
+        index_tmp = os.path.join(self.cache_dir, f"{INDEX_FILE}.{pid}.tmp")
+        with open(index_tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(index_tmp, os.path.join(self.cache_dir, INDEX_FILE))
+        log(f"Feature cache built with {len(dataset)} samples ({size_gb:.1f} GB)")
+        return index
+
+
+class FeatureDataset(torch.utils.data.Dataset):
+    """
+    The samples of a FeatureCache, as CPU tensors: ((image, output, *skips), mask), the features being
+    float16 and the mask uint8 (converted to floats on the device, see loaders.py).
+    """
+
+    def __init__(self, cache: FeatureCache):
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, index):
+        features = tuple(
+            torch.from_numpy(np.array(f[index])) for f in self.cache.features
+        )
+        return features, torch.from_numpy(np.array(self.cache.masks[index]))
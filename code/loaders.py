@@ -0,0 +1,282 @@
+import itertools
+import math
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+from utils import to_float_tensor
+from resume import ResumableSampler
+from profiling import phase
+from memory_format import to_channels_last
+
+"""
+The datasets return CPU tensors, so that they can be used from DataLoader worker processes.
+Whole batches are then moved to the device by a DeviceLoader, which on CUDA copies the next batch
+on a side stream while the current one is being used by the model.
+uint8 images/masks and bool labels are only converted to floats once on the device.
+Datasets that are resident (the whole split already on the device or in shared memory) skip the
+DataLoader entirely: their batches are gathered by index tensors by a ResidentLoader.
+Both loaders sample with a ResumableSampler, so that an epoch can be resumed from any batch, or over a
+dataset that samples itself and saves its own position (e.g. shards.ShardedTileDataset).
+With channels_last, the 4D tensors of the batches are converted to the channels-last memory format on the
+device (see memory_format.py).
+"""
+
+
+def _map_tensors(fn, batch):
+    # applies fn to every tensor of a (possibly nested) batch
+    if isinstance(batch, torch.Tensor):
+        return fn(batch)
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_map_tensors(fn, b) for b in batch)
+    if isinstance(batch, dict):
+        return {k: _map_tensors(fn, v) for k, v in batch.items()}
+    return batch
+
+
+def to_device(batch, device, non_blocking=False, channels_last=False):
+    # moves a (possibly nested) batch of tensors to the device, then converts it to floats
+    with phase("h2d"):
+        batch = _map_tensors(
+            lambda t: t.to(device=device, non_blocking=non_blocking), batch
+        )
+        if channels_last:
+            # before the conversion to floats, which keeps the format, e.g. on 1 byte uint8 pixels
+            batch = _map_tensors(to_channels_last, batch)
+        return _map_tensors(to_float_tensor, batch)
+
+
+def _tensors(batch):
+    if isinstance(batch, torch.Tensor):
+        yield batch
+    elif isinstance(batch, (list, tuple)):
+        for b in batch:
+            yield from _tensors(b)
+    elif isinstance(batch, dict):
+        for b in batch.values():
+            yield from _tensors(b)
+
+
+class ResumableLoader:
+    """
+    Loader over a ResumableSampler (self.sampler) or over a dataset that saves its own position in the epoch
+    of the loader (self.dataset, e.g. a ShardedTileDataset), whose position can be saved and restored.
+    """
+
+    num_workers = 0
+    drop_last = False
+
+    @property
+    def _samples_itself(self) -> bool:
+        return not isinstance(self.sampler, ResumableSampler) and hasattr(
+            getattr(self, "dataset", None), "load_state_dict"
+        )
+
+    @property
+    def resumable(self) -> bool:
+        return isinstance(self.sampler, ResumableSampler) or self._samples_itself
+
+    def set_epoch(self, epoch: int):
+        if isinstance(self.sampler, ResumableSampler):
+            self.sampler.set_epoch(epoch)
+        elif self._samples_itself:
+            self.dataset.set_epoch(epoch)
+
+    def state_dict(self, n_batches: int = 0):
+        # position after the first n_batches batches of the epoch
+        if self._samples_itself:
+            return self.dataset.state_dict(
+                n_batches, self.batch_size, self.num_workers, self.drop_last
+            )
+        return self.sampler.state_dict(n_batches * self.batch_size)
+
+    def load_state_dict(self, state):
+        if self._samples_itself:
+            self.dataset.load_state_dict(state, self.num_workers)
+        else:
+            self.sampler.load_state_dict(state)
+
+
+class DeviceLoader(ResumableLoader):
+    def __init__(self, dataloader, device, channels_last=False):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        self.stream = (
+            torch.cuda.Stream(device=self.device)
+            if self.device.type == "cuda"
+            else None
+        )
+
+    def __len__(self):
+        if hasattr(self.dataset, "n_batches"):
+            # e.g. the workers of a ShardedTileDataset each yield their own last (partial) batch
+            return self.dataset.n_batches(
+                self.batch_size, self.num_workers, self.drop_last
+            )
+        return len(self.dataloader)
+
+    @property
+    def dataset(self):
+        return self.dataloader.dataset
+
+    @property
+    def batch_size(self):
+        return self.dataloader.batch_size
+
+    @property
+    def sampler(self):
+        return self.dataloader.sampler
+
+    @property
+    def num_workers(self):
+        return self.dataloader.num_workers
+
+    @property
+    def drop_last(self):
+        return self.dataloader.drop_last
+
+    def _batches(self):
+        # the batches of the dataloader, no more than len(self) of them
+        if hasattr(self.dataset, "n_batches"):
+            return itertools.islice(self.dataloader, len(self))
+        return self.dataloader
+
+    def _preload(self, it):
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return to_device(
+                batch, self.device, non_blocking=True, channels_last=self.channels_last
+            )
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self._batches():
+                yield to_device(batch, self.device, channels_last=self.channels_last)
+            return
+
+        it = iter(self._batches())
+        next_batch = self._preload(it)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            # the batch was allocated on the side stream but is used on the current one
+            for t in _tensors(batch):
+                t.record_stream(current_stream)
+            next_batch = self._preload(it)
+            yield batch
+
+
+def to_shared_memory(tensor):
+    # moves the tensor to shared memory, so that it is not copied in each process using it
+    # (the memory is not page-locked: the copies to the GPU pin the gathered batches, see get_batch)
+    return tensor.share_memory_()
+
+
+class ResidentLoader(ResumableLoader):
+    def __init__(
+        self,
+        dataset,
+        batch_size,
+        device,
+        shuffle=False,
+        drop_last=False,
+        seed=None,
+        equal_ranks=True,
+        subset=None,
+        channels_last=False,
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        self.sampler = ResumableSampler(
+            len(dataset),
+            shuffle=shuffle,
+            seed=seed,
+            equal_ranks=equal_ranks,
+            subset=subset,
+        )
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return math.ceil(len(self.sampler) / self.batch_size)
+
+    def __iter__(self):
+        # the indices live where the data is, so that gathering a batch needs no host work
+        storage = self.dataset.images.device
+        order = self.sampler.order()[self.sampler.start :].to(storage)
+        for i in range(len(self)):
+            indices = order[i * self.batch_size : (i + 1) * self.batch_size]
+            yield to_device(
+                self.dataset.get_batch(indices),
+                self.device,
+                channels_last=self.channels_last,
+            )
+
+
+def make_dataloader(
+    dataset,
+    batch_size,
+    device,
+    shuffle=False,
+    num_workers=0,
+    prefetch_factor=2,
+    persistent_workers=False,
+    seed=None,
+    equal_ranks=True,
+    subset=None,
+    channels_last=False,
+    **kwargs,
+):
+    """
+    Builds a DataLoader over a dataset returning CPU tensors, wrapped in a DeviceLoader.
+    prefetch_factor and persistent_workers are only used with num_workers > 0.
+    Resident datasets get a ResidentLoader instead (and no worker).
+    The samples are drawn by a ResumableSampler seeded by seed (drawn at random if None),
+    except for iterable datasets, which sample themselves.
+    When distributed, each rank loads its part of the samples, equal_ranks (for training) padding them
+    so that every rank runs as many steps.
+    subset: number of samples of a fixed random subset of the dataset that is loaded instead of all of it
+    (not for iterable datasets)
+    channels_last: if set, the batches are in the channels-last memory format (see memory_format.py)
+    """
+    if getattr(dataset, "resident", None):
+        return ResidentLoader(
+            dataset,
+            batch_size,
+            device,
+            shuffle=shuffle,
+            drop_last=kwargs.get("drop_last", False),
+            seed=seed,
+            equal_ranks=equal_ranks,
+            subset=subset,
+            channels_last=channels_last,
+        )
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = prefetch_factor
+        kwargs["persistent_workers"] = persistent_workers
+    if not isinstance(dataset, IterableDataset) and "sampler" not in kwargs:
+        kwargs["sampler"] = ResumableSampler(
+            len(dataset),
+            shuffle=shuffle,
+            seed=seed,
+            equal_ranks=equal_ranks,
+            subset=subset,
+        )
+        # the seeds of the workers do not depend on the global RNG either
+        kwargs["generator"] = torch.Generator().manual_seed(kwargs["sampler"].seed)
+        shuffle = False
+    dataloader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=shuffle,
+        num_workers=num_workers,
+        pin_memory=torch.device(device).type == "cuda",
+        **kwargs,
+    )
+    return DeviceLoader(dataloader, device, channels_last=channels_last)
@@ -0,0 +1,197 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+import numpy as np
+import json
+import os
+import re
+from tqdm import tqdm
+
+"""
+Dataset manifest: an index of the (image, mask) pairs of a split (a folder with `images/` and
+optionally `groundtruth/`), matched by id, with their shapes and dtypes.
+It is built once (only reading the PNG headers) and cached next to the data.
+The pixels are then decoded in bulk by a thread or process pool, whose size is set with set_io_workers.
+"""
+
+MANIFEST_FILE = "manifest.json"
+MANIFEST_VERSION = 1
+
+# channels and dtype of the PIL image modes found in the datasets
+_MODES = {
+    "1": (None, "bool"),
+    "L": (None, "uint8"),
+    "P": (None, "uint8"),
+    "RGB": (3, "uint8"),
+    "RGBA": (4, "uint8"),
+    "I;16": (None, "uint16"),
+    "I": (None, "int32"),
+    "F": (None, "float32"),
+}
+
+_io_workers = os.cpu_count()
+_io_executor = "thread"
+
+
+def set_io_workers(n_workers: int = None, executor: str = "thread"):
+    # number of workers (None for the number of cores) and kind of pool used to decode the PNGs
+    global _io_workers, _io_executor
+    assert executor in {"thread", "process"}, f"Unknown executor {executor}"
+    _io_workers = n_workers or os.cpu_count()
+    _io_executor = executor
+
+
+def file_id(name: str):
+    # the number in the file name (as in the submissions), or the name without extension
+    match = re.search(r"\d+", name)
+    return int(match.group(0)) if match else os.path.splitext(name)[0]
+
+
+def _header(path: str):
+    with Image.open(path) as img:
+        channels, dtype = _MODES.get(img.mode, (None, "uint8"))
+        w, h = img.size
+    shape = [h, w] if channels is None else [h, w, channels]
+    return shape, dtype
+
+
+def _stat(path: str):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def _list_pngs(path: str):
+    if not os.path.isdir(path):
+        return []
+    return sorted(f for f in os.listdir(path) if f.endswith(".png"))
+
+
+def _is_valid(manifest, images, masks) -> bool:
+    if manifest.get("version") != MANIFEST_VERSION:
+        return False
+    if [e["image"] for e in manifest["entries"]] != images:
+        return False
+    if sorted(e["mask"] for e in manifest["entries"] if e["mask"]) != masks:
+        return False
+    # cheap check (no decoding nor hashing) that no file was modified since
+    path = manifest["path"]
+    return all(
+        _stat(os.path.join(path, "images", e["image"])) == e["image_stat"]
+        and (
+            e["mask"] is None
+            or _stat(os.path.join(path, "groundtruth", e["mask"])) == e["mask_stat"]
+        )
+        for e in manifest["entries"]
+    )
+
+
+def build_manifest(path: str, use_cache: bool = True):
+    """
+    Returns the list of entries of the split in `path`, sorted by file name (as load_all_from_path)
+    and each one being a dict with:
+    id, image, mask (file names, mask is None if there is no groundtruth), image_shape, image_dtype,
+    mask_shape, mask_dtype.
+    """
+    path = os.path.abspath(path)
+    images = _list_pngs(os.path.join(path, "images"))
+    masks = _list_pngs(os.path.join(path, "groundtruth"))
+    if len(images) == 0:
+        raise ValueError(f"No .png images found in {path}/images")
+
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if use_cache and os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get("path") == path and _is_valid(manifest, images, masks):
+                return manifest["entries"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    masks_by_id = {file_id(m): m for m in masks}
+    if masks and set(masks_by_id) != set(file_id(i) for i in images):
+        raise ValueError(f"images/ and groundtruth/ of {path} cannot be paired by id")
+
+    entries = []
+    for image in images:
+        image_path = os.path.join(path, "images", image)
+        mask = masks_by_id.get(file_id(image))
+        image_shape, image_dtype = _header(image_path)
+        mask_shape, mask_dtype = (
+            _header(os.path.join(path, "groundtruth", mask)) if mask else (None, None)
+        )
+        entries.append(
+            {
+                "id": file_id(image),
+                "image": image,
+                "mask": mask,
+                "image_shape": image_shape,
+                "image_dtype": image_dtype,
+                "mask_shape": mask_shape,
+                "mask_dtype": mask_dtype,
+                "image_stat": _stat(image_path),
+                "mask_stat": (
+                    _stat(os.path.join(path, "groundtruth", mask)) if mask else None
+                ),
+            }
+        )
+
+    if use_cache:
+        try:
+            tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(
+                    {"version": MANIFEST_VERSION, "path": path, "entries": entries}, f
+                )
+            os.replace(tmp_path, manifest_path)
+        except OSError:
+            # read-only data folder, the manifest is just not cached
+            pass
+    return entries
+
+
+def manifest_files(path: str, entries=None):
+    # full paths of the images and masks of the split, in manifest order
+    entries = entries if entries is not None else build_manifest(path)
+    images = [os.path.join(path, "images", e["image"]) for e in entries]
+    masks = [
+        os.path.join(path, "groundtruth", e["mask"]) if e["mask"] else None
+        for e in entries
+    ]
+    return images, masks
+
+
+def _read_png(path: str):
+    return np.array(Image.open(path))
+
+
+def load_images(
+    files,
+    out=None,
+    transform=None,
+    n_workers=None,
+    executor=None,
+    desc="Loading images",
+):
+    """
+    Decodes all the files with a pool of workers and stacks them in a (N, H, W[, C]) array.
+    If `out` is given (e.g. a memory-mapped array), the images are written into it instead.
+    `transform` is applied to each decoded image before it is stored.
+    """
+    n_workers = n_workers or _io_workers
+    executor = executor or _io_executor
+
+    pool = ThreadPoolExecutor if executor == "thread" else ProcessPoolExecutor
+    with pool(max_workers=n_workers) as ex:
+        decoded = ex.map(_read_png, files, chunksize=1 if executor == "thread" else 8)
+        for i, img in enumerate(tqdm(decoded, total=len(files), desc=desc)):
+            if transform is not None:
+                img = transform(img)
+            if out is None:
+                # the first image gives the shape of the whole array
+                out = np.empty((len(files), *img.shape), dtype=img.dtype)
+            if img.shape != out.shape[1:]:
+                raise ValueError(
+                    f"All images must have the same shape, {files[i]} is {img.shape} instead of {out.shape[1:]}"
+                )
+            out[i] = img
+    return out
@@ -0,0 +1,39 @@
+import torch
+
+"""
+Channels-last training: the tensors keep their logical (B, C, H, W) shape but are NHWC in memory, for which
+cuDNN and oneDNN have faster convolution kernels (especially on tensor cores, in fp16/bf16).
+- the 4D parameters of the model are converted once (see model_memory_format), after which the convolutions,
+  transposed convolutions, poolings, batch norms, elementwise ops and concatenations of NHWC tensors output
+  NHWC tensors: the format is kept through the UNet skips and the decoders without any conversion
+- the loaders convert the batches on the device, before their conversion to floats (see loaders.to_device),
+  and the batch augmentations and test-time augmentation keep the format of their input
+- the Swin encoder works on (B, H, W, C) tensors, so its input permute and the (B, C, H, W) permuted views of
+  its skips and output are already channels-last: they reach the decoder without copies
+benchmark.py compares the training steps in both formats.
+"""
+
+
+def model_memory_format(channels_last: bool):
+    # memory format of the 4D parameters, for model.to(memory_format=...)
+    return torch.channels_last if channels_last else torch.contiguous_format
+
+
+def is_channels_last(x) -> bool:
+    # NHWC in memory, and not also contiguous as NCHW (e.g. a single channel)
+    return (
+        x.dim() == 4
+        and x.is_contiguous(memory_format=torch.channels_last)
+        and not x.is_contiguous()
+    )
+
+
+def memory_format_of(x):
+    return torch.channels_last if is_channels_last(x) else torch.contiguous_format
+
+
+def to_channels_last(x):
+    # 4D tensors are converted (without copy if they already are), the others are returned as they are
+    if x.dim() != 4:
+        return x
+    return x.contiguous(memory_format=torch.channels_last)
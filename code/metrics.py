@@ -0,0 +1,257 @@
+import torch
+import torch.distributed as dist
+from consts import *
+
+"""
+Streaming metrics: each metric accumulates its statistics (e.g. TP/FP/FN/TN counts) over the batches of an
+epoch in a tensor on the device of the batches, without any device sync nor copy to the CPU.
+The value is only computed once, by compute(), after summing the statistics of all the DDP processes.
+A metric can still be called as a function, e.g. metric(y_hat, y), to get its value on one batch.
+Within a StepStats context, the patch means and thresholded pixels of the outputs and labels of the step
+are computed once and shared by the loss and all the metrics.
+"""
+
+
+def patch_size_for(width: int) -> int:
+    # the 400x400 images are split in 16x16 patches, the 208x208 crops in 8x8 ones
+    return PATCH_SIZE if width > 250 else PATCH_SIZE // 2
+
+
+class StepStats:
+    """
+    Cache of the reductions of the outputs and labels (y_hat, y) of one step, e.g.
+        with StepStats(y_hat, y):
+            loss = loss_fn(y_hat, y)
+            metric.update(y_hat, y)
+    pools the patches of y_hat and y once for the loss and all the patch metrics.
+    The tensors are recognized by their storage, so that detached views of them also hit the cache.
+    logits: the logits of the outputs y_hat (the first tensor), if known (see logits_of)
+    """
+
+    current = None
+
+    def __init__(self, *tensors, logits=None):
+        self.tensors = tensors
+        self.logits = logits
+        self.cache = {}
+
+    def __enter__(self):
+        self.previous, StepStats.current = StepStats.current, self
+        return self
+
+    def __exit__(self, *args):
+        StepStats.current = self.previous
+
+    def _index(self, x):
+        for i, t in enumerate(self.tensors):
+            if x is t or (
+                x.data_ptr() == t.data_ptr()
+                and x.shape == t.shape
+                and x.stride() == t.stride()
+                and x.dtype == t.dtype
+            ):
+                return i
+        return None
+
+    def get(self, x, key, fn):
+        i = self._index(x)
+        if i is None:
+            return fn(x)
+        value = self.cache.get((i, key))
+        if value is None or (x.requires_grad and not value.requires_grad):
+            # e.g. a metric (without grad) ran before the loss
+            value = self.cache[(i, key)] = fn(x)
+        return value if x.requires_grad else value.detach()
+
+
+def logits_of(x):
+    # logits of the outputs x of the current step, None if they are unknown
+    stats = StepStats.current
+    if stats is None or stats.logits is None or stats._index(x) != 0:
+        return None
+    return stats.logits if x.requires_grad else stats.logits.detach()
+
+
+def _cached(x, key, fn):
+    stats = StepStats.current
+    return fn(x) if stats is None else stats.get(x, key, fn)
+
+
+def patch_means(x, size: int = None):
+    # (B, 1, H, W) -> (B, 1, H / size, W / size) mean of each patch
+    size = size or patch_size_for(x.shape[-1])
+
+    def pool(x):
+        h_patches, w_patches = x.shape[-2] // size, x.shape[-1] // size
+        return x.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3))
+
+    return _cached(x, ("patch_means", size), pool)
+
+
+def pixel_labels(x, threshold: float = CUTOFF):
+    # boolean x >= threshold
+    return _cached(x, ("pixel_labels", threshold), lambda x: x >= threshold)
+
+
+def confusion(pred, target, dim=None):
+    # TP, FP, FN, TN counts of boolean tensors, summed over `dim` (all the dims if None)
+    dims = dim if dim is not None else tuple(range(pred.dim()))
+    return torch.stack(
+        [
+            (pred & target).sum(dims),
+            (pred & ~target).sum(dims),
+            (~pred & target).sum(dims),
+            (~pred & ~target).sum(dims),
+        ],
+        -1,
+    )
+
+
+def f1_from_confusion(counts):
+    # F1 from (..., 4) TP, FP, FN, TN counts, 0 when there is no positive at all (as sklearn)
+    tp, fp, fn = counts[..., 0], counts[..., 1], counts[..., 2]
+    return 2 * tp / (2 * tp + fp + fn).clamp(min=1)
+
+
+class StreamingMetric:
+    def __init__(self):
+        self.state = None
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}()"
+
+    def reset(self):
+        self.state = None
+
+    def __getstate__(self):
+        # e.g. the best metric saved in the checkpoints, without its (device) statistics
+        return {**self.__dict__, "state": None}
+
+    def _stats(self, y_hat, y):
+        # 1D tensor of statistics of the batch, summed over the epoch
+        raise NotImplementedError
+
+    def _value(self, state):
+        raise NotImplementedError
+
+    @torch.no_grad()
+    def update(self, y_hat, y):
+        stats = self._stats(y_hat.detach(), y.detach())
+        # float64 counts do not overflow (nor lose precision) over an epoch of pixels
+        stats = stats.to(torch.float32 if stats.device.type == "mps" else torch.float64)
+        self.state = stats if self.state is None else self.state + stats
+
+    @torch.no_grad()
+    def compute(self):
+        if self.state is None:
+            return torch.tensor(float("nan"))
+        state = self.state
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            state = state.clone()
+            dist.all_reduce(state)
+        return self._value(state)
+
+    def __call__(self, y_hat, y):
+        return self._value(self._stats(y_hat.detach(), y.detach()).double())
+
+
+class Mean(StreamingMetric):
+    # mean of a scalar (e.g. the loss) over the batches
+    @torch.no_grad()
+    def update(self, value):
+        value = value.detach().reshape(1)
+        super().update(value, torch.ones_like(value))
+
+    def _stats(self, value, count):
+        return torch.cat([value, count])
+
+    def _value(self, state):
+        return state[0] / state[1]
+
+
+class BatchMean(StreamingMetric):
+    # any metric function fn(y_hat, y), averaged over the batches
+    def __init__(self, fn):
+        super().__init__()
+        self.fn = fn
+
+    def __repr__(self) -> str:
+        return f"BatchMean({getattr(self.fn, '__name__', self.fn)})"
+
+    def _stats(self, y_hat, y):
+        value = torch.as_tensor(self.fn(y_hat, y), device=y_hat.device).float()
+        return torch.stack([value, torch.ones_like(value)])
+
+    def _value(self, state):
+        return state[0] / state[1]
+
+
+class Accuracy(StreamingMetric):
+    # pixel accuracy of the rounded predictions (as accuracy_fn)
+    def _stats(self, y_hat, y):
+        y = y.reshape(y_hat.shape)
+        correct = (y_hat.round() == y.round()).sum()
+        return torch.stack([correct, torch.tensor(y.numel(), device=y.device)])
+
+    def _value(self, state):
+        return state[0] / state[1]
+
+
+class F1(StreamingMetric):
+    # pixel F1 score (as f1_score_fn), from the TP/FP/FN/TN counts of the epoch
+    def __init__(self, threshold: float = CUTOFF):
+        super().__init__()
+        self.threshold = threshold
+
+    def _stats(self, y_hat, y):
+        y = y.reshape(y_hat.shape)
+        return confusion(
+            pixel_labels(y_hat, self.threshold), pixel_labels(y, self.threshold)
+        )
+
+    def _value(self, state):
+        return f1_from_confusion(state)
+
+
+class PatchAccuracy(StreamingMetric):
+    # accuracy of the patch labels (as patch_accuracy_fn)
+    def _stats(self, y_hat, y):
+        pred, target = patch_means(y_hat) > CUTOFF, patch_means(y) > CUTOFF
+        correct = (pred == target).sum()
+        return torch.stack([correct, torch.tensor(target.numel(), device=y.device)])
+
+    def _value(self, state):
+        return state[0] / state[1]
+
+
+class PatchF1(StreamingMetric):
+    """
+    F1 score of the patch labels, the metric of the Kaggle competition.
+    The patch labels are computed image by image as in the submissions, then:
+    - per_image=False: one F1 over all the patches of the epoch (as the Kaggle score of a submission)
+    - per_image=True: the mean of the F1 scores of the images
+    """
+
+    def __init__(self, per_image: bool = False):
+        super().__init__()
+        self.per_image = per_image
+
+    def __repr__(self) -> str:
+        return f"PatchF1(per_image={self.per_image})"
+
+    def _stats(self, y_hat, y):
+        pred, target = patch_means(y_hat) > CUTOFF, patch_means(y) > CUTOFF
+        if not self.per_image:
+            return confusion(pred, target)
+        f1 = f1_from_confusion(confusion(pred, target, dim=(1, 2, 3)).double())
+        return torch.stack([f1.sum(), torch.tensor(len(f1), device=f1.device)])
+
+    def _value(self, state):
+        if self.per_image:
+            return state[0] / state[1]
+        return f1_from_confusion(state)
+
+
+def as_metric(fn):
+    # streaming metric of a metric function (or metric)
+    return fn if isinstance(fn, StreamingMetric) else BatchMean(fn)
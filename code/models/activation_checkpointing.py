@@ -0,0 +1,70 @@
+import torch
+import torch.utils.checkpoint
+
+"""
+Activation checkpointing: the activations inside a checkpointed segment are not kept for the
+backward pass but recomputed from its input, trading compute for memory.
+The random state is restored for the recomputation (e.g. the stochastic depth of Swin is replayed),
+and so are the running statistics of the BatchNorm layers of the segment, which are only updated once per step.
+"""
+
+ENCODER_MODES = ["stage", "blocks"]
+
+
+def is_active(module) -> bool:
+    # there is nothing to save when not training
+    return module.training and torch.is_grad_enabled()
+
+
+def _batch_norms(fn):
+    if not isinstance(fn, torch.nn.Module):
+        return []
+    return [
+        m
+        for m in fn.modules()
+        if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)
+        and m.track_running_stats
+    ]
+
+
+def _keep_running_stats(fn, batch_norms):
+    # fn, whose calls after the first one (the recomputations) leave the running statistics as they are
+    calls = 0
+
+    def run(*args):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            return fn(*args)
+        with torch.no_grad():
+            saved = [[b.clone() for b in m.buffers()] for m in batch_norms]
+        try:
+            return fn(*args)
+        finally:
+            # also when the recomputation stops early (non-reentrant checkpoint)
+            with torch.no_grad():
+                for m, buffers in zip(batch_norms, saved):
+                    for b, value in zip(m.buffers(), buffers):
+                        b.copy_(value)
+
+    return run
+
+
+def checkpoint(fn, *args):
+    batch_norms = _batch_norms(fn)
+    if batch_norms:
+        fn = _keep_running_stats(fn, batch_norms)
+    try:
+        # non-reentrant version, which also works when no input requires grad
+        return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False)
+    except TypeError:  # torch < 1.11
+        return torch.utils.checkpoint.checkpoint(fn, *args)
+
+
+def checkpoint_chunks(sequential, x, every: int):
+    # runs an nn.Sequential as consecutive segments of `every` modules, each one being checkpointed
+    modules = list(sequential)
+    for start in range(0, len(modules), every):
+        chunk = torch.nn.Sequential(*modules[start : start + every])
+        x = checkpoint(chunk, x)
+    return x
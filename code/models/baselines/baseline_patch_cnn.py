@@ -5,11 +5,18 @@ import numpy as np
 
 sys.path.append("..")
 from ..losses.dice_loss import BinaryDiceLoss
+from ..losses.bce_loss import SafeBCELoss
 from ..losses.focal_loss import FocalLoss
 from ..losses.mixed_loss import MixedLoss
 from utils import *
 from dataset import ImageDataset
 from train import train
+from sweep import Trial
+from loaders import make_dataloader
+from precision import Float32Sigmoid
+from memory_format import model_memory_format
+from distributed import is_main_process
+from metrics import Accuracy, F1
 from datetime import datetime
 
 
@@ -36,7 +43,7 @@ class PatchCNN(nn.Module):
             nn.ReLU(),
             nn.Dropout(0.5),
             nn.Linear(10, 1),
-            nn.Sigmoid(),
+            Float32Sigmoid(),
         )
 
     def forward(self, x):
@@ -52,23 +59,55 @@ def run(
     checkpoint_path: str = None,
     model_save_dir: str = None,
     loss: str = "bce",
+    num_workers: int = 0,
+    prefetch_factor: int = 2,
+    persistent_workers: bool = False,
+    as_uint8: bool = False,
+    precision: str = "fp32",
+    accumulation_steps: int = 1,
+    keep_checkpoints: int = 3,
+    snapshot_interval: int = None,
+    compile_mode: str = None,
+    max_steps: int = None,
+    val_interval: int = None,
+    val_subset: int = None,
+    patience: int = None,
+    profile: bool = False,
+    trace_steps=None,
+    channels_last: bool = False,
 ):
     log("Training Patch-CNN Baseline...")
     device = (
         "cuda" if torch.cuda.is_available() else "cpu"
     )  # automatically select device
-    train_dataset = ImageDataset(train_path, device, augment=False, use_patches=True)
-    val_dataset = ImageDataset(val_path, device, augment=False, use_patches=True)
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=batch_size, shuffle=True
+    train_dataset = ImageDataset(
+        train_path, device, augment=False, use_patches=True, as_uint8=as_uint8
     )
-    val_dataloader = torch.utils.data.DataLoader(
-        val_dataset, batch_size=batch_size, shuffle=True
+    val_dataset = ImageDataset(
+        val_path, device, augment=False, use_patches=True, as_uint8=as_uint8
     )
-    model = PatchCNN().to(device)
+    loader_kwargs = dict(
+        device=device,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=persistent_workers,
+        channels_last=channels_last,
+    )
+    train_dataloader = make_dataloader(
+        train_dataset, batch_size=batch_size, shuffle=True, **loader_kwargs
+    )
+    val_dataloader = make_dataloader(
+        val_dataset,
+        batch_size=batch_size,
+        shuffle=True,
+        equal_ranks=False,
+        subset=val_subset,
+        **loader_kwargs,
+    )
+    model = PatchCNN().to(device, memory_format=model_memory_format(channels_last))
 
     if loss == "bce":
-        loss_fn = nn.BCELoss()
+        loss_fn = SafeBCELoss()
     elif loss == "dice":
         loss_fn = BinaryDiceLoss()
     elif loss == "mixed":
@@ -76,8 +115,9 @@ def run(
     elif loss == "focal":
         loss_fn = FocalLoss()
 
-    metric_fns = {"acc": accuracy_fn}
-    best_metric_fn = {"patch_f1_score": patch_f1_score_fn}
+    # the outputs are the probabilities of the patch labels, rounded as in the test predictions
+    metric_fns = {"acc": Accuracy()}
+    best_metric_fn = {"patch_f1_score": F1(threshold=0.5)}
     optimizer = torch.optim.Adam(model.parameters())
 
     train(
@@ -92,24 +132,43 @@ def run(
         checkpoint_path=checkpoint_path,
         model_save_path=model_save_dir,
         model_name="baseline_patch_cnn",
+        precision=precision,
+        accumulation_steps=accumulation_steps,
+        keep_checkpoints=keep_checkpoints,
+        snapshot_interval=snapshot_interval,
+        compile_mode=compile_mode,
+        max_steps=max_steps,
+        val_interval=val_interval,
+        patience=patience,
+        profile=profile,
+        trace_steps=trace_steps,
     )
 
     log("Training done!")
+    if not is_main_process() or Trial.current is not None:
+        # the other ranks only take part in training, and the trials of a sweep are compared on their
+        # validations (see sweep.py), without predicting on the test set
+        return
 
     log("Predicting on test set...")
     # predict on test set
     test_path = os.path.join(test_path, "images")
     test_filenames = sorted(glob(test_path + "/*.png"))
-    test_images = load_all_from_path(test_path)
+    test_images = load_all_from_path(test_path, as_uint8)
     test_images = test_images[:, :, :, :3]
     log(f"{test_images.shape[0]} were loaded")
-    test_patches = np.moveaxis(image_to_patches(test_images), -1, 1)  # HWC to CHW
-    test_patches = np.reshape(
-        test_patches, (25, -1, 3, PATCH_SIZE, PATCH_SIZE)
-    )  # split in batches for memory constraints
+    # the patches are only copied batch by batch, for memory constraints
+    test_patches = PatchIndex(test_images)
     test_pred = [
-        model(np_to_tensor(batch, device)).detach().cpu().numpy()
-        for batch in test_patches
+        model(
+            to_float_tensor(
+                np_to_tensor(np.moveaxis(batch, -1, 1), device)  # HWC to CHW
+            )
+        )
+        .detach()
+        .cpu()
+        .numpy()
+        for batch in test_patches.batches(batch_size)
     ]
     test_pred = np.concatenate(test_pred, 0)
     test_pred = np.round(
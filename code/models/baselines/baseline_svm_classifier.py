@@ -8,10 +8,12 @@ sys.path.append("..")
 from utils import *
 
 
-def run(train_path: str, val_path: str, test_path: str):
+def run(train_path: str, val_path: str, test_path: str, as_uint8: bool = False):
     # Load data
     log("Loading data...")
-    train_images, train_masks, val_images, val_masks = load_data(train_path, val_path)
+    train_images, train_masks, val_images, val_masks = load_data(
+        train_path, val_path, as_uint8
+    )
 
     log(f"\tTraining images: {train_images.shape[0]}")
     log(f"\tTraining masks: {train_masks.shape[0]}")
@@ -19,8 +21,10 @@ def run(train_path: str, val_path: str, test_path: str):
     log(f"\tValidation masks: {val_masks.shape[0]}")
 
     log("Creating patches...")
-    train_patches, train_labels = image_to_patches(train_images, train_masks)
-    val_patches, val_labels = image_to_patches(val_images, val_masks)
+    # views over the images, the patches are only copied chunk by chunk to extract the features
+    train_patches = PatchIndex(train_images, train_masks)
+    val_patches = PatchIndex(val_images, val_masks)
+    train_labels, val_labels = train_patches.labels, val_patches.labels
 
     # Extract features
     log("Extracting features...")
@@ -35,8 +39,8 @@ def run(train_path: str, val_path: str, test_path: str):
 
     test_path = os.path.join(test_path, "images")
     test_filenames = sorted(glob(test_path + "/*.png"))
-    test_images = load_all_from_path(test_path)
-    test_patches = image_to_patches(test_images)
+    test_images = load_all_from_path(test_path, as_uint8)
+    test_patches = PatchIndex(test_images)
     x_test = extract_features(test_patches)
     log("Making predictions...")
     test_pred = model.predict(x_test).reshape(
@@ -25,6 +25,22 @@ def run(
     test_path: str,
     checkpoint_path=None,
     model_save_dir: str = None,
+    num_workers: int = 0,
+    prefetch_factor: int = 2,
+    persistent_workers: bool = False,
+    as_uint8: bool = False,
+    precision: str = "fp32",
+    accumulation_steps: int = 1,
+    keep_checkpoints: int = 3,
+    snapshot_interval: int = None,
+    compile_mode: str = None,
+    max_steps: int = None,
+    val_interval: int = None,
+    val_subset: int = None,
+    patience: int = None,
+    profile: bool = False,
+    trace_steps=None,
+    channels_last: bool = False,
 ):
     run_unet(
         train_path=train_path,
@@ -37,4 +53,20 @@ def run(
         checkpoint_path=checkpoint_path,
         model_save_dir=model_save_dir,
         loss="bce",
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=persistent_workers,
+        as_uint8=as_uint8,
+        precision=precision,
+        accumulation_steps=accumulation_steps,
+        keep_checkpoints=keep_checkpoints,
+        snapshot_interval=snapshot_interval,
+        compile_mode=compile_mode,
+        max_steps=max_steps,
+        val_interval=val_interval,
+        val_subset=val_subset,
+        patience=patience,
+        profile=profile,
+        trace_steps=trace_steps,
+        channels_last=channels_last,
     )
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from ..activation_checkpointing import checkpoint, is_active
 
 
 class Block(nn.Module):
@@ -57,10 +58,14 @@ class DecoderBlock(nn.Module):
 
 
 class Decoder(nn.Module):
+    # If set, the activations of each decoder block are recomputed in the backward pass
+    checkpointing = False
+
     def __init__(self, sizes) -> None:
         super().__init__()
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        self.blocks = []
+        # registered, so that the blocks are trained and saved with the model
+        self.blocks = nn.ModuleList()
         for i, size in enumerate(sizes):
             if i == 0:
                 self.blocks.append(
@@ -104,7 +109,10 @@ class Decoder(nn.Module):
     def forward(self, x, skips):
         # We apply the same block to all the skips expect the last one as we need first to upscale the image 4 times
         for block, skip in zip(self.blocks, skips[:-1]):
-            x = block(x, skip)
+            if self.checkpointing and is_active(self):
+                x = checkpoint(block, x, skip)
+            else:
+                x = block(x, skip)
         x = self.last_upX4(x)
         x = torch.cat([x, skips[-1]], dim=1)
         x = self.last_convs(x)
@@ -3,6 +3,7 @@ from torchvision.models import swin_s, Swin_S_Weights, SwinTransformer, Swin_B_W
 from typing import List, Optional, Union, Any, Dict
 from torchvision.models._api import WeightsEnum
 from torchvision.models._utils import V
+from ..activation_checkpointing import checkpoint, checkpoint_chunks, is_active
 
 """
 Construct a SwinTransformer from the torchvision package
@@ -12,14 +13,40 @@ Therefore we can leverage skip connections in the encoder and decoder
 
 
 class IntSwinS(SwinTransformer):
+    # Activation checkpointing of the stages (see set_activation_checkpointing)
+    checkpointing = None
+    checkpoint_every = 1
+
+    def set_activation_checkpointing(self, mode: str = None, every: int = 1):
+        """
+        mode:
+            - None: all the activations are kept for the backward pass
+            - "stage": the activations of each stage are recomputed
+            - "blocks": the activations of every `every` transformer blocks of a stage are recomputed
+        """
+        assert mode in {None, "stage", "blocks"}, f"Unknown checkpointing mode {mode}"
+        self.checkpointing = mode
+        self.checkpoint_every = every
+
+    def _feature(self, i, x):
+        # features[1], [3], [5] and [7] are the stages (the others are the patch embedding and patch mergings)
+        if self.checkpointing is None or i % 2 == 0 or not is_active(self):
+            return self.features[i](x)
+        if self.checkpointing == "stage":
+            return checkpoint(self.features[i], x)
+        return checkpoint_chunks(self.features[i], x, self.checkpoint_every)
+
     def forward(self, x):
-        self.x_skips = []
+        # returns the output and the skip features of the stages (first stage first), without keeping them
+        # as attributes, so that the forward has no side effects (and can be traced or compiled)
+        x_skips = []
         for i in range(len(self.features)):
-            x = self.features[i](x)
+            x = self._feature(i, x)
             if i % 2 == 1 and i < len(self.features) - 2:
                 # We don't want to the last one as it is the output
-                self.x_skips.append(x.permute(0, 3, 1, 2))
-        return x.permute(0, 3, 1, 2)
+                # (B, H, W, C) -> (B, C, H, W) view, channels-last in memory (see memory_format.py)
+                x_skips.append(x.permute(0, 3, 1, 2))
+        return x.permute(0, 3, 1, 2), x_skips
 
 
 def _ovewrite_named_param(kwargs: Dict[str, Any], param: str, new_value: V) -> None:
@@ -136,11 +163,11 @@ def swin_b(
     )
 
 
-def swin_pretrained_s():
-    weights = Swin_S_Weights.IMAGENET1K_V1
+def swin_pretrained_s(pretrained: bool = True):
+    weights = Swin_S_Weights.IMAGENET1K_V1 if pretrained else None
     return swin_s(weights=weights)
 
 
-def swin_pretrained_b():
-    weights = Swin_B_Weights.IMAGENET1K_V1
+def swin_pretrained_b(pretrained: bool = True):
+    weights = Swin_B_Weights.IMAGENET1K_V1 if pretrained else None
     return swin_b(weights=weights)
@@ -0,0 +1,39 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from metrics import logits_of
+
+EPS = 1e-7
+
+
+def binary_cross_entropy(inputs, targets, reduction="mean", eps=EPS):
+    """
+    Binary cross-entropy of probabilities, computed in fp32 (unlike F.binary_cross_entropy, it can be called
+    under autocast). The outputs of a training step are given with their logits (see metrics.StepStats),
+    on which it is computed by F.binary_cross_entropy_with_logits: exact, and with a gradient however
+    saturated the prediction is. Otherwise (e.g. in validation), the probabilities are clamped to
+    [eps, 1 - eps], so that it stays finite for probabilities of exactly 0 or 1.
+    """
+    logits = logits_of(inputs)
+    if logits is not None:
+        return F.binary_cross_entropy_with_logits(
+            logits.float(), targets.float(), reduction=reduction
+        )
+    inputs = inputs.float().clamp(eps, 1 - eps)
+    targets = targets.float()
+    loss = -(targets * torch.log(inputs) + (1 - targets) * torch.log1p(-inputs))
+    if reduction == "mean":
+        return loss.mean()
+    if reduction == "sum":
+        return loss.sum()
+    assert reduction == "none", f"Unknown reduction {reduction}"
+    return loss
+
+
+class SafeBCELoss(nn.Module):
+    def __init__(self, reduction: str = "mean"):
+        super(SafeBCELoss, self).__init__()
+        self.reduction = reduction
+
+    def forward(self, y_hat, y):
+        return binary_cross_entropy(y_hat, y, reduction=self.reduction)
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from .f1_score import F1Score
 from consts import CUTOFF
+from metrics import pixel_labels
 
 
 class DifferentiableF1Loss(nn.Module):
@@ -11,12 +12,8 @@ class DifferentiableF1Loss(nn.Module):
         self.f1_score = F1Score(threshold=threshold)
 
     def forward(self, y_hat, y):
-        aug_y_hat = torch.where(
-            y_hat >= self.threshold, torch.ones_like(y_hat), torch.zeros_like(y_hat)
-        )
-        aug_y = torch.where(
-            y >= self.threshold, torch.ones_like(y), torch.zeros_like(y)
-        )
+        aug_y_hat = pixel_labels(y_hat, self.threshold).to(y_hat.dtype)
+        aug_y = pixel_labels(y, self.threshold).to(y.dtype)
 
         f1 = self.f1_score(y_hat=aug_y_hat, y=aug_y)
 
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from models.losses.f1_score import F1Score
 from consts import PATCH_SIZE, CUTOFF
+from metrics import patch_means
 import numpy as np
 
 
@@ -21,13 +22,9 @@ class DifferentiablePatchF1Loss(nn.Module):
         w = y_hat.shape[-1]
         size = self.patch_size if w > 250 else self.patch_size // 2
         # computes accuracy weighted by patches (metric used on Kaggle for evaluation)
-        h_patches = y.shape[-2] // size
-        w_patches = y.shape[-1] // size
-
-        tmp_patches_hat = y_hat.reshape(-1, 1, h_patches, size, w_patches, size).mean(
-            (-1, -3)
-        )
-        tmp_patches = y.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3))
+        # (pooled once per step for the loss and the metrics, see metrics.StepStats)
+        tmp_patches_hat = patch_means(y_hat, size)
+        tmp_patches = patch_means(y, size)
 
         patches_hat = torch.where(
             tmp_patches_hat >= self.threshold,
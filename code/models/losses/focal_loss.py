@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
+from .bce_loss import binary_cross_entropy
 
 # PyTorch
 ALPHA = 0.8
@@ -16,12 +17,9 @@ class FocalLoss(nn.Module):
         # comment out if your model contains a sigmoid or equivalent activation layer
         # inputs = F.sigmoid(inputs)
 
-        # flatten label and prediction tensors
-        inputs = inputs.view(-1)
-        targets = targets.view(-1)
-
-        # first compute binary cross-entropy
-        BCE = F.binary_cross_entropy(inputs, targets, reduction="mean")
+        # first compute binary cross-entropy (in fp32, on the logits of the outputs of a training step,
+        # which are found from the unflattened outputs)
+        BCE = binary_cross_entropy(inputs, targets, reduction="mean")
         BCE_EXP = torch.exp(-BCE)
         focal_loss = alpha * (1 - BCE_EXP) ** gamma * BCE
 
@@ -1,5 +1,6 @@
 import torch.nn as nn
 from .dice_loss import BinaryDiceLoss
+from .bce_loss import SafeBCELoss
 
 
 class MixedLoss(nn.Module):
@@ -18,7 +19,7 @@ class MixedLoss(nn.Module):
             reduction=reduction,
         )
 
-        self.bce_loss = nn.modules.BCELoss()
+        self.bce_loss = SafeBCELoss()
 
     def forward(self, y_hat, y):
         bce_loss = self.bce_loss(y_hat, y)
@@ -6,18 +6,31 @@ from datetime import datetime
 from pandas import test
 from utils import *
 from train import train
+from sweep import Trial
 from dataset import OptimizedImageDataset
+from augmentation import BatchAugmentation
+from shards import ShardedTileDataset
 from PIL import Image
 import torch
 import torch.nn as nn
 
 from .losses.dice_loss import BinaryDiceLoss
+from .losses.bce_loss import SafeBCELoss
 from .losses.mixed_loss import MixedLoss
 from .losses.focal_loss import FocalLoss
 from .losses.twersky_focal_loss import FocalTverskyLoss
 from .losses.mixed_f1_loss import MixedF1Loss
 from .losses.mixed_patch_f1_loss import MixedPatchF1Loss
-from torch.utils.data import DataLoader
+from loaders import make_dataloader
+from progressive import ProgressiveLoader, parse_schedule
+from feature_cache import FeatureCache, FeatureDataset
+from validation import make_val_loader
+from checkpoints import load_checkpoint
+from distributed import is_main_process
+from precision import Float32Sigmoid
+from memory_format import model_memory_format
+from compilation import CompiledModel
+from metrics import Accuracy, PatchAccuracy, PatchF1
 
 from .encoders.swin import swin_pretrained_s, swin_pretrained_b
 from .decoders.custom_decoder import Decoder
@@ -30,14 +43,20 @@ INFERED_SIZES = [(768, 384), (384, 192), (192, 96), (96, 48)]
 INFERED_SIZES_B = [(1024, 512), (512, 256), (256, 128), (128, 64)]
 
 
+def is_valid_input_size(size: int) -> bool:
+    # the encoder downsamples by 4, 8, 16 and 32 (rounding up), and the first decoder block upsamples its
+    # output from n to 2n - 1, which has to match the skip at size / 16: size is 16 times an odd number
+    return size % 16 == 0 and (size // 16) % 2 == 1
+
+
 class SwinUNet(nn.Module):
-    def __init__(self, model_type: str = "small"):
+    def __init__(self, model_type: str = "small", pretrained: bool = True):
         assert model_type in {"small", "base"}
         super(SwinUNet, self).__init__()
         device = "cuda" if torch.cuda.is_available() else "cpu"
 
         if model_type == "small":
-            self.encoder = swin_pretrained_s().to(device)
+            self.encoder = swin_pretrained_s(pretrained).to(device)
             self.decoder = Decoder(INFERED_SIZES).to(device)
             self.prev_conv = nn.Conv2d(
                 INFERED_SIZES[0][0],
@@ -59,7 +78,7 @@ class SwinUNet(nn.Module):
                 nn.ReLU(),
             )
         else:
-            self.encoder = swin_pretrained_b().to(device)
+            self.encoder = swin_pretrained_b(pretrained).to(device)
             self.decoder = Decoder(sizes=INFERED_SIZES_B).to(device)
 
             self.tail = nn.Sequential(
@@ -82,14 +101,42 @@ class SwinUNet(nn.Module):
             nn.Conv2d(self.last_n_channels // 2, 3, 3, padding=1),
             nn.ReLU(),
             nn.Conv2d(3, 1, 1),
-            nn.Sigmoid(),
+            Float32Sigmoid(),
+        )
+
+    def set_activation_checkpointing(
+        self, encoder: str = None, every: int = 1, decoder: bool = False
+    ):
+        # trades compute for memory, see IntSwinS.set_activation_checkpointing for the encoder modes
+        self.encoder.set_activation_checkpointing(encoder, every)
+        self.decoder.checkpointing = decoder
+
+    def load_state_dict(self, state_dict, strict: bool = True):
+        # the decoder blocks used to be kept in a plain list, so older checkpoints do not hold their weights
+        legacy = not any(k.startswith("decoder.blocks.") for k in state_dict)
+        if not legacy:
+            return super().load_state_dict(state_dict, strict=strict)
+        log(
+            "WARNING: checkpoint saved without the decoder blocks, which keep their initial weights"
         )
+        result = super().load_state_dict(state_dict, strict=False)
+        missing = [
+            k for k in result.missing_keys if not k.startswith("decoder.blocks.")
+        ]
+        if strict and (missing or result.unexpected_keys):
+            raise RuntimeError(
+                f"Error(s) in loading state_dict for SwinUNet: missing keys {missing}, unexpected keys {result.unexpected_keys}"
+            )
+        return result
 
     def forward(self, x):
+        if isinstance(x, (tuple, list)):
+            # (image, encoder output, *skips) precomputed by a frozen encoder, see feature_cache.py
+            x, out, *x_skips = [t.float() for t in x]
+        else:
+            out, x_skips = self.encoder(x)
         x_tail = self.tail(x)
-        x = self.encoder(x)
-        self.encoder.x_skips.reverse()
-        x = self.decoder(x, self.encoder.x_skips + [x_tail])
+        x = self.decoder(out, x_skips[::-1] + [x_tail])
 
         return self.head(x)
 
@@ -104,51 +151,173 @@ def run(
     checkpoint_path: str = None,
     model_type: str = "small",
     loss: str = "focal",
+    tile_cache_dir: str = None,
+    batch_augment: str = None,
+    num_workers: int = 0,
+    prefetch_factor: int = 2,
+    persistent_workers: bool = False,
+    as_uint8: bool = False,
+    train_shards: str = None,
+    crops_per_image: int = None,
+    crop_mode: str = "corners",
+    resident: str = None,
+    precision: str = "fp32",
+    accumulation_steps: int = 1,
+    keep_checkpoints: int = 3,
+    snapshot_interval: int = None,
+    compile_mode: str = None,
+    max_steps: int = None,
+    val_interval: int = None,
+    val_subset: int = None,
+    patience: int = None,
+    lr: float = 1e-3,
+    crop_size: int = None,
+    profile: bool = False,
+    trace_steps=None,
+    val_mode: str = "augmented",
+    val_batch_size: int = None,
+    activation_checkpointing: str = None,
+    checkpoint_every: int = 1,
+    checkpoint_decoder: bool = False,
+    freeze_encoder: bool = False,
+    feature_cache_dir: str = None,
+    resolution_schedule=None,
+    channels_last: bool = False,
 ):
+    """
+    freeze_encoder: if set, only the tail, decoder and head are trained
+    feature_cache_dir: if set, the encoder is frozen and its features on the training crops are computed once
+    and cached in feature_cache_dir, the decoder part being trained on them, see feature_cache.py
+    resolution_schedule: stages "SIZE:BATCH_SIZE:EPOCHS" of progressive-resolution training, the crops being
+    resized to SIZE (instead of 400) in each stage, see progressive.py
+    channels_last: if set, the model and the batches are in the channels-last memory format, see memory_format.py
+    """
     assert loss in {"bce", "dice", "mixed", "focal", "twersky", "f1", "patch-f1"}
+    if resolution_schedule:
+        resolution_schedule = parse_schedule(resolution_schedule)
+        for size, _, _ in resolution_schedule:
+            assert is_valid_input_size(
+                size
+            ), f"Invalid Swin-UNet input size {size}, expected 16 times an odd number (e.g. 208, 304, 400)"
+        assert (
+            feature_cache_dir is None
+        ), "The features are cached at a single resolution"
+    if feature_cache_dir is not None:
+        assert (
+            train_shards is None and batch_augment is None
+        ), "The features are cached for the transforms of the training dataset"
+        assert compile_mode is None, "The decoder cannot be compiled on cached features"
+        freeze_encoder = True
     log(f"Training Swin-{model_type.capitalize()}-UNet...")
+    crop_size = crop_size or 208
     device = (
         "cuda" if torch.cuda.is_available() else "cpu"
     )  # automatically select device
-    train_dataset = OptimizedImageDataset(
-        train_path,
-        device,
-        augment=True,
-        crop=True,
-        crop_size=208,
-        resize_to=(400, 400),
-        type_="training",
-    )
+    if train_shards is not None:
+        # streamed from shards (see create_shards.py), the augmentations are then done per batch
+        train_dataset = ShardedTileDataset(
+            train_shards,
+            crop=True,
+            crop_size=crop_size,
+            resize_to=(400, 400),
+            as_uint8=as_uint8,
+            crops_per_image=crops_per_image,
+            crop_mode=crop_mode,
+        )
+        batch_augment = batch_augment or "six"
+    else:
+        train_dataset = OptimizedImageDataset(
+            train_path,
+            device,
+            augment=True,
+            crop=True,
+            crop_size=crop_size,
+            resize_to=(400, 400),
+            type_="training",
+            cache_dir=tile_cache_dir,
+            # the feature cache reads every sample once, in order
+            resident=resident if feature_cache_dir is None else None,
+            as_uint8=as_uint8,
+            defer_transforms=batch_augment is not None,
+            crops_per_image=crops_per_image,
+            crop_mode=crop_mode,
+        )
+    # in the fixed validation modes, the crops are not augmented (see validation.py)
     val_dataset = OptimizedImageDataset(
         val_path,
         device,
-        augment=True,
+        augment=val_mode == "augmented",
         crop=True,
-        crop_size=208,
+        crop_size=crop_size,
         resize_to=(400, 400),
         type_="validation",
+        cache_dir=tile_cache_dir,
+        resident=resident,
+        as_uint8=as_uint8,
     )
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
+    loader_kwargs = dict(
+        device=device,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=persistent_workers,
+        channels_last=channels_last,
     )
-    val_dataloader = DataLoader(
+    val_dataloader = make_val_loader(
         val_dataset,
-        batch_size=batch_size,
-        shuffle=True,
+        batch_size=val_batch_size or batch_size,
+        mode=val_mode,
+        subset=val_subset,
+        **loader_kwargs,
+    )
+    model = SwinUNet(model_type=model_type).to(
+        device, memory_format=model_memory_format(channels_last)
+    )
+    model.set_activation_checkpointing(
+        activation_checkpointing, checkpoint_every, checkpoint_decoder
     )
-    model = SwinUNet(model_type=model_type).to(device)
-
-    # model.encoder.features.requires_grad_ = False
-    # param.requires_grad = False
-    # model.encoder.weight.requires_grad = False
-    # exit()
-    metric_fns = {"acc": accuracy_fn, "patch_acc": patch_accuracy_fn}
-    best_metric_fns = {"patch_acc": patch_accuracy_fn}
+    if freeze_encoder:
+        model.encoder.requires_grad_(False)
+    if feature_cache_dir is not None:
+        if checkpoint_path:
+            # the features are the ones of the encoder of the checkpoint
+            checkpoint = load_checkpoint(checkpoint_path, map_location=device)
+            model.load_state_dict(checkpoint["model_state_dict"])
+        cache = FeatureCache(
+            train_dataset,
+            model.encoder,
+            feature_cache_dir,
+            batch_size=val_batch_size or batch_size,
+        )
+        # the validation still runs the encoder, on the images
+        train_dataset = FeatureDataset(cache)
+    if resolution_schedule:
+
+        def make_stage_loader(size, stage_batch_size):
+            train_dataset.set_size(resize_to=(size, size))
+            return make_dataloader(
+                train_dataset,
+                batch_size=stage_batch_size,
+                shuffle=train_shards is None,
+                **loader_kwargs,
+            )
+
+        train_dataloader = ProgressiveLoader(resolution_schedule, make_stage_loader)
+    else:
+        train_dataloader = make_dataloader(
+            train_dataset,
+            batch_size=batch_size,
+            # an IterableDataset shuffles itself
+            shuffle=train_shards is None,
+            **loader_kwargs,
+        )
+
+    metric_fns = {"acc": Accuracy(), "patch_acc": PatchAccuracy()}
+    best_metric_fns = {"patch_acc": PatchAccuracy()}
     # Observe that all parameters are being optimized
     # optimizer_ft = torch.optim.SGD(model.parameters(), lr=0.001, momentum=0.9)
-    optimizer_ft = torch.optim.Adam(model.parameters())
+    optimizer_ft = torch.optim.Adam(
+        (p for p in model.parameters() if p.requires_grad), lr=lr
+    )
 
     # Decay LR by a factor of 0.1 every 7 epochs
     # exp_lr_scheduler = torch.optim.lr_scheduler.StepLR(
@@ -156,7 +325,7 @@ def run(
     # )
 
     if loss == "bce":
-        loss_fn = torch.nn.BCELoss()
+        loss_fn = SafeBCELoss()
     elif loss == "dice":
         loss_fn = BinaryDiceLoss()
     elif loss == "mixed":
@@ -178,8 +347,8 @@ def run(
     else:
         raise NotImplementedError(f"Loss {loss} is not implemented")
 
-    metric_fns = {"acc": accuracy_fn, "patch_acc": patch_accuracy_fn}
-    best_metric_fns = {"patch_f1_score": patch_f1_score_fn}
+    metric_fns = {"acc": Accuracy(), "patch_acc": PatchAccuracy()}
+    best_metric_fns = {"patch_f1_score": PatchF1()}
 
     best_weights_path = train(
         train_dataloader=train_dataloader,
@@ -194,11 +363,34 @@ def run(
         checkpoint_path=checkpoint_path,
         save_state=True,
         model_save_path=model_save_dir,
+        batch_transform=BatchAugmentation(batch_augment) if batch_augment else None,
+        precision=precision,
+        accumulation_steps=accumulation_steps,
+        keep_checkpoints=keep_checkpoints,
+        snapshot_interval=snapshot_interval,
+        compile_mode=compile_mode,
+        max_steps=max_steps,
+        val_interval=val_interval,
+        patience=patience,
+        profile=profile,
+        trace_steps=trace_steps,
+        tta=val_mode == "tta",
         model_name="swin-unet",
     )
 
     log("Training done!")
-    test_and_create_sub(test_path, best_weights_path, model_type, just_resize=True)
+    if not is_main_process() or Trial.current is not None:
+        # the other ranks only take part in training, and the trials of a sweep are compared on their
+        # validations (see sweep.py), without predicting on the test set
+        return
+    test_and_create_sub(
+        test_path,
+        best_weights_path,
+        model_type,
+        just_resize=True,
+        as_uint8=as_uint8,
+        compile_mode=compile_mode,
+    )
 
 
 INPUT_SIZE = 208
@@ -209,12 +401,16 @@ def test_and_create_sub(
     model_path: str = None,
     model_type: str = "small",
     just_resize: bool = False,
+    as_uint8: bool = False,
+    compile_mode: str = None,
 ):
+    # compile_mode: None (eager), "trace" or "compile", see compilation.py
     device = "cuda" if torch.cuda.is_available() else "cpu"
     log("Predicting on test set...")
     test_path = os.path.join(test_path, "images")
     test_filenames = glob(test_path + "/*.png")
-    test_images = load_all_from_path(test_path)
+    # if as_uint8, the images stay uint8 until they are fed to the model
+    test_images = load_all_from_path(test_path, as_uint8)
     batch_size = test_images.shape[0]
     size = test_images.shape[1:3]
 
@@ -231,14 +427,19 @@ def test_and_create_sub(
         with torch.no_grad():
             model = SwinUNet(model_type=model_type).to(device)
             if model_path:
-                checkpoint = torch.load(model_path, map_location=device)
+                checkpoint = load_checkpoint(model_path, map_location=device)
                 model.load_state_dict(checkpoint["model_state_dict"])
                 log(f"Loaded best model weights ({model_path})")
             else:
                 log("DEBUG: No best weights path using default weights")
+            model.eval()
+            if compile_mode:
+                model = CompiledModel(model, compile_mode)
+                model.check_parity(to_float_tensor(test_images[:1]))
 
             test_pred = [
-                model(t).detach().cpu().numpy() for t in tqdm(test_images.unsqueeze(1))
+                model(to_float_tensor(t)).detach().cpu().numpy()
+                for t in tqdm(test_images.unsqueeze(1))
             ]
 
         test_pred = np.concatenate(test_pred, 0)
@@ -272,16 +473,21 @@ def test_and_create_sub(
         with torch.no_grad():
             model = SwinUNet(model_type=model_type).to(device)
             if model_path:
-                checkpoint = torch.load(model_path, map_location=device)
+                checkpoint = load_checkpoint(model_path, map_location=device)
                 model.load_state_dict(checkpoint["model_state_dict"])
                 log(f"Loaded best model weights ({model_path})")
             else:
                 log("DEBUG: No best weights path using default weights")
+            model.eval()
+            if compile_mode:
+                model = CompiledModel(model, compile_mode)
             test_pred = []
             CROP_SIZE = 200
             RESIZE_SIZE = 208
             os.makedirs("tmp", exist_ok=True)
             for i, image in enumerate(tqdm(test_images)):
+                if image.dtype == np.uint8:
+                    image = image.astype(np.float32) / 255.0
                 # np_image = image.cpu().numpy()
                 a = Image.fromarray((image * 255).astype(np.uint8))
                 # plt.imshow(a)
@@ -329,6 +535,8 @@ def test_and_create_sub(
                 # BHWC -> BCHW
                 # TODO : ASK IF THIS IS CORRECT CLEMENT
                 resized_crops = np_to_tensor(np.moveaxis(resized_image, -1, 1), device)
+                if compile_mode and i == 0:
+                    model.check_parity(resized_crops)
 
                 # predict the segmentation
                 # res has shape (4, H, W)
@@ -1,8 +1,11 @@
 from datetime import datetime
 from train import train
+from sweep import Trial
 from dataset import OptimizedImageDataset
+from augmentation import BatchAugmentation
 from utils import *
 from .losses.dice_loss import BinaryDiceLoss
+from .losses.bce_loss import SafeBCELoss
 from .losses.mixed_f1_loss import MixedF1Loss
 from .losses.mixed_patch_f1_loss import MixedPatchF1Loss
 from .losses.focal_loss import FocalLoss
@@ -13,7 +16,14 @@ import torch
 import sys
 import numpy as np
 import cv2
-from torch.utils.data import DataLoader
+from loaders import make_dataloader
+from progressive import ProgressiveLoader, parse_schedule
+from validation import make_val_loader
+from checkpoints import load_checkpoint
+from distributed import is_main_process
+from precision import Float32Sigmoid
+from memory_format import model_memory_format
+from metrics import Accuracy, F1, PatchAccuracy, PatchF1
 
 
 sys.path.append("..")
@@ -59,7 +69,7 @@ class UNet(nn.Module):
             [Block(in_ch, out_ch) for in_ch, out_ch in zip(dec_chs[:-1], dec_chs[1:])]
         )  # decoder blocks
         self.head = nn.Sequential(
-            nn.Conv2d(dec_chs[-1], 1, 1), nn.Sigmoid()
+            nn.Conv2d(dec_chs[-1], 1, 1), Float32Sigmoid()
         )  # 1x1 convolution for producing the output
 
     def forward(self, x):
@@ -91,8 +101,47 @@ def run(
     model_save_dir: str = None,
     crop: bool = True,
     loss: str = "bce",
+    tile_cache_dir: str = None,
+    batch_augment: str = None,
+    num_workers: int = 0,
+    prefetch_factor: int = 2,
+    persistent_workers: bool = False,
+    as_uint8: bool = False,
+    crops_per_image: int = None,
+    crop_mode: str = "corners",
+    resident: str = None,
+    precision: str = "fp32",
+    accumulation_steps: int = 1,
+    keep_checkpoints: int = 3,
+    snapshot_interval: int = None,
+    compile_mode: str = None,
+    max_steps: int = None,
+    val_interval: int = None,
+    val_subset: int = None,
+    patience: int = None,
+    lr: float = 1e-3,
+    crop_size: int = None,
+    profile: bool = False,
+    trace_steps=None,
+    val_mode: str = "augmented",
+    val_batch_size: int = None,
+    resolution_schedule=None,
+    channels_last: bool = False,
 ):
+    """
+    resolution_schedule: stages "SIZE:BATCH_SIZE:EPOCHS" of progressive-resolution training, the training crops
+    being SIZE x SIZE (a multiple of 16, for the 4 poolings) in each stage, see progressive.py
+    channels_last: if set, the model and the batches are in the channels-last memory format, see memory_format.py
+    """
     log("Training Vanilla-UNet...")
+    crop_size = crop_size or 384
+    if resolution_schedule:
+        resolution_schedule = parse_schedule(resolution_schedule)
+        assert crop, "The resolution schedule sets the size of the crops"
+        for size, _, _ in resolution_schedule:
+            assert (
+                size % 16 == 0
+            ), f"Invalid UNet input size {size}, expected a multiple of 16"
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
     # reshape the image to simplify the handling of skip connections and maxpooling
@@ -101,43 +150,76 @@ def run(
         path=train_path,
         device=device,
         # resize_to=(384, 384),
-        crop_size=384,
+        crop_size=crop_size,
         crop=crop,
         type_="training",
         augment=augment,
+        cache_dir=tile_cache_dir,
+        resident=resident,
+        as_uint8=as_uint8,
+        defer_transforms=batch_augment is not None,
+        crops_per_image=crops_per_image,
+        crop_mode=crop_mode,
     )
     log(f"After loading image dataset on {train_dataset.device}")
     display_gpu_usage()
 
-    train_dataloader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
+    loader_kwargs = dict(
+        device=device,
+        num_workers=num_workers,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=persistent_workers,
+        channels_last=channels_last,
     )
+    if resolution_schedule:
+
+        def make_stage_loader(size, stage_batch_size):
+            train_dataset.set_size(crop_size=size)
+            return make_dataloader(
+                train_dataset,
+                batch_size=stage_batch_size,
+                shuffle=True,
+                **loader_kwargs,
+            )
+
+        train_dataloader = ProgressiveLoader(resolution_schedule, make_stage_loader)
+    else:
+        train_dataloader = make_dataloader(
+            train_dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            **loader_kwargs,
+        )
 
     val_dataset = OptimizedImageDataset(
         path=val_path,
         device=device,
         # resize_to=(384, 384),
-        crop_size=384,
+        crop_size=crop_size,
         crop=crop,
         type_="validation",
-        augment=augment,
+        # in the fixed validation modes, the crops are not augmented (see validation.py)
+        augment=augment and val_mode == "augmented",
+        cache_dir=tile_cache_dir,
+        resident=resident,
+        as_uint8=as_uint8,
     )
     log(f"After loading image dataset on {val_dataset.device}")
     display_gpu_usage()
 
-    val_dataloader = DataLoader(
+    val_dataloader = make_val_loader(
         val_dataset,
-        batch_size=batch_size,
-        shuffle=True,
+        batch_size=val_batch_size or batch_size,
+        mode=val_mode,
+        subset=val_subset,
+        **loader_kwargs,
     )
 
     display_gpu_usage()
 
-    model = UNet().to(device)
+    model = UNet().to(device, memory_format=model_memory_format(channels_last))
     if loss == "bce":
-        loss_fn = nn.BCELoss()
+        loss_fn = SafeBCELoss()
     elif loss == "dice":
         loss_fn = BinaryDiceLoss()
     elif loss == "mixed":
@@ -158,14 +240,14 @@ def run(
         )
     else:
         raise ValueError(f"Unknown loss function: {loss}")
-    best_metric_fn = {"patch_f1": patch_f1_score_fn}
+    best_metric_fn = {"patch_f1": PatchF1()}
     metric_fns = {
-        "acc": accuracy_fn,
-        "patch_acc": patch_accuracy_fn,
-        "patch_f1": patch_f1_score_fn,
-        "f1": f1_score_fn,
+        "acc": Accuracy(),
+        "patch_acc": PatchAccuracy(),
+        "patch_f1": PatchF1(),
+        "f1": F1(),
     }
-    optimizer = torch.optim.Adam(model.parameters())
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
     best_weights_path = train(
         train_dataloader=train_dataloader,
@@ -176,6 +258,18 @@ def run(
         best_metric_fn=best_metric_fn,
         checkpoint_path=checkpoint_path,
         model_save_path=model_save_dir,
+        batch_transform=BatchAugmentation(batch_augment) if batch_augment else None,
+        precision=precision,
+        accumulation_steps=accumulation_steps,
+        keep_checkpoints=keep_checkpoints,
+        snapshot_interval=snapshot_interval,
+        compile_mode=compile_mode,
+        max_steps=max_steps,
+        val_interval=val_interval,
+        patience=patience,
+        profile=profile,
+        trace_steps=trace_steps,
+        tta=val_mode == "tta",
         save_state=True,
         optimizer=optimizer,
         n_epochs=n_epochs,
@@ -183,12 +277,16 @@ def run(
     )
 
     log("Training done!")
+    if not is_main_process() or Trial.current is not None:
+        # the other ranks only take part in training, and the trials of a sweep are compared on their
+        # validations (see sweep.py), without predicting on the test set
+        return
 
     log("Predicting on test set...")
     # predict on test set
     test_path = os.path.join(test_path, "images")
     test_filenames = glob(test_path + "/*.png")
-    test_images = load_all_from_path(test_path)
+    test_images = load_all_from_path(test_path, as_uint8)
     batch_size = test_images.shape[0]
     size = test_images.shape[1:3]
     # we also need to resize the test images. This might not be the best ideas depending on their spatial resolution.
@@ -200,12 +298,13 @@ def run(
     test_images = np_to_tensor(np.moveaxis(test_images, -1, 1), device)
     log("Making predictions...")
     # Load best model state
-    checkpoint = torch.load(best_weights_path)
+    checkpoint = load_checkpoint(best_weights_path)
     model.load_state_dict(checkpoint["model_state_dict"])
     log(f"Loaded best model weights ({best_weights_path})")
 
     test_pred = [
-        model(t).detach().cpu().numpy() for t in tqdm(test_images.unsqueeze(1))
+        model(to_float_tensor(t)).detach().cpu().numpy()
+        for t in tqdm(test_images.unsqueeze(1))
     ]
     test_pred = np.concatenate(test_pred, 0)
     test_pred = np.moveaxis(test_pred, 1, -1)  # CHW to HWC
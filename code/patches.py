@@ -0,0 +1,57 @@
+from numpy.lib.stride_tricks import as_strided
+import numpy as np
+from consts import *
+
+"""
+Patches of a set of images, for the patch classifiers (Patch-CNN and SVC baselines).
+Instead of copying every patch out of the images, a PatchIndex sees the (N, H, W, C) images as an
+(N, H / PATCH_SIZE, W / PATCH_SIZE, PATCH_SIZE, PATCH_SIZE, C) strided view, so the patches are
+only materialized when a batch of them is read.
+"""
+
+
+def _patch_view(x, patch_size: int):
+    # (N, H, W, ...) -> (N, H / P, W / P, P, P, ...) view, without copy
+    n, h, w = x.shape[:3]
+    s = x.strides
+    return as_strided(
+        x,
+        shape=(n, h // patch_size, w // patch_size, patch_size, patch_size)
+        + x.shape[3:],
+        strides=(s[0], patch_size * s[1], patch_size * s[2], s[1], s[2]) + s[3:],
+        writeable=False,
+    )
+
+
+class PatchIndex:
+    def __init__(self, images, masks=None, patch_size: int = PATCH_SIZE):
+        n, h, w = images.shape[:3]
+        # make sure images can be patched exactly
+        assert (h % patch_size) + (w % patch_size) == 0
+        self.patch_size = patch_size
+        self.grid_shape = (n, h // patch_size, w // patch_size)
+        self.patches = _patch_view(images[..., :3], patch_size)
+        self.labels = None
+        if masks is not None:
+            # one pooled reduction over the patches of all the masks
+            pooled = _patch_view(masks, patch_size)
+            means = pooled.mean(axis=tuple(range(3, pooled.ndim))).reshape(-1)
+            if masks.dtype == np.uint8:
+                # uint8 masks are in [0, 255], labels are kept as bool
+                self.labels = means > CUTOFF * 255
+            else:
+                self.labels = (means > CUTOFF).astype(np.float32)
+
+    def __len__(self):
+        return int(np.prod(self.grid_shape))
+
+    def __getitem__(self, index):
+        # a view for a single patch, a (B, P, P, C) copy for a slice or an array of indices
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        return self.patches[np.unravel_index(index, self.grid_shape)]
+
+    def batches(self, batch_size: int):
+        # the (B, P, P, C) patches, in order, one batch at a time
+        for start in range(0, len(self), batch_size):
+            yield self[start : start + batch_size]
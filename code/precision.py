@@ -0,0 +1,54 @@
+import torch
+from torch import nn
+from utils import log
+
+"""
+Mixed-precision training: the forward pass runs under autocast and, in fp16, the loss is scaled
+by a GradScaler so that small gradients do not underflow.
+- "fp32": no autocast (default)
+- "bf16": bf16 autocast, on CPU or on the GPU
+- "fp16": fp16 autocast with gradient scaling on the GPU (falls back to bf16 on CPU)
+The losses are always computed in fp32, outside of autocast. In training, the models output their logits
+(see Float32Sigmoid), so that the binary cross-entropy is computed on them.
+"""
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+def autocast_dtype(precision: str, device_type: str):
+    # dtype of the autocast regions, None for no autocast
+    assert precision in PRECISIONS, f"Unknown precision {precision}"
+    if precision == "fp32":
+        return None
+    if device_type not in {"cpu", "cuda"}:
+        log(f"WARNING: no autocast on {device_type}, training in fp32")
+        return None
+    if precision == "fp16" and device_type == "cpu":
+        log("WARNING: fp16 autocast is not supported on CPU, using bf16 instead")
+        return torch.bfloat16
+    return torch.float16 if precision == "fp16" else torch.bfloat16
+
+
+def autocast(device_type: str, dtype):
+    return torch.autocast(device_type, dtype=dtype, enabled=dtype is not None)
+
+
+def make_grad_scaler(device_type: str, dtype):
+    # only fp16 needs its gradients to be scaled (bf16 has the same range as fp32)
+    enabled = dtype == torch.float16 and device_type == "cuda"
+    if hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+class Float32Sigmoid(nn.Sigmoid):
+    """
+    Output layer of the models: the probabilities are computed in fp32 even under autocast, so that they do
+    not round to 0 or 1. In training mode, the fp32 logits are returned instead, from which train() computes
+    the probabilities and the binary cross-entropy (see metrics.StepStats).
+    """
+
+    def forward(self, x):
+        if self.training:
+            return x.float()
+        return torch.sigmoid(x.float())
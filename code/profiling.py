@@ -0,0 +1,196 @@
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+from torch.profiler import ProfilerActivity, profile, record_function
+from utils import log
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+"""
+Instrumentation of the training steps, to tell whether a run is input-bound or compute-bound.
+A StepProfiler is active in train(), and the loaders and the training loop mark the phases of each step
+with phase(name) (see PHASES), which is a no-op when the profiler neither times nor traces:
+- timing: the time of each phase, the device being synced around every phase so that the asynchronous
+  kernels are attributed to the phase that launched them. This serializes the host to device copies and the
+  computations that overlap otherwise (and slows training down a little), so the split shows the cost of
+  each phase rather than the overlap. Nested phases (e.g. the copy of the next batch while waiting for it)
+  are not counted in their parent.
+- trace_steps (start, end): a torch.profiler trace of the optimizer steps start + 1 to end, with the phases as
+  labelled ranges, exported for chrome://tracing (or Perfetto)
+The throughput (samples/s) and the peak memory (CPU RSS and device) are always measured, as they need no sync
+(the peak RSS is the one of the whole process, and is not measured on Windows).
+"""
+
+PHASES = [
+    "data",
+    "h2d",
+    "augment",
+    "forward",
+    "loss",
+    "metrics",
+    "backward",
+    "optimizer",
+]
+
+
+def phase(name: str):
+    # marks a phase of the step for the active StepProfiler, if any
+    profiler = StepProfiler.current
+    return profiler.phase(name) if profiler is not None else nullcontext()
+
+
+def timed(iterable, name: str = "data"):
+    # iterates over iterable, the wait for each item being the phase name
+    it = iter(iterable)
+    while True:
+        with phase(name):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+
+def peak_rss():
+    # peak resident memory of the process, in bytes (ru_maxrss is in kB on Linux), None if unknown
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StepProfiler:
+    current = None
+
+    def __init__(
+        self,
+        device,
+        timing: bool = False,
+        trace_steps=None,
+        trace_dir: str = None,
+        world_size: int = 1,
+    ):
+        self.device = torch.device(device)
+        self.timing = timing
+        if trace_steps is not None:
+            assert (
+                trace_steps[0] < trace_steps[1]
+            ), f"Empty range of traced steps {trace_steps}"
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.world_size = world_size
+        self.trace = None
+        self._stack = []
+        self.reset()
+
+    def __enter__(self):
+        self.previous, StepProfiler.current = StepProfiler.current, self
+        return self
+
+    def __exit__(self, *args):
+        StepProfiler.current = self.previous
+        # e.g. training stopped early, the steps traced so far are exported
+        self._stop_trace()
+
+    def reset(self):
+        # e.g. after a validation, which is not part of the training throughput
+        self.times = defaultdict(float)
+        self.samples = 0
+        self.steps = 0
+        self.start = time.perf_counter()
+        if self.device.type == "cuda":
+            # the peak device memory of the next summary is the one of its steps
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @contextmanager
+    def phase(self, name: str):
+        if not (self.timing or self.trace):
+            yield
+            return
+        with record_function(name):
+            if not self.timing:
+                yield
+                return
+            self._sync()
+            start = time.perf_counter()
+            self._stack.append(0.0)  # time of the nested phases
+            try:
+                yield
+            finally:
+                self._sync()
+                elapsed = time.perf_counter() - start
+                self.times[name] += elapsed - self._stack.pop()
+                if self._stack:
+                    self._stack[-1] += elapsed
+
+    def count(self, n_samples: int):
+        # samples of the current micro-batch
+        self.samples += n_samples
+
+    def step(self, global_step: int):
+        # called after each optimizer step
+        self.steps += 1
+        self.trace_window(global_step)
+
+    def trace_window(self, global_step: int):
+        # opens or closes the trace window after global_step optimizer steps
+        if self.trace_steps is None:
+            return
+        start, end = self.trace_steps
+        if global_step == start and self.trace is None:
+            activities = [ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(ProfilerActivity.CUDA)
+            self.trace = profile(activities=activities, profile_memory=True)
+            self.trace.__enter__()
+            log(f"Tracing the optimizer steps {start + 1} to {end}")
+        elif global_step == end:
+            self._stop_trace()
+
+    def _stop_trace(self):
+        if self.trace is None:
+            return
+        self.trace.__exit__(None, None, None)
+        start, end = self.trace_steps
+        path = os.path.join(self.trace_dir or "", f"trace_steps_{start}-{end}.json")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.trace.export_chrome_trace(path)
+        log(f"Trace of the steps {start + 1} to {end} exported to {path}")
+        self.trace = None
+        # the trace window is only recorded once
+        self.trace_steps = None
+
+    def summary(self) -> dict:
+        """
+        Scalars of the steps since the last summary: samples/s (of all the processes), peak memory (MiB)
+        and, when timing, the mean time of each phase per optimizer step (ms) and the fraction of the time
+        spent loading the data (data, h2d), close to 1 when the run is input-bound.
+        """
+        elapsed = time.perf_counter() - self.start
+        values = {
+            "perf/samples_per_s": self.samples * self.world_size / max(elapsed, 1e-9),
+        }
+        rss = peak_rss()
+        if rss is not None:
+            values["perf/peak_rss_mib"] = rss / 2**20
+        if self.device.type == "cuda":
+            values["perf/peak_device_mib"] = (
+                torch.cuda.max_memory_allocated(self.device) / 2**20
+            )
+        if self.timing and self.steps:
+            for name in PHASES:
+                values[f"perf/time_{name}_ms"] = 1000 * self.times[name] / self.steps
+            total = sum(self.times.values())
+            values["perf/input_fraction"] = (
+                self.times["data"] + self.times["h2d"]
+            ) / max(total, 1e-9)
+        self.reset()
+        return values
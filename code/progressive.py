@@ -0,0 +1,99 @@
+from loaders import ResumableLoader
+from utils import log
+
+"""
+Progressive-resolution training: the first epochs run on small samples in large batches, which are cheap,
+and the following stages step up to the full resolution. A schedule is a list of stages
+"SIZE:BATCH_SIZE:EPOCHS", e.g. ["208:16:10", "304:8:10", "400:4"], the last stage lasting until the end of
+training (its epochs can be omitted). The sizes must be valid inputs of the model (see
+models.swin_unet.is_valid_input_size), and the validation stays at the final resolution.
+ProgressiveLoader rebuilds the DataLoader (and its workers, which hold a copy of the dataset) with the size
+and batch size of the stage whenever train() moves to an epoch of another stage.
+"""
+
+
+def parse_schedule(stages):
+    # ["SIZE:BATCH_SIZE:EPOCHS", ...] -> [(size, batch_size, epochs)], epochs being None for the last stage
+    schedule = []
+    for i, stage in enumerate(stages):
+        values = stage.split(":")
+        last = i == len(stages) - 1
+        assert len(values) == 3 or (
+            last and len(values) == 2
+        ), f"Invalid stage {stage}, expected SIZE:BATCH_SIZE:EPOCHS"
+        size, batch_size, epochs = [int(v) for v in values] + [None] * (3 - len(values))
+        assert size > 0 and batch_size > 0, f"Invalid stage {stage}"
+        assert epochs is None or epochs > 0, f"Invalid stage {stage}"
+        schedule.append((size, batch_size, None if last else epochs))
+    assert schedule, "Empty resolution schedule"
+    return schedule
+
+
+class ProgressiveLoader(ResumableLoader):
+    """
+    Training loader of the stages (size, batch_size, epochs) of a schedule (see parse_schedule), the loader of
+    each stage being built by make_loader(size, batch_size) at its first epoch (see set_epoch).
+    The position within an epoch is the one of the loader of its stage, so that a snapshot resumes
+    in the right stage.
+    """
+
+    def __init__(self, stages, make_loader):
+        self.stages = stages
+        self.make_loader = make_loader
+        self.stage = None
+        self.loader = None
+        self.set_epoch(0)
+
+    def stage_of(self, epoch: int) -> int:
+        end = 0
+        for i, (_, _, epochs) in enumerate(self.stages):
+            if epochs is None:
+                return i
+            end += epochs
+            if epoch < end:
+                return i
+        return len(self.stages) - 1
+
+    def set_epoch(self, epoch: int):
+        stage = self.stage_of(epoch)
+        if stage != self.stage:
+            size, batch_size, _ = self.stages[stage]
+            log(
+                f"Resolution stage {stage + 1}/{len(self.stages)} from epoch {epoch + 1}: {size}x{size} samples in batches of {batch_size}"
+            )
+            # the previous loader (and its workers) is released first
+            self.loader = None
+            self.loader = self.make_loader(size, batch_size)
+            self.stage = stage
+        if hasattr(self.loader, "set_epoch"):
+            self.loader.set_epoch(epoch)
+
+    @property
+    def size(self) -> int:
+        return self.stages[self.stage][0]
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def num_workers(self):
+        return self.loader.num_workers
+
+    @property
+    def drop_last(self):
+        return self.loader.drop_last
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        return iter(self.loader)
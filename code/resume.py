@@ -0,0 +1,153 @@
+import random
+import signal
+import threading
+import numpy as np
+import torch
+from contextlib import contextmanager
+from utils import log
+from distributed import broadcast_object, get_rank, get_world_size
+
+"""
+Resumable training: the snapshots written by train() hold everything needed to continue from the
+exact optimizer step they were taken at (model, optimizer, scaler and scheduler states, epoch metrics,
+RNG states and position in the epoch).
+For the continuation to be bit-for-bit identical, no randomness may depend on how far the loader got:
+- the order of the samples only depends on (seed, epoch), see ResumableSampler
+- the random transforms of the samples are seeded per (seed, epoch, index), see seeded
+- the batch augmentations and the model (e.g. stochastic depth) use the global RNGs, saved in the snapshot
+On the GPU, the continuation is only as deterministic as the kernels are (see torch.use_deterministic_algorithms).
+"""
+
+# signals sent before the job is killed, e.g. by LSF with bsub -wa USR2
+PREEMPTION_SIGNALS = ["SIGTERM", "SIGUSR1", "SIGUSR2"]
+
+
+def rng_state() -> dict:
+    return {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+    }
+
+
+def set_rng_state(state: dict):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _seed(*keys) -> int:
+    return int(np.random.SeedSequence([int(k) for k in keys]).generate_state(1)[0])
+
+
+@contextmanager
+def seeded(*keys):
+    # the CPU torch RNG is seeded by keys inside the block, and restored after it
+    with torch.random.fork_rng(devices=[]):
+        torch.manual_seed(_seed(*keys))
+        yield
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Samples the indices in an order that only depends on (seed, epoch), from the `start`-th one on.
+    The seed is drawn at random if not given (by rank 0 when distributed), and saved with state_dict.
+    When distributed, each rank samples every world_size-th index of the order. With equal_ranks, the
+    order is padded with its first indices so that every rank gets as many samples (and training steps).
+    With subset, only a fixed random subset of `subset` indices is sampled, the same for every seed
+    (e.g. to validate on the same samples across runs and resumptions).
+    """
+
+    def __init__(
+        self,
+        n: int,
+        shuffle: bool = True,
+        seed: int = None,
+        equal_ranks: bool = True,
+        subset: int = None,
+    ):
+        self.indices = None
+        if subset is not None and subset < n:
+            generator = torch.Generator().manual_seed(_seed(n, subset))
+            self.indices = torch.randperm(n, generator=generator)[:subset].sort().values
+            n = subset
+        self.n = n
+        self.shuffle = shuffle
+        self.seed = broadcast_object(
+            int(torch.empty((), dtype=torch.int64).random_()) if seed is None else seed
+        )
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.equal_ranks = equal_ranks
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.start = 0
+
+    def order(self):
+        # indices of the rank, for the whole epoch
+        if not self.shuffle:
+            order = torch.arange(self.n)
+        else:
+            generator = torch.Generator().manual_seed(_seed(self.seed, self.epoch))
+            order = torch.randperm(self.n, generator=generator)
+        if self.indices is not None:
+            order = self.indices[order]
+        if self.world_size == 1:
+            return order
+        if self.equal_ranks:
+            padding = -self.n % self.world_size
+            order = torch.cat([order, order[:padding]])
+        return order[self.rank :: self.world_size]
+
+    def __iter__(self):
+        return iter(self.order()[self.start :].tolist())
+
+    def __len__(self):
+        if self.equal_ranks:
+            n_rank = -(-self.n // self.world_size)
+        else:
+            n_rank = len(range(self.rank, self.n, self.world_size))
+        return n_rank - self.start
+
+    def state_dict(self, start: int = 0):
+        # state of the sampler starting at the start-th sample of the epoch
+        return {"seed": self.seed, "start": start}
+
+    def load_state_dict(self, state):
+        self.seed, self.start = state["seed"], state["start"]
+
+
+class PreemptionHandler:
+    """
+    Within the block, PREEMPTION_SIGNALS do not kill the process but set `requested`,
+    so that the training loop can write a snapshot before exiting.
+    """
+
+    def __init__(self):
+        self.requested = None
+        self.previous = {}
+
+    def _handle(self, signum, frame):
+        log(
+            f"Received {signal.Signals(signum).name}, stopping within the next few steps"
+        )
+        self.requested = signum
+
+    def __enter__(self):
+        # signal handlers can only be set from the main thread
+        if threading.current_thread() is threading.main_thread():
+            for name in PREEMPTION_SIGNALS:
+                if hasattr(signal, name):
+                    signum = getattr(signal, name)
+                    self.previous[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def __exit__(self, *args):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)
+        self.previous = {}
@@ -5,12 +5,20 @@ import models.baselines.baseline_patch_cnn as patch_cnn
 import models.baselines.baseline_vanilla_unet as vanilla_unet
 import models.swin_unet as swin_unet
 import models.unet as unet
+from manifest import set_io_workers
+from crops import CROP_MODES
+from precision import PRECISIONS
+from models.activation_checkpointing import ENCODER_MODES
+from distributed import BACKENDS, cleanup_distributed, init_distributed
+from compilation import COMPILE_MODES
+from validation import VAL_MODES
+from sweep import PRUNERS, run_sweep
 from torchvision import __version__
 
 log(f"Running torchvision {__version__}")
 
 
-if __name__ == "__main__":
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "model",
@@ -22,6 +30,7 @@ if __name__ == "__main__":
             "baseline-patch-cnn",
             "unet",
             "swin-unet",
+            "sweep",
         ],
     )
     parser.add_argument(
@@ -92,10 +101,268 @@ if __name__ == "__main__":
         type=str,
         help="Path of a model checkpoint to load",
     )
+    parser.add_argument(
+        "--tile-cache-dir",
+        type=str,
+        help="Directory of the decoded tile cache, shared by all runs (disabled if not set)",
+    )
+    parser.add_argument(
+        "--batch-augment",
+        type=str,
+        choices=["six", "d4"],
+        help="Augment whole batches on the device instead of each sample in the dataset",
+    )
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=0,
+        help="Number of DataLoader worker processes (0 loads the data in the main process)",
+    )
+    parser.add_argument(
+        "--prefetch-factor",
+        type=int,
+        default=2,
+        help="Number of batches loaded in advance by each worker",
+    )
+    parser.add_argument(
+        "--persistent-workers",
+        action="store_true",
+        default=False,
+        help="Keep the DataLoader workers alive between epochs",
+    )
+    parser.add_argument(
+        "--uint8-storage",
+        action="store_true",
+        default=False,
+        help="Keep images and masks as uint8 until they are converted to floats on the device",
+    )
+    parser.add_argument(
+        "--io-workers",
+        type=int,
+        help="Number of workers decoding the images in bulk (defaults to the number of cores)",
+    )
+    parser.add_argument(
+        "--io-executor",
+        type=str,
+        choices=["thread", "process"],
+        default="thread",
+        help="Kind of pool decoding the images in bulk",
+    )
+    parser.add_argument(
+        "--train-shards",
+        type=str,
+        help="Directory of training shards written by create_shards.py, streamed instead of --train-dir (Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--crops-per-image",
+        type=int,
+        help="Number of training crops taken out of each image per epoch (4 in corners mode)",
+    )
+    parser.add_argument(
+        "--crop-mode",
+        type=str,
+        choices=CROP_MODES,
+        default="corners",
+        help="How the training crops are sampled: the 4 corners, a strided grid or random windows",
+    )
+    parser.add_argument(
+        "--resident",
+        type=str,
+        choices=["device", "shared"],
+        help="Keep the whole training and validation splits as uint8 tensors on the device or in shared memory",
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        choices=PRECISIONS,
+        default="fp32",
+        help="Precision of the forward pass: fp32, or bf16/fp16 autocast (with gradient scaling in fp16)",
+    )
+    parser.add_argument(
+        "--channels-last",
+        action="store_true",
+        default=False,
+        help="Train the model on batches in the channels-last (NHWC) memory format, for faster convolution kernels",
+    )
+    parser.add_argument(
+        "--accumulation-steps",
+        type=int,
+        default=1,
+        help="Number of batches whose gradients are accumulated before each optimizer step (effective batch size = accumulation steps * batch size)",
+    )
+    parser.add_argument(
+        "--keep-checkpoints",
+        type=int,
+        default=3,
+        help="Number of best checkpoints kept per run, besides the rolling last.pt",
+    )
+    parser.add_argument(
+        "--snapshot-interval",
+        type=int,
+        help="Number of optimizer steps between the snapshots of the full training state in last.pt, which --checkpoint_path resumes from at the exact step (default: end of each epoch only)",
+    )
+    parser.add_argument(
+        "--activation-checkpointing",
+        type=str,
+        choices=ENCODER_MODES,
+        help="Recompute the activations of each Swin stage, or of every --checkpoint-every transformer blocks, in the backward pass (Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--checkpoint-every",
+        type=int,
+        default=1,
+        help="Number of transformer blocks per checkpointed segment with --activation-checkpointing blocks",
+    )
+    parser.add_argument(
+        "--checkpoint-decoder",
+        action="store_true",
+        default=False,
+        help="Recompute the activations of each decoder block in the backward pass (Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--freeze-encoder",
+        action="store_true",
+        default=False,
+        help="Only train the tail, decoder and head, the Swin encoder being frozen (Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--feature-cache-dir",
+        type=str,
+        help="Freeze the encoder, and cache its features on every training crop once in this directory to train the decoder on them (Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--resolution-schedule",
+        type=str,
+        nargs="+",
+        metavar="SIZE:BATCH_SIZE:EPOCHS",
+        help="Progressive-resolution training stages, e.g. 208:16:10 304:8:10 400:4 (the last stage lasts until the end), overriding --batch_size for training (Swin-UNet and UNet only)",
+    )
+    parser.add_argument(
+        "--max-steps",
+        type=int,
+        help="Maximum number of optimizer steps, training stops at whichever of --n_epochs and --max-steps comes first",
+    )
+    parser.add_argument(
+        "--val-interval",
+        type=int,
+        help="Number of optimizer steps between the validations (default: end of each epoch)",
+    )
+    parser.add_argument(
+        "--val-subset",
+        type=int,
+        help="Number of samples of a fixed subset of the validation set to validate on (default: all of it)",
+    )
+    parser.add_argument(
+        "--val-mode",
+        type=str,
+        choices=VAL_MODES,
+        default="augmented",
+        help="Validate on the augmented validation set, or on its non-augmented crops kept on the device (fixed), predicted with D4 test-time augmentation (tta) (UNet and Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--val-batch-size",
+        type=int,
+        help="Batch size of the validation (default: --batch_size)",
+    )
+    parser.add_argument(
+        "--patience",
+        type=int,
+        help="Number of validations without a better validation metric after which training stops early",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Log the time of each phase of the training steps (data wait, host to device copy, forward, loss, backward, optimizer step, metrics) to tensorboard, syncing the device around each phase",
+    )
+    parser.add_argument(
+        "--trace-steps",
+        type=int,
+        nargs=2,
+        metavar=("START", "END"),
+        help="Trace the optimizer steps START + 1 to END with torch.profiler and export a Chrome trace to the traces directory of the model",
+    )
+    parser.add_argument(
+        "--lr",
+        type=float,
+        default=1e-3,
+        help="Learning rate of Adam (UNet and Swin-UNet only)",
+    )
+    parser.add_argument(
+        "--crop-size",
+        type=int,
+        help="Size of the training and validation crops (default: 208 for Swin-UNet, 384 for UNet)",
+    )
+    parser.add_argument(
+        "--sweep-space",
+        type=str,
+        help="JSON file of the search space of a sweep, mapping arguments (e.g. model, loss, lr, crop_size) to lists of values, see sweep.py",
+    )
+    parser.add_argument(
+        "--sweep-dir",
+        type=str,
+        default="sweeps/sweep",
+        help="Directory of the results of the trials of a sweep, which is resumed if it already exists",
+    )
+    parser.add_argument(
+        "--sweep-trials",
+        type=int,
+        help="Number of trials drawn from the search space (default: all of its grid)",
+    )
+    parser.add_argument(
+        "--sweep-workers",
+        type=int,
+        default=2,
+        help="Number of trials run concurrently",
+    )
+    parser.add_argument(
+        "--threads-per-trial",
+        type=int,
+        default=max(1, (os.cpu_count() or 1) // 2),
+        help="Number of CPU threads of each trial",
+    )
+    parser.add_argument(
+        "--sweep-metric",
+        type=str,
+        help="Validation metric maximized by the sweep (default: the best metric of the model, e.g. val_patch_f1_score)",
+    )
+    parser.add_argument(
+        "--pruner",
+        type=str,
+        choices=PRUNERS,
+        default="asha",
+        help="Stop the weak trials early by asynchronous successive halving (asha), or never (none)",
+    )
+    parser.add_argument(
+        "--min-validations",
+        type=int,
+        default=1,
+        help="Number of validations before a trial can first be pruned",
+    )
+    parser.add_argument(
+        "--reduction-factor",
+        type=int,
+        default=3,
+        help="Only the best 1 / reduction factor of the trials go on at each rung of the successive halving",
+    )
+    parser.add_argument(
+        "--compile",
+        type=str,
+        choices=COMPILE_MODES,
+        help="Run the training steps and the test predictions through TorchScript traces or torch.compile graphs of the model, checked against the eager outputs",
+    )
 
-    args = parser.parse_args()
-    log(vars(args))
+    parser.add_argument(
+        "--dist-backend",
+        type=str,
+        choices=BACKENDS,
+        help="Backend of the process group when launched with torchrun (default: nccl on GPU, gloo on CPU)",
+    )
+    return parser
 
+
+def run_model(args):
+    # trains args.model (parsed by make_parser) and predicts on the test set
     device = get_best_available_device()
     log(f"PyTorch will use device: {device}")
     if device == "cuda":
@@ -107,6 +374,7 @@ if __name__ == "__main__":
             train_path=args.train_dir,
             val_path=args.val_dir,
             test_path=args.test_dir,
+            as_uint8=args.uint8_storage,
         )
 
     elif args.model == "baseline-patch-cnn":
@@ -118,6 +386,22 @@ if __name__ == "__main__":
             n_epochs=args.n_epochs,
             batch_size=args.batch_size,
             checkpoint_path=args.checkpoint_path,
+            num_workers=args.num_workers,
+            prefetch_factor=args.prefetch_factor,
+            persistent_workers=args.persistent_workers,
+            as_uint8=args.uint8_storage,
+            precision=args.precision,
+            accumulation_steps=args.accumulation_steps,
+            keep_checkpoints=args.keep_checkpoints,
+            snapshot_interval=args.snapshot_interval,
+            compile_mode=args.compile,
+            max_steps=args.max_steps,
+            val_interval=args.val_interval,
+            val_subset=args.val_subset,
+            patience=args.patience,
+            profile=args.profile,
+            trace_steps=args.trace_steps,
+            channels_last=args.channels_last,
         )
 
     elif args.model == "baseline-unet":
@@ -128,6 +412,22 @@ if __name__ == "__main__":
             test_path=args.test_dir,
             checkpoint_path=args.checkpoint_path,
             model_save_dir=args.model_save_dir,
+            num_workers=args.num_workers,
+            prefetch_factor=args.prefetch_factor,
+            persistent_workers=args.persistent_workers,
+            as_uint8=args.uint8_storage,
+            precision=args.precision,
+            accumulation_steps=args.accumulation_steps,
+            keep_checkpoints=args.keep_checkpoints,
+            snapshot_interval=args.snapshot_interval,
+            compile_mode=args.compile,
+            max_steps=args.max_steps,
+            val_interval=args.val_interval,
+            val_subset=args.val_subset,
+            patience=args.patience,
+            profile=args.profile,
+            trace_steps=args.trace_steps,
+            channels_last=args.channels_last,
         )
 
     elif args.model == "unet":
@@ -142,6 +442,32 @@ if __name__ == "__main__":
             augment=args.no_augment,
             model_save_dir=args.model_save_dir,
             loss=args.loss,
+            tile_cache_dir=args.tile_cache_dir,
+            batch_augment=args.batch_augment,
+            num_workers=args.num_workers,
+            prefetch_factor=args.prefetch_factor,
+            persistent_workers=args.persistent_workers,
+            as_uint8=args.uint8_storage,
+            precision=args.precision,
+            accumulation_steps=args.accumulation_steps,
+            keep_checkpoints=args.keep_checkpoints,
+            snapshot_interval=args.snapshot_interval,
+            compile_mode=args.compile,
+            max_steps=args.max_steps,
+            val_interval=args.val_interval,
+            val_subset=args.val_subset,
+            patience=args.patience,
+            profile=args.profile,
+            trace_steps=args.trace_steps,
+            channels_last=args.channels_last,
+            lr=args.lr,
+            crop_size=args.crop_size,
+            val_mode=args.val_mode,
+            val_batch_size=args.val_batch_size,
+            resolution_schedule=args.resolution_schedule,
+            crops_per_image=args.crops_per_image,
+            crop_mode=args.crop_mode,
+            resident=args.resident,
         )
 
     elif args.model == "swin-unet":
@@ -156,7 +482,53 @@ if __name__ == "__main__":
             model_type=args.model_type,
             loss=args.loss,
             model_save_dir=args.model_save_dir,
+            tile_cache_dir=args.tile_cache_dir,
+            batch_augment=args.batch_augment,
+            num_workers=args.num_workers,
+            prefetch_factor=args.prefetch_factor,
+            persistent_workers=args.persistent_workers,
+            as_uint8=args.uint8_storage,
+            precision=args.precision,
+            accumulation_steps=args.accumulation_steps,
+            keep_checkpoints=args.keep_checkpoints,
+            snapshot_interval=args.snapshot_interval,
+            compile_mode=args.compile,
+            max_steps=args.max_steps,
+            val_interval=args.val_interval,
+            val_subset=args.val_subset,
+            patience=args.patience,
+            profile=args.profile,
+            trace_steps=args.trace_steps,
+            channels_last=args.channels_last,
+            lr=args.lr,
+            crop_size=args.crop_size,
+            val_mode=args.val_mode,
+            val_batch_size=args.val_batch_size,
+            train_shards=args.train_shards,
+            activation_checkpointing=args.activation_checkpointing,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_decoder=args.checkpoint_decoder,
+            freeze_encoder=args.freeze_encoder,
+            feature_cache_dir=args.feature_cache_dir,
+            resolution_schedule=args.resolution_schedule,
+            crops_per_image=args.crops_per_image,
+            crop_mode=args.crop_mode,
+            resident=args.resident,
         )
 
     else:
         raise NotImplementedError("Not implemented yet")
+
+
+if __name__ == "__main__":
+    args = make_parser().parse_args()
+    log(vars(args))
+    set_io_workers(args.io_workers, args.io_executor)
+    if args.model == "sweep":
+        # the trials run in a pool of processes, see sweep.py
+        run_sweep(args)
+    else:
+        # DDP training when launched with torchrun, see distributed.py
+        init_distributed(args.dist_backend)
+        run_model(args)
+        cleanup_distributed()
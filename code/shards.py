@@ -0,0 +1,365 @@
+import torchvision.transforms.functional as TF
+import numpy as np
+import torch
+import json
+import os
+from utils import log
+from crops import CropSampler, crop_batch
+from manifest import build_manifest, manifest_files, load_images
+
+"""
+Streaming dataset over sharded tile archives, to train on far more tiles than fit in memory
+without opening and stat-ing every PNG.
+A split is first packed into uncompressed .npz shards of uint8 tiles (see create_shards.py), with an
+index.json listing the shards. ShardedTileDataset then reads the shards sequentially:
+- the shard order is shuffled every epoch and the shards are split across DDP ranks, then across the
+  DataLoader workers of each rank, every rank yielding as many batches as the rank with the fewest
+  (see n_batches), so that they all run as many steps
+- samples are shuffled inside a buffer
+- an epoch can be resumed after any batch of a DataLoader over the dataset (see state_dict), the
+  samples it already yielded being replayed without reading their tiles
+- all the crops of a tile are gathered at once, right after it is read
+"""
+
+SHARDS_INDEX = "index.json"
+
+
+def write_shards(path: str, out_dir: str, shard_size: int = 1024):
+    # packs the images and masks of the split in `path` into shards of shard_size tiles
+    entries = build_manifest(path)
+    images, masks = manifest_files(path, entries)
+    if masks[0] is None:
+        raise ValueError(f"{path} has no groundtruth to pack with the images")
+    os.makedirs(out_dir, exist_ok=True)
+
+    shards = []
+    for start in range(0, len(entries), shard_size):
+        stop = min(start + shard_size, len(entries))
+        file = f"shard_{len(shards):05d}.npz"
+        tmp_path = os.path.join(out_dir, f"{file}.{os.getpid()}.tmp.npz")
+        np.savez(
+            tmp_path,
+            images=load_images(images[start:stop], transform=lambda img: img[:, :, :3]),
+            masks=load_images(masks[start:stop]),
+            ids=np.array([e["id"] for e in entries[start:stop]]),
+        )
+        os.replace(tmp_path, os.path.join(out_dir, file))
+        shards.append({"file": file, "n_samples": stop - start})
+        log(f"Wrote {file} ({stop - start} tiles)")
+
+    with open(os.path.join(out_dir, SHARDS_INDEX), "w") as f:
+        json.dump({"source": os.path.abspath(path), "shards": shards}, f)
+    return shards
+
+
+class ShardedTileDataset(torch.utils.data.IterableDataset):
+    def __init__(
+        self,
+        shard_dir: str,
+        shuffle: bool = True,
+        buffer_size: int = 512,
+        seed: int = 0,
+        crop: bool = False,
+        crop_size: int = 208,
+        resize_to=None,
+        as_uint8: bool = False,
+        crops_per_image: int = None,
+        crop_mode: str = "corners",
+        rank: int = None,
+        world_size: int = None,
+    ):
+        super().__init__()
+        with open(os.path.join(shard_dir, SHARDS_INDEX)) as f:
+            self.shards = json.load(f)["shards"]
+        self.shard_dir = shard_dir
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.crop = crop
+        self.crop_sampler = (
+            CropSampler(crop_size, crops_per_image, crop_mode, seed) if crop else None
+        )
+        self.resize_to = resize_to
+        self.as_uint8 = as_uint8
+        # defaults to the DDP process group, if any
+        distributed = torch.distributed.is_available() and (
+            torch.distributed.is_initialized()
+        )
+        self.rank = (
+            rank
+            if rank is not None
+            else (torch.distributed.get_rank() if distributed else 0)
+        )
+        self.world_size = world_size or (
+            torch.distributed.get_world_size() if distributed else 1
+        )
+        assert (
+            len(self.shards) >= self.world_size
+        ), f"{len(self.shards)} shards cannot be split across {self.world_size} processes"
+        # (epoch, batches, batch_size, drop_last) of the batches of the epoch already yielded by a DataLoader
+        # (see load_state_dict), in shared memory so that it also reaches persistent DataLoader workers
+        self._cursor = torch.zeros(4, dtype=torch.int64).share_memory_()
+        self.n_crops = len(self.crop_sampler) if crop else 1
+        # global index of the first tile of each shard, to seed the crops of each tile
+        self.shard_starts = np.cumsum([0] + [s["n_samples"] for s in self.shards])
+
+        log(
+            f"Streaming {len(self.shards)} shards from {shard_dir} ({len(self)} samples per rank)"
+        )
+
+    def __len__(self):
+        # samples the rank yields in a whole epoch
+        return sum(self._worker_samples(1))
+
+    def n_batches(self, batch_size: int, n_workers: int = 0, drop_last: bool = False):
+        """
+        Batches of a DataLoader over the dataset, in which every worker yields its own last (partial) batch,
+        in the current epoch from the cursor on.
+        The ranks being given shards of different sizes, the DataLoader of every rank stops after the batches
+        of the rank with the fewest, the last batches of the others being left out of the epoch.
+        """
+        n_batches = min(
+            sum(self._worker_batches(batch_size, n_workers, drop_last, rank))
+            for rank in range(self.world_size)
+        )
+        return max(n_batches - self.resumed_batches, 0)
+
+    def _worker_samples(self, n_workers: int, rank: int = None):
+        # samples each DataLoader worker of the rank (default: this one) yields in a whole epoch
+        order = self._shard_order()
+        positions = self._rank_positions(rank)
+        n_workers = max(n_workers, 1)
+        return [
+            self.n_crops
+            * sum(
+                self.shards[order[pos]]["n_samples"] for pos in positions[w::n_workers]
+            )
+            for w in range(n_workers)
+        ]
+
+    def _worker_batches(
+        self, batch_size: int, n_workers: int, drop_last: bool, rank: int = None
+    ):
+        counts = self._worker_samples(n_workers, rank)
+        if drop_last:
+            return [n // batch_size for n in counts]
+        return [-(-n // batch_size) for n in counts]
+
+    @property
+    def epoch(self):
+        return int(self._cursor[0])
+
+    @property
+    def resumed_batches(self):
+        # batches of the epoch yielded before it was resumed
+        return int(self._cursor[1])
+
+    def set_epoch(self, epoch: int):
+        if epoch != self.epoch:
+            # a cursor is only valid for the epoch it was saved in
+            self._cursor.zero_()
+            self._cursor[0] = epoch
+        if self.crop:
+            self.crop_sampler.set_epoch(epoch)
+
+    def set_size(self, crop_size: int = None, resize_to=None):
+        # see OptimizedImageDataset.set_size
+        if crop_size is not None:
+            assert self.crop, "Only the crops of a cropped dataset can be resized"
+            self.crop_sampler.size = crop_size
+        if resize_to is not None:
+            self.resize_to = resize_to
+
+    def state_dict(
+        self, n_batches: int, batch_size: int, n_workers: int, drop_last: bool = False
+    ):
+        # position after the first n_batches batches of the epoch of a DataLoader over the dataset
+        return {
+            "epoch": self.epoch,
+            "batches": n_batches,
+            "batch_size": batch_size,
+            "n_workers": max(n_workers, 1),
+            "drop_last": drop_last,
+            "world_size": self.world_size,
+        }
+
+    def load_state_dict(self, state, n_workers: int):
+        assert (state["n_workers"], state["world_size"]) == (
+            max(n_workers, 1),
+            self.world_size,
+        ), f"The stream can only be resumed with {state['n_workers']} DataLoader workers in each of {state['world_size']} processes"
+        self._cursor.copy_(
+            torch.tensor(
+                [
+                    state["epoch"],
+                    state["batches"],
+                    state["batch_size"],
+                    int(state["drop_last"]),
+                ]
+            )
+        )
+        if self.crop:
+            self.crop_sampler.set_epoch(state["epoch"])
+
+    def _shard_order(self):
+        # same order on every rank and worker
+        if not self.shuffle:
+            return np.arange(len(self.shards))
+        return np.random.default_rng((self.seed, self.epoch)).permutation(
+            len(self.shards)
+        )
+
+    def _sample_order(self, shard: int):
+        # samples of a shard are read in a random (but reproducible) order
+        n_samples = self.shards[shard]["n_samples"]
+        if not self.shuffle:
+            return np.arange(n_samples)
+        return np.random.default_rng((self.seed, self.epoch, shard)).permutation(
+            n_samples
+        )
+
+    def _rank_positions(self, rank: int = None):
+        # positions (in the shard order) of the shards of the rank, whatever its number of workers
+        rank = self.rank if rank is None else rank
+        return list(range(len(self.shards)))[rank :: self.world_size]
+
+    def _resumed_workers(self, n_workers: int):
+        """
+        Batches of the epoch already yielded by each worker, and the worker of the next batch, replaying the
+        DataLoader, which takes the batches of its workers in turn (skipping the exhausted ones).
+        """
+        consumed, worker = [0] * n_workers, 0
+        batches = self.resumed_batches
+        if batches == 0:
+            return consumed, worker
+        counts = self._worker_batches(
+            int(self._cursor[2]), n_workers, bool(self._cursor[3])
+        )
+        batches = min(batches, sum(counts))
+        while batches > 0:
+            if consumed[worker] < counts[worker]:
+                consumed[worker] += 1
+                batches -= 1
+            worker = (worker + 1) % n_workers
+        return consumed, worker
+
+    def _worker_stream(self):
+        # (global worker, positions of its shards, samples it already yielded) of the current worker
+        info = torch.utils.data.get_worker_info()
+        worker_id, n_workers = (info.id, info.num_workers) if info else (0, 1)
+        consumed, first = self._resumed_workers(n_workers)
+        # a resumed DataLoader starts with its first worker, which continues the stream of the worker
+        # that the interrupted one would have taken the next batch from
+        worker = (first + worker_id) % n_workers
+        positions = self._rank_positions()
+        if len(positions) < n_workers:
+            log(
+                f"WARNING: {len(positions)} shards for {n_workers} workers, some workers will be idle"
+            )
+        return (
+            self.rank * n_workers + worker,
+            positions[worker::n_workers],
+            consumed[worker] * int(self._cursor[2]),
+        )
+
+    def _to_tensor(self, array):
+        tensor = torch.from_numpy(np.ascontiguousarray(array))
+        if not self.as_uint8:
+            tensor = tensor.float() / 255.0
+        return tensor
+
+    def _keys(self, positions):
+        # (position, offset, crop) of the samples of the shards at positions, in reading order
+        order = self._shard_order()
+        for pos in positions:
+            for offset in range(self.shards[order[pos]]["n_samples"]):
+                for j in range(self.n_crops):
+                    yield pos, offset, j
+
+    def _tile(self, images, masks, shard: int, i: int):
+        # the (x, y) samples of the crops of the i-th tile of a shard
+        image = np.moveaxis(images[i], -1, 0)[None]
+        mask = masks[i][None, None]
+        if self.crop:
+            h, w = mask.shape[-2:]
+            tile_index = self.shard_starts[shard] + i
+            crops = self.crop_sampler.positions_table(h, w, self.shard_starts[-1])[
+                [tile_index]
+            ]
+            image = crop_batch(image, crops, self.crop_sampler.size)
+            mask = crop_batch(mask, crops, self.crop_sampler.size)
+        image, mask = self._to_tensor(image), self._to_tensor(mask)
+        if self.resize_to:
+            image = TF.resize(image, self.resize_to)
+            mask = TF.resize(mask, self.resize_to)
+        return list(zip(image, mask))
+
+    def __iter__(self):
+        """
+        The shuffle buffer holds the keys (position, offset, crop) of the samples, whose tiles are read when
+        they enter it. When resuming, the samples already yielded are only replayed as keys: the tiles are
+        then read from the point the stream resumes at, the ones still in the buffer being read again.
+        """
+        global_worker, positions, skip = self._worker_stream()
+        rng = np.random.default_rng((self.seed, self.epoch, global_worker))
+        reader = _TileReader(self)
+        buffer = []
+        for key in self._keys(positions):
+            if skip == 0:
+                reader.read(key)
+            if not self.shuffle:
+                key, skip = self._emit(key, skip, buffer, reader)
+            elif len(buffer) < self.buffer_size:
+                buffer.append(key)
+                continue
+            else:
+                # replaces a random key of the buffer by the new one
+                i = rng.integers(len(buffer))
+                buffer[i], key = key, buffer[i]
+                key, skip = self._emit(key, skip, buffer, reader)
+            if key is not None:
+                yield reader.samples.pop(key)
+        rng.shuffle(buffer)
+        for i, key in enumerate(buffer):
+            key, skip = self._emit(key, skip, buffer[i + 1 :], reader)
+            if key is not None:
+                yield reader.samples.pop(key)
+
+    @staticmethod
+    def _emit(key, skip, buffer, reader):
+        # (key to yield or None if it is skipped, samples left to skip)
+        if skip == 0:
+            return key, 0
+        if skip == 1:
+            # the stream resumes after this key: the samples still in the buffer are read again
+            for k in sorted(buffer):
+                reader.read(k)
+        return None, skip - 1
+
+
+class _TileReader:
+    # reads the samples of a ShardedTileDataset, keeping the last shard and the crops of the last tile
+    def __init__(self, dataset: ShardedTileDataset):
+        self.dataset = dataset
+        self.order = dataset._shard_order()
+        self.samples = {}  # samples read but not yet yielded, by key
+        self.pos = None
+        self.tile_key = None
+
+    def read(self, key):
+        pos, offset, j = key
+        if self.tile_key != (pos, offset):
+            shard = int(self.order[pos])
+            if self.pos != pos:
+                path = os.path.join(
+                    self.dataset.shard_dir, self.dataset.shards[shard]["file"]
+                )
+                with np.load(path) as f:
+                    self.images, self.masks = f["images"], f["masks"]
+                self.sample_order = self.dataset._sample_order(shard)
+                self.pos = pos
+            self.tile = self.dataset._tile(
+                self.images, self.masks, shard, self.sample_order[offset]
+            )
+            self.tile_key = (pos, offset)
+        self.samples[key] = self.tile[j]
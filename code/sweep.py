@@ -0,0 +1,269 @@
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+import torch
+from utils import log
+
+"""
+Hyperparameter sweeps: a search space is expanded into trials, which run concurrently in a pool of processes
+(each one capped to threads_per_trial threads) with the arguments of run.py plus the parameters of the trial.
+The search space is a JSON file mapping arguments of run.py (by their dest, e.g. "model", "loss", "lr",
+"crop_size", "model_type") to lists of values, e.g.
+    {"model": ["swin-unet"], "loss": ["focal", "patch-f1"], "lr": [1e-4, 3e-4, 1e-3]}
+Its grid is run entirely, or n_trials combinations drawn from it (always the same ones).
+
+Weak trials are stopped early by asynchronous successive halving (ASHA): after min_validations *
+reduction_factor**r validations (the rung r), a trial only goes on if its metric is among the best
+1 / reduction_factor of the values reported at that rung by all the trials so far. The metric is maximized.
+
+Each trial has its own directory in sweep_dir, with its record (params, status, validation history and rungs)
+in trial.json, which is the results store, and its checkpoints. A sweep started again skips the trials that
+are done (complete, pruned or failed) and resumes the interrupted ones from their last.pt snapshot.
+"""
+
+PRUNERS = ["asha", "none"]
+RECORD_FILE = "trial.json"
+
+
+class TrialPruned(Exception):
+    # raised by train() when the active Trial is pruned
+    pass
+
+
+def trial_id(params: dict) -> str:
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:10]
+
+
+def expand_space(space: dict, n_trials: int = None, seed: int = 0):
+    # the parameters of the trials: the whole grid of space, or n_trials combinations drawn from it
+    keys = sorted(space)
+    grid = [
+        dict(zip(keys, values))
+        for values in itertools.product(*(space[k] for k in keys))
+    ]
+    if n_trials is not None and n_trials < len(grid):
+        grid = random.Random(seed).sample(grid, n_trials)
+    return grid
+
+
+class ResultsStore:
+    # one record per trial, each one only written by its own trial (atomically)
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def trial_dir(self, trial: str) -> str:
+        return os.path.join(self.directory, trial)
+
+    def load(self, trial: str):
+        try:
+            with open(os.path.join(self.trial_dir(trial), RECORD_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, record: dict):
+        path = os.path.join(self.trial_dir(record["id"]), RECORD_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f, indent=2)
+        os.replace(tmp_path, path)
+
+    def records(self):
+        paths = glob(os.path.join(self.directory, "*", RECORD_FILE))
+        records = [self.load(os.path.basename(os.path.dirname(p))) for p in paths]
+        return [r for r in records if r is not None]
+
+
+class Trial:
+    """
+    The trial run by the current process: train() reports every validation to Trial.current (if any),
+    which records it and tells whether the trial is pruned.
+    """
+
+    current = None
+
+    def __init__(
+        self,
+        store: ResultsStore,
+        record: dict,
+        metric: str = None,
+        pruner: str = "asha",
+        min_validations: int = 1,
+        reduction_factor: int = 3,
+    ):
+        assert pruner in PRUNERS, f"Unknown pruner {pruner}"
+        self.store = store
+        self.record = record
+        self.metric = metric
+        self.pruner = pruner
+        self.min_validations = min_validations
+        self.reduction_factor = reduction_factor
+
+    def __enter__(self):
+        self.previous, Trial.current = Trial.current, self
+        return self
+
+    def __exit__(self, *args):
+        Trial.current = self.previous
+
+    @property
+    def directory(self) -> str:
+        # checkpoints, tensorboard logs and plots of the trial
+        return self.store.trial_dir(self.record["id"])
+
+    def _rung(self, n_validations: int):
+        # r if n_validations is the budget of the rung r, None otherwise
+        budget, rung = self.min_validations, 0
+        while budget < n_validations:
+            budget, rung = budget * self.reduction_factor, rung + 1
+        return rung if budget == n_validations else None
+
+    def report(self, key, metrics: dict, default_metric: str) -> bool:
+        """
+        Records the metrics of the validation `key` (epoch or step), default_metric being used if the trial
+        has no metric of its own. Returns whether the trial is pruned.
+        """
+        metric = self.metric or default_metric
+        value = metrics[metric]
+        # a resumed trial reports the validations after its snapshot again
+        self.record["history"][str(key)] = value
+        self.record["metric"] = metric
+        self.record["best"] = max(self.record["history"].values())
+        rung = self._rung(len(self.record["history"]))
+        pruned = False
+        if rung is not None and self.pruner == "asha":
+            self.record["rungs"][str(rung)] = value
+            values = [
+                r["rungs"][str(rung)]
+                for r in self.store.records()
+                if str(rung) in r["rungs"] and r["id"] != self.record["id"]
+            ] + [value]
+            top_k = max(1, len(values) // self.reduction_factor)
+            pruned = value < sorted(values, reverse=True)[top_k - 1]
+            if pruned:
+                log(
+                    f"Trial {self.record['id']} pruned at rung {rung}: {metric} = {value:.4f} is not in the top {top_k} of {len(values)}"
+                )
+        self.store.save(self.record)
+        return pruned
+
+
+def _last_snapshot(trial_dir: str):
+    # the latest last.pt of an interrupted trial (checkpoints/<model>/<run id>/), None if it has none
+    snapshots = glob(os.path.join(trial_dir, "checkpoints", "*", "*", "last.pt"))
+    return max(snapshots, key=os.path.getmtime) if snapshots else None
+
+
+def _run_trial(args: dict, params: dict, threads: int, pruning: dict):
+    # runs in a process of the pool, returns the final record of the trial
+    from run import run_model
+    from manifest import set_io_workers
+
+    torch.set_num_threads(threads)
+    set_io_workers(threads, args["io_executor"])
+    store = ResultsStore(args["sweep_dir"])
+    trial = trial_id(params)
+    record = store.load(trial) or {
+        "id": trial,
+        "params": params,
+        "history": {},
+        "rungs": {},
+        "best": None,
+    }
+    record["status"] = "running"
+    store.save(record)
+
+    trial_args = argparse.Namespace(**{**args, **params})
+    trial_args.model_save_dir = store.trial_dir(trial)
+    snapshot = _last_snapshot(trial_args.model_save_dir)
+    if snapshot:
+        log(f"Resuming trial {trial} from {snapshot}")
+        trial_args.checkpoint_path = snapshot
+    try:
+        with Trial(store, record, **pruning):
+            run_model(trial_args)
+        record["status"] = "complete"
+    except TrialPruned:
+        record["status"] = "pruned"
+    except Exception as e:
+        log(f"Trial {trial} failed: {e!r}")
+        record["status"] = "failed"
+        record["error"] = repr(e)
+    store.save(record)
+    return record
+
+
+def run_sweep(args):
+    """
+    Runs the trials of the search space args.sweep_space with the other arguments of args (see run.py),
+    sweep_workers at a time, and logs their results sorted by their best metric.
+    """
+    with open(args.sweep_space) as f:
+        space = json.load(f)
+    unknown = set(space) - set(vars(args))
+    assert not unknown, f"Unknown arguments in the search space: {sorted(unknown)}"
+    assert "model" in space, "The search space needs the models to train"
+    trials = expand_space(space, args.sweep_trials)
+    store = ResultsStore(args.sweep_dir)
+    done = {"complete", "pruned", "failed"}
+    todo = [
+        p for p in trials if (store.load(trial_id(p)) or {}).get("status") not in done
+    ]
+    log(
+        f"Sweep of {len(trials)} trials in {args.sweep_dir}, {len(trials) - len(todo)} already done, {args.sweep_workers} at a time"
+    )
+
+    base_args = {**vars(args), "checkpoint_path": None}
+    pruning = dict(
+        metric=args.sweep_metric,
+        pruner=args.pruner,
+        min_validations=args.min_validations,
+        reduction_factor=args.reduction_factor,
+    )
+    # the thread caps are inherited by the (spawned) trial processes before torch is loaded
+    for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS"]:
+        os.environ[var] = str(args.threads_per_trial)
+    ctx = mp.get_context("spawn")
+    try:
+        # a fresh process per trial, so that no state leaks from one trial to the next
+        executor = ProcessPoolExecutor(
+            args.sweep_workers, mp_context=ctx, max_tasks_per_child=1
+        )
+    except TypeError:  # Python < 3.11
+        executor = ProcessPoolExecutor(args.sweep_workers, mp_context=ctx)
+    with executor:
+        futures = [
+            executor.submit(
+                _run_trial, base_args, params, args.threads_per_trial, pruning
+            )
+            for params in todo
+        ]
+        for future in as_completed(futures):
+            try:
+                record = future.result()
+            except Exception as e:  # e.g. a trial process killed by the OOM killer
+                log(f"WARNING: a trial process died: {e!r}")
+                continue
+            log(f"Trial {record['id']} {record['status']} (best {record['best']})")
+
+    records = [r for r in (store.load(trial_id(p)) for p in trials) if r is not None]
+    records.sort(
+        key=lambda r: -float("inf") if r["best"] is None else r["best"], reverse=True
+    )
+    with open(os.path.join(args.sweep_dir, "summary.json"), "w") as f:
+        json.dump(records, f, indent=2)
+    log(f"{'trial':<12}{'status':<10}{'best':>8}{'validations':>13}  params")
+    for r in records:
+        best = f"{r['best']:.4f}" if r["best"] is not None else "-"
+        log(
+            f"{r['id']:<12}{r['status']:<10}{best:>8}{len(r['history']):>13}  {r['params']}"
+        )
+    return records
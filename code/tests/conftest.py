@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of code/ are imported by their name, as when running code/run.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
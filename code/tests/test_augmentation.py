@@ -0,0 +1,66 @@
+import types
+import pytest
+import torch
+from augmentation import (
+    N_D4,
+    SIX_TO_D4,
+    apply_batch_transforms,
+    batch_d4_transform,
+    d4_inverse,
+    d4_transform,
+    six_to_d4,
+)
+from dataset import OptimizedImageDataset
+from memory_format import is_channels_last
+
+"""
+The batched transforms against the per-sample transforms of the datasets that they replace.
+"""
+
+
+def _dataset_transform(image, mask, mode):
+    # OptimizedImageDataset.transform, without a dataset
+    dataset = types.SimpleNamespace(N_TRANSFORMS=6, verbose=False)
+    return OptimizedImageDataset.transform(dataset, image, mask, mode)
+
+
+def _batch(b=5, size=8):
+    generator = torch.Generator().manual_seed(0)
+    x = torch.rand(b, 3, size, size, generator=generator)
+    y = (torch.rand(b, 1, size, size, generator=generator) > 0.5).float()
+    return x, y
+
+
+@pytest.mark.parametrize("mode", range(5))
+def test_six_to_d4_matches_dataset_transforms(mode):
+    x, y = _batch()
+    ks, crop = six_to_d4(torch.full((len(x),), mode))
+    assert not crop.any()
+    x_t, y_t = apply_batch_transforms(x, y, ks, crop)
+    for i in range(len(x)):
+        image, mask = _dataset_transform(x[i], y[i], mode)
+        assert torch.equal(x_t[i], image)
+        assert torch.equal(y_t[i], mask)
+
+
+def test_random_crop_mode():
+    ks, crop = six_to_d4(torch.arange(6))
+    assert crop.tolist() == [False] * 5 + [True]
+    assert ks.tolist() == SIX_TO_D4
+
+
+def test_batch_d4_transform_matches_d4_transform():
+    x, _ = _batch(b=N_D4)
+    ks = torch.arange(N_D4)
+    out = batch_d4_transform(x, ks)
+    for k in range(N_D4):
+        assert torch.equal(out[k], d4_transform(x[k], k))
+        assert torch.equal(d4_inverse(d4_transform(x[k], k), k), x[k])
+
+
+def test_batch_d4_transform_keeps_channels_last():
+    x, _ = _batch(b=N_D4)
+    ks = torch.arange(N_D4)
+    out = batch_d4_transform(x.contiguous(memory_format=torch.channels_last), ks)
+    assert is_channels_last(out)
+    assert torch.equal(out, batch_d4_transform(x, ks))
@@ -0,0 +1,46 @@
+import torch
+import torch.nn.functional as F
+from metrics import StepStats
+from models.losses.bce_loss import SafeBCELoss, binary_cross_entropy
+from models.losses.focal_loss import FocalLoss
+from precision import Float32Sigmoid
+
+"""
+The binary cross-entropy of the outputs of a training step, computed on their logits.
+"""
+
+
+def _outputs(saturated=False):
+    generator = torch.Generator().manual_seed(0)
+    logits = torch.randn(2, 1, 8, 8, generator=generator) * (40 if saturated else 3)
+    y = (torch.rand(2, 1, 8, 8, generator=generator) > 0.5).float()
+    return logits.requires_grad_(), y
+
+
+def test_bce_of_a_step_is_computed_on_the_logits():
+    logits, y = _outputs()
+    y_hat = torch.sigmoid(logits)
+    expected = F.binary_cross_entropy_with_logits(logits, y)
+    with StepStats(y_hat, y, logits=logits):
+        assert torch.allclose(SafeBCELoss()(y_hat, y), expected)
+    # without the logits, on the clamped probabilities
+    assert torch.allclose(binary_cross_entropy(y_hat, y), expected, atol=1e-5)
+
+
+def test_saturated_outputs_have_a_gradient():
+    logits, y = _outputs(saturated=True)
+    y_hat = torch.sigmoid(logits)
+    with StepStats(y_hat, y, logits=logits):
+        FocalLoss()(y_hat, y).backward()
+    wrong = (logits > 0) != (y > 0)
+    assert (logits.grad[wrong] != 0).all()
+    logits.grad = None
+    binary_cross_entropy(torch.sigmoid(logits), y).backward()
+    assert (logits.grad[wrong] == 0).any()
+
+
+def test_float32_sigmoid_outputs_logits_in_training():
+    x = torch.randn(4, dtype=torch.bfloat16)
+    layer = Float32Sigmoid()
+    assert torch.equal(layer.train()(x), x.float())
+    assert torch.equal(layer.eval()(x), torch.sigmoid(x.float()))
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import f1_score
+from consts import CUTOFF
+from metrics import F1, Accuracy, PatchAccuracy, PatchF1, StepStats
+
+"""
+The streaming metrics, accumulated over several batches, against the per-batch functions of utils.py
+(sklearn F1) that they replace, evaluated on the concatenated batches.
+"""
+
+
+def _patches(y_hat, y):
+    size = 16 if y_hat.shape[-1] > 250 else 8
+    h_patches, w_patches = y.shape[-2] // size, y.shape[-1] // size
+    pool = lambda x: x.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3))
+    return pool(y_hat) > CUTOFF, pool(y) > CUTOFF
+
+
+def accuracy_fn(y_hat, y):
+    return (y_hat.round() == y.round()).float().mean()
+
+
+def f1_score_fn(y_hat, y):
+    y_hat, y = (y_hat >= CUTOFF).float(), (y >= CUTOFF).float()
+    return f1_score(y_true=y.flatten().numpy(), y_pred=y_hat.flatten().numpy())
+
+
+def patch_accuracy_fn(y_hat, y):
+    patches_hat, patches = _patches(y_hat, y)
+    return (patches == patches_hat).float().mean()
+
+
+def patch_f1_score_fn(y_hat, y):
+    patches_hat, patches = _patches(y_hat, y)
+    return f1_score(
+        y_true=patches.flatten().numpy(), y_pred=patches_hat.flatten().numpy()
+    )
+
+
+def _batches(size, n_batches=3, batch_size=4, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(n_batches):
+        y_hat = torch.rand(batch_size, 1, size, size, generator=generator)
+        # blobs of road, so that the patch labels are not all equal
+        y = (
+            torch.rand(batch_size, 1, size // 8, size // 8, generator=generator) > 0.7
+        ).float()
+        y = y.repeat_interleave(8, -2).repeat_interleave(8, -1)
+        batches.append((y_hat, y))
+    return batches
+
+
+@pytest.mark.parametrize("size", [400, 208])
+@pytest.mark.parametrize(
+    "metric, reference",
+    [
+        (Accuracy, accuracy_fn),
+        (F1, f1_score_fn),
+        (PatchAccuracy, patch_accuracy_fn),
+        (PatchF1, patch_f1_score_fn),
+    ],
+)
+def test_streaming_metric_matches_reference(size, metric, reference):
+    batches = _batches(size)
+    streaming = metric()
+    for y_hat, y in batches:
+        # the shared reductions of a step must not change the values
+        with StepStats(y_hat, y):
+            streaming.update(y_hat, y)
+    y_hat = torch.cat([b[0] for b in batches])
+    y = torch.cat([b[1] for b in batches])
+    expected = float(reference(y_hat, y))
+    assert streaming.compute().dtype == torch.float64
+    assert float(streaming.compute()) == pytest.approx(expected, abs=1e-6)
+    # called as a function, on one batch
+    assert float(metric()(y_hat, y)) == pytest.approx(expected, abs=1e-6)
+
+
+def test_patch_f1_per_image():
+    y_hat, y = _batches(400, n_batches=1)[0]
+    expected = np.mean([patch_f1_score_fn(y_hat[[i]], y[[i]]) for i in range(len(y))])
+    assert float(PatchF1(per_image=True)(y_hat, y)) == pytest.approx(expected)
+
+
+def test_f1_without_positives_is_zero():
+    # as sklearn (with its warning)
+    zeros = torch.zeros(2, 1, 16, 16)
+    assert float(F1()(zeros, zeros)) == 0.0
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from consts import CUTOFF, PATCH_SIZE
+from patches import PatchIndex
+
+"""
+PatchIndex against the image_to_patches function of utils.py that it replaces.
+"""
+
+
+def image_to_patches(images, masks):
+    n_images = images.shape[0]
+    h, w = images.shape[1:3]
+    images = images[:, :, :, :3]
+    h_patches, w_patches = h // PATCH_SIZE, w // PATCH_SIZE
+    patches = images.reshape(
+        (n_images, h_patches, PATCH_SIZE, w_patches, PATCH_SIZE, -1)
+    )
+    patches = np.moveaxis(patches, 2, 3)
+    patches = patches.reshape(-1, PATCH_SIZE, PATCH_SIZE, 3)
+    masks = masks.reshape((n_images, h_patches, PATCH_SIZE, w_patches, PATCH_SIZE, -1))
+    masks = np.moveaxis(masks, 2, 3)
+    labels = np.mean(masks, (-1, -2, -3)) > CUTOFF
+    return patches, labels.reshape(-1).astype(np.float32)
+
+
+def _images(n=3, h=64, w=48):
+    rng = np.random.default_rng(0)
+    images = rng.random((n, h, w, 4), dtype=np.float32)
+    masks = (rng.random((n, h // 4, w // 4)) > 0.6).astype(np.float32)
+    masks = masks.repeat(4, 1).repeat(4, 2)
+    return images, masks
+
+
+def test_patch_order_and_labels():
+    images, masks = _images()
+    expected_patches, expected_labels = image_to_patches(images, masks)
+    index = PatchIndex(images, masks)
+    assert len(index) == len(expected_patches)
+    assert np.array_equal(index[: len(index)], expected_patches)
+    for i in [0, 1, 5, len(index) - 1]:
+        assert np.array_equal(index[i], expected_patches[i])
+    assert np.array_equal(index.labels, expected_labels)
+    assert np.array_equal(np.concatenate(list(index.batches(7))), expected_patches)
+
+
+def test_uint8_labels():
+    images, masks = _images()
+    _, expected_labels = image_to_patches(images, masks)
+    index = PatchIndex((images * 255).astype(np.uint8), (masks * 255).astype(np.uint8))
+    assert index.labels.dtype == bool
+    assert np.array_equal(index.labels, expected_labels.astype(bool))
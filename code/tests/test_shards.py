@@ -0,0 +1,125 @@
+import json
+import os
+import numpy as np
+import pytest
+import torch
+from loaders import make_dataloader
+from shards import SHARDS_INDEX, ShardedTileDataset
+
+"""
+The batches of ShardedTileDataset streams, through the DataLoader workers that split their shards.
+"""
+
+
+def _write_shards(shard_dir, n_tiles=10, shard_size=3, size=16):
+    # shards of tiles whose pixels depend on the tile and on their position, so that the crops differ
+    os.makedirs(shard_dir, exist_ok=True)
+    pixels = np.arange(n_tiles)[:, None, None] * 7 + np.arange(size * size).reshape(
+        size, size
+    )
+    pixels = (pixels % 256).astype(np.uint8)
+    shards = []
+    for start in range(0, n_tiles, shard_size):
+        stop = min(start + shard_size, n_tiles)
+        file = f"shard_{len(shards):05d}.npz"
+        np.savez(
+            os.path.join(shard_dir, file),
+            images=np.repeat(pixels[start:stop, :, :, None], 3, axis=-1),
+            masks=pixels[start:stop],
+            ids=np.arange(start, stop),
+        )
+        shards.append({"file": file, "n_samples": stop - start})
+    with open(os.path.join(shard_dir, SHARDS_INDEX), "w") as f:
+        json.dump({"source": shard_dir, "shards": shards}, f)
+    return shard_dir
+
+
+def _dataset(shard_dir, **kwargs):
+    kwargs = {
+        "crop": True,
+        "crop_size": 8,
+        "crops_per_image": 4,
+        "as_uint8": True,
+        **kwargs,
+    }
+    return ShardedTileDataset(shard_dir, **kwargs)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2, 3])
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_length_counts_the_batches_of_each_worker(tmp_path, num_workers, drop_last):
+    dataset = _dataset(_write_shards(str(tmp_path)))
+    loader = make_dataloader(
+        dataset,
+        batch_size=5,
+        device="cpu",
+        num_workers=num_workers,
+        drop_last=drop_last,
+    )
+    batches = list(loader)
+    assert len(loader) == len(batches)
+    if not drop_last:
+        assert sum(len(y) for _, y in batches) == len(dataset) == 40
+
+
+def _loader(dataset, num_workers, **kwargs):
+    return make_dataloader(
+        dataset, batch_size=3, device="cpu", num_workers=num_workers, **kwargs
+    )
+
+
+@pytest.mark.parametrize("num_workers", [0, 2, 3])
+def test_resumed_epoch_continues_the_batches(tmp_path, num_workers):
+    # a buffer smaller than a shard, so that samples of several shards are in it when resuming
+    shard_dir = _write_shards(str(tmp_path))
+    dataset = _dataset(shard_dir, buffer_size=5)
+    dataset.set_epoch(1)
+    batches = list(_loader(dataset, num_workers))
+    for n in range(len(batches) + 1):
+        state = dataset.state_dict(n, 3, num_workers)
+        resumed = _dataset(shard_dir, buffer_size=5)
+        resumed.set_epoch(1)
+        resumed.load_state_dict(state, num_workers)
+        loader = _loader(resumed, num_workers)
+        rest = list(loader)
+        assert len(loader) == len(rest) == len(batches) - n
+        for (x, y), (x_resumed, y_resumed) in zip(batches[n:], rest):
+            assert torch.equal(x, x_resumed) and torch.equal(y, y_resumed)
+
+
+def test_resuming_needs_as_many_workers(tmp_path):
+    dataset = _dataset(_write_shards(str(tmp_path)))
+    with pytest.raises(AssertionError):
+        dataset.load_state_dict(dataset.state_dict(2, 3, 2), 3)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_loader_resumes_the_stream(tmp_path, num_workers):
+    # the position saved and restored through the loader, as in train.py
+    shard_dir = _write_shards(str(tmp_path))
+    loader = _loader(_dataset(shard_dir), num_workers, drop_last=True)
+    assert loader.resumable
+    loader.set_epoch(2)
+    batches = list(loader)
+    state = loader.state_dict(4)
+    resumed = _loader(_dataset(shard_dir), num_workers, drop_last=True)
+    resumed.set_epoch(2)
+    resumed.load_state_dict(state)
+    rest = list(resumed)
+    assert len(resumed) == len(rest) == len(batches) - 4
+    for (x, y), (x_resumed, y_resumed) in zip(batches[4:], rest):
+        assert torch.equal(x, x_resumed) and torch.equal(y, y_resumed)
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_ranks_run_as_many_batches(tmp_path, num_workers):
+    # shards of 3, 3, 3 and 1 tiles: the ranks stream different numbers of samples
+    shard_dir = _write_shards(str(tmp_path))
+    lengths = []
+    for rank in range(2):
+        dataset = _dataset(shard_dir, rank=rank, world_size=2)
+        dataset.set_epoch(1)
+        loader = _loader(dataset, num_workers)
+        lengths.append((len(dataset), len(loader), len(list(loader))))
+    assert lengths[0][0] != lengths[1][0]
+    assert lengths[0][1:] == lengths[1][1:] == (lengths[0][2],) * 2
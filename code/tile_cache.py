@@ -0,0 +1,210 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import hashlib
+import json
+import os
+from utils import log
+from manifest import build_manifest, load_images
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+"""
+On-disk cache of decoded tiles for a dataset split (a folder with `images/` and `groundtruth/`).
+All images (and masks) are decoded once and stored as a single uint8 array that is memory-mapped
+afterwards, so that several runs on the same node can share it without decoding any PNG again.
+The cache is rebuilt automatically when the source files change (checked with mtimes, then hashes).
+"""
+
+CACHE_VERSION = 1
+IMAGES_FILE = "images.u8"
+MASKS_FILE = "masks.u8"
+INDEX_FILE = "index.json"
+
+
+def _file_hash(path: str) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _file_entry(path: str) -> dict:
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime, "size": stat.st_size, "sha1": _file_hash(path)}
+
+
+def _entry_matches(path: str, entry: dict) -> bool:
+    if not os.path.exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_mtime == entry["mtime"] and stat.st_size == entry["size"]:
+        return True
+    # mtime changed (e.g. the data was copied again), fall back to the content hash
+    return _file_hash(path) == entry["sha1"]
+
+
+class TileCache:
+    def __init__(self, path: str, cache_dir: str):
+        self.path = os.path.abspath(path)
+        # One sub-directory per split so that a single cache_dir can be shared by all the splits
+        split_key = hashlib.sha1(self.path.encode()).hexdigest()[:12]
+        self.cache_dir = os.path.join(
+            cache_dir, f"{os.path.basename(self.path)}_{split_key}"
+        )
+        self.index = None
+        self._images, self._masks = None, None
+        self._open_or_build()
+
+    def __len__(self):
+        return len(self.index["names"])
+
+    def __getstate__(self):
+        # memmaps are re-opened lazily in each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state["_images"], state["_masks"] = None, None
+        return state
+
+    @property
+    def names(self):
+        return self.index["names"]
+
+    @property
+    def has_masks(self):
+        return self.index["masks_shape"] is not None
+
+    @property
+    def images(self):
+        # (N, H, W, 3) uint8
+        if self._images is None:
+            self._images = np.memmap(
+                os.path.join(self.cache_dir, IMAGES_FILE),
+                dtype=np.uint8,
+                mode="r",
+                shape=tuple(self.index["images_shape"]),
+            )
+        return self._images
+
+    @property
+    def masks(self):
+        # (N, H, W) uint8
+        if self._masks is None and self.has_masks:
+            self._masks = np.memmap(
+                os.path.join(self.cache_dir, MASKS_FILE),
+                dtype=np.uint8,
+                mode="r",
+                shape=tuple(self.index["masks_shape"]),
+            )
+        return self._masks
+
+    def _image_path(self, entry):
+        return os.path.join(self.path, "images", entry["image"])
+
+    def _mask_path(self, entry):
+        return os.path.join(self.path, "groundtruth", entry["mask"])
+
+    def _is_valid(self, index, entries) -> bool:
+        names = [e["image"] for e in entries]
+        if index.get("version") != CACHE_VERSION or index["names"] != names:
+            return False
+        has_masks = entries[0]["mask"] is not None
+        if (index["masks_shape"] is not None) != has_masks:
+            return False
+        for e, files in zip(entries, index["files"]):
+            if not _entry_matches(self._image_path(e), files[0]):
+                return False
+            if has_masks and not _entry_matches(self._mask_path(e), files[1]):
+                return False
+        return True
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _open_or_build(self):
+        # images and masks paired by id
+        entries = build_manifest(self.path)
+        index = self._read_index()
+        if index is not None and self._is_valid(index, entries):
+            self.index = index
+            log(f"Using tile cache {self.cache_dir} ({len(self)} tiles)")
+            return
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # Another run may have built the cache while we were waiting for the lock
+            index = self._read_index()
+            if index is None or not self._is_valid(index, entries):
+                index = self._build(entries)
+        self.index = index
+
+    def _build(self, entries):
+        log(f"Building tile cache for {self.path} in {self.cache_dir}...")
+        # Invalidate the stale cache first so that no reader pairs the old index with new arrays
+        if os.path.exists(os.path.join(self.cache_dir, INDEX_FILE)):
+            os.remove(os.path.join(self.cache_dir, INDEX_FILE))
+        names = [e["image"] for e in entries]
+        has_masks = entries[0]["mask"] is not None
+        h, w = entries[0]["image_shape"][:2]
+        images_shape = (len(names), h, w, 3)
+        masks_shape = (len(names), h, w) if has_masks else None
+        image_paths = [self._image_path(e) for e in entries]
+        mask_paths = [self._mask_path(e) for e in entries] if has_masks else []
+
+        pid = os.getpid()
+        images_tmp = os.path.join(self.cache_dir, f"{IMAGES_FILE}.{pid}.tmp")
+        masks_tmp = os.path.join(self.cache_dir, f"{MASKS_FILE}.{pid}.tmp")
+        images = np.memmap(images_tmp, dtype=np.uint8, mode="w+", shape=images_shape)
+        masks = (
+            np.memmap(masks_tmp, dtype=np.uint8, mode="w+", shape=masks_shape)
+            if has_masks
+            else None
+        )
+
+        # decoded in parallel straight into the memory-mapped arrays
+        load_images(
+            image_paths,
+            out=images,
+            transform=lambda img: img[:, :, :3],
+            desc="Caching tiles",
+        )
+        if has_masks:
+            load_images(mask_paths, out=masks, desc="Caching masks")
+        with ThreadPoolExecutor() as ex:
+            image_entries = list(ex.map(_file_entry, image_paths))
+            mask_entries = list(ex.map(_file_entry, mask_paths))
+        files = [
+            [image_entry, mask_entries[i] if has_masks else None]
+            for i, image_entry in enumerate(image_entries)
+        ]
+
+        images.flush()
+        os.replace(images_tmp, os.path.join(self.cache_dir, IMAGES_FILE))
+        del images
+        if has_masks:
+            masks.flush()
+            os.replace(masks_tmp, os.path.join(self.cache_dir, MASKS_FILE))
+            del masks
+
+        index = {
+            "version": CACHE_VERSION,
+            "names": names,
+            "images_shape": list(images_shape),
+            "masks_shape": list(masks_shape) if has_masks else None,
+            "files": files,
+        }
+        # The index is written last (and atomically): a cache without index is never used
+        index_tmp = os.path.join(self.cache_dir, f"{INDEX_FILE}.{pid}.tmp")
+        with open(index_tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(index_tmp, os.path.join(self.cache_dir, INDEX_FILE))
+        log(f"Tile cache built with {len(names)} tiles")
+        return index
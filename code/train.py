@@ -7,11 +7,39 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 import matplotlib.pyplot as plt
 import os
+import signal
 from utils import *
+from precision import Float32Sigmoid, autocast, autocast_dtype, make_grad_scaler
+from metrics import Mean, StepStats, as_metric
+from checkpoints import (
+    LAST,
+    CheckpointManager,
+    load_checkpoint,
+    run_directory,
+    to_cpu,
+)
+from resume import PreemptionHandler, rng_state, set_rng_state
+from compilation import CompiledModel
+from validation import d4_tta
+from profiling import StepProfiler, phase, timed
+from sweep import Trial, TrialPruned
+from distributed import (
+    all_gather_object,
+    any_rank,
+    average_gradients,
+    get_rank,
+    get_world_size,
+    is_main_process,
+    wrap_model,
+)
+from contextlib import nullcontext
 from subprocess import Popen
 
 pjoin = os.path.join
 
+# the progress bar is refreshed every PROGRESS_INTERVAL optimizer steps (each refresh syncs the device)
+PROGRESS_INTERVAL = 20
+
 
 def show_val_samples(
     x, y, y_hat, model_save_path: str, model_name: str, train: bool = False
@@ -64,110 +92,286 @@ def train(
     checkpoint_path=None,
     model_save_path=None,
     interactive=True,
+    batch_transform=None,
+    precision="fp32",
+    accumulation_steps=1,
+    scheduler_interval="epoch",
+    keep_checkpoints=3,
+    snapshot_interval=None,
+    compile_mode=None,
+    max_steps=None,
+    val_interval=None,
+    patience=None,
+    tta=False,
+    profile=False,
+    trace_steps=None,
 ):
     """
     Returns the path to the best model
+
+    train_dataloader: set to each epoch before it, e.g. a progressive.ProgressiveLoader, which then moves to the
+    sample size and batch size of the stage of the epoch in its resolution schedule
+    batch_transform: optional callable (x, y) -> (x, y) applied on every training batch,
+    e.g. a BatchAugmentation
+    precision: "fp32", "bf16" or "fp16", see precision.py
+    accumulation_steps: number of (micro-)batches whose gradients are accumulated before each optimizer step,
+    the effective batch size being accumulation_steps * batch size
+    scheduler_interval: "epoch" or "step", whether the scheduler is stepped after each epoch or each optimizer step
+    metric_fns, best_metric_fn: dicts of metrics.StreamingMetric (or of metric functions, averaged over the batches),
+    accumulated on the device over the whole epoch, see metrics.py
+    keep_checkpoints: number of best checkpoints kept (besides last.pt), written in the background, see checkpoints.py
+    snapshot_interval: number of optimizer steps between the snapshots of the full training state written to last.pt,
+    which checkpoint_path can resume from at the exact step (None: only at the end of each epoch), see resume.py.
+    A snapshot is also written before exiting on SIGTERM, SIGUSR1 or SIGUSR2
+    compile_mode: None (eager), "trace" or "compile", the training and validation steps then run through the
+    compiled graphs of the model, checked against the eager outputs on the first batch, see compilation.py
+    max_steps: maximum number of optimizer steps, training stops at whichever of n_epochs and max_steps comes first
+    val_interval: number of optimizer steps between the validations (None: at the end of each epoch), the history
+    and tensorboard logs being then indexed by step
+    patience: number of validations without a better best_metric_fn after which training stops (None: never)
+    tta: if set, the validation predictions are the means over the D4 symmetries of the samples, see validation.py
+    profile: if set, the time of each phase of the steps (data wait, host to device copy, forward, loss, backward,
+    optimizer step, metrics) is logged to tensorboard, besides the throughput and peak memory, see profiling.py
+    trace_steps: (start, end) optimizer steps, the steps start + 1 to end being traced by torch.profiler and
+    exported as a Chrome trace to the traces directory of the model
+
+    When distributed (see distributed.py), the model is trained with DDP and the metrics are all-reduced
+    across ranks, only rank 0 writing the checkpoints, tensorboard logs and plots (the other ranks return None)
     """
+    assert scheduler_interval in {"epoch", "step"}
+    main = is_main_process()
     # training loop
-    logdir = "./tensorboard/net"
-    writer = SummaryWriter(logdir)  # tensorboard writer (can also log images)
+    trial = Trial.current
+    # the trials of a sweep run unattended, in parallel: no window is shown
+    interactive = interactive and trial is None
+    # the concurrent trials of a sweep each log to their own directory
+    logdir = (
+        pjoin(trial.directory, "tensorboard")
+        if trial is not None
+        else "./tensorboard/net"
+    )
+    plot_dir = (
+        pjoin(trial.directory, "plots")
+        if trial is not None
+        else "./code/models/baselines/plots"
+    )
+    # tensorboard writer (can also log images)
+    writer = SummaryWriter(logdir) if main else None
 
-    history = {}  # collects metrics at the end of each epoch
+    history = {}  # collects metrics at each validation
 
     best_metric_fn_val = 0.0
     checkpoint_epoch = 0
+    global_step = 0  # optimizer steps
+    stale_validations = 0  # validations since the last better best_metric_fn
+    pruned = False  # by the sweep running this training, see sweep.py
+    resume = None
+
+    # the losses are computed from the logits the model outputs in training
+    assert any(
+        isinstance(m, Float32Sigmoid) for m in model.modules()
+    ), "The output layer of the model must be a Float32Sigmoid (see precision.py)"
+    device_type = next(model.parameters()).device.type
+    amp_dtype = autocast_dtype(precision, device_type)
+    scaler = make_grad_scaler(device_type, amp_dtype)
 
     if checkpoint_path:
-        checkpoint = torch.load(checkpoint_path)
+        checkpoint = load_checkpoint(checkpoint_path, map_location="cpu")
         model.load_state_dict(checkpoint["model_state_dict"])
-        optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        try:
+            optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
+        except ValueError as e:
+            # e.g. a checkpoint saved before more parameters were registered (see SwinUNet.load_state_dict)
+            log(f"WARNING: the optimizer state is not restored: {e}")
+        if scaler.is_enabled() and checkpoint.get("scaler_state_dict"):
+            scaler.load_state_dict(checkpoint["scaler_state_dict"])
+        if scheduler and checkpoint.get("scheduler_state_dict"):
+            scheduler.load_state_dict(checkpoint["scheduler_state_dict"])
         best_metric_fn = checkpoint["best_metric_fn"]
         best_metric_fn_val = checkpoint["best_metric_fn_val"]
         checkpoint_epoch = checkpoint["epoch"]
+        global_step = checkpoint.get("step", 0)
+        stale_validations = checkpoint.get("stale_validations", 0)
+        resume = checkpoint.get("resume")
+        if resume:
+            # full training state, continued from the exact step it was saved at
+            checkpoint_epoch = resume["epoch"]
+            history = checkpoint["history"]
         log(
             f"""
             Model loaded:
-            - epoch: {checkpoint_epoch}
+            - epoch: {checkpoint_epoch}{f", batch {resume['batch']}" if resume else ""}
             - Best metric function: {list(best_metric_fn.keys())[0]}
             - Current best metric function value: {best_metric_fn_val:.4f}
         """
         )
 
-    for epoch in range(
-        checkpoint_epoch, n_epochs
-    ):  # loop over the dataset multiple times
+    if save_state and main:
+        # a new directory per run, or the one of the checkpoint resumed from (see checkpoints.run_directory)
+        checkpoint_dir = run_directory(
+            pjoin(model_save_path or "", "checkpoints", model_name), checkpoint_path
+        )
+        checkpoint_manager = CheckpointManager(
+            checkpoint_dir,
+            metric=f"val_{list(best_metric_fn.keys())[0]}",
+            top_k=keep_checkpoints,
+            resume=bool(checkpoint_path),
+        )
 
-        # Add real-time logs
-        log(f"Epoch {epoch + 1}/{n_epochs}", print_message=False)
+    # compiled and DDP models of the training steps, sharing their parameters with model
+    step_model = CompiledModel(model, compile_mode) if compile_mode else model
+    parity_checked = compile_mode is None
+    train_model = wrap_model(step_model)
+    ddp = isinstance(train_model, nn.parallel.DistributedDataParallel)
+    device = next(model.parameters()).device
 
-        display_gpu_usage()
+    metric_fns = {k: as_metric(fn) for k, fn in metric_fns.items()}
+    best_metric_fn = {k: as_metric(fn) for k, fn in best_metric_fn.items()}
+    all_metrics = {**metric_fns, **best_metric_fn}
+    loss_metric = Mean()
 
-        # initialize metric list
-        metrics = {"loss": [], "val_loss": []}
-        for k, _ in metric_fns.items():
-            metrics[k] = []
-            metrics["val_" + k] = []
-        for k, _ in best_metric_fn.items():
-            metrics[k] = []
-            metrics["val_" + k] = []
+    def _reset_metrics():
+        loss_metric.reset()
+        for m in all_metrics.values():
+            m.reset()
 
-        pbar = tqdm(train_dataloader, desc=f"Epoch {epoch+1}/{n_epochs}")
-        # training
-        model.train()
-        for (x, y) in pbar:
-            optimizer.zero_grad()  # zero out gradients
-            y_hat = model(x)  # forward pass
-            loss = loss_fn(y_hat, y)
-            loss.backward()  # backward pass
-            optimizer.step()  # optimize weights
-
-            # log partial metrics
-            metrics["loss"].append(loss.item())
-            # print(x.shape, y.shape, y_hat.shape)
-            for k, fn in metric_fns.items():
-                metrics[k].append(fn(y_hat, y).item())
-            for k, fn in best_metric_fn.items():
-                metrics[k].append(fn(y_hat, y).item())
-            metrics_dict = {
-                k: sum(v) / len(v) for k, v in metrics.items() if len(v) > 0
-            }
-            metrics_dict[f"max_sample_{list(best_metric_fn.keys())[0]}"] = max(
-                metrics[list(best_metric_fn.keys())[0]]
-            )
-            pbar.set_postfix(metrics_dict)
-        if interactive:
-            show_val_samples(
-                x.detach().cpu().numpy(),
-                y.detach().cpu().numpy(),
-                y_hat.detach().cpu().numpy(),
-                train=True,
-                model_save_path=model_save_path,
-                model_name=model_name,
+    def _update_metrics(loss, y_hat, y):
+        loss_metric.update(loss)
+        for m in all_metrics.values():
+            m.update(y_hat, y)
+
+    def _compute_metrics(prefix=""):
+        # the only device syncs of the metrics
+        values = {f"{prefix}loss": loss_metric.compute().item()}
+        for k, m in all_metrics.items():
+            values[prefix + k] = m.compute().item()
+        return values
+
+    resumable = getattr(train_dataloader, "resumable", False)
+    if snapshot_interval and not resumable:
+        log(
+            "WARNING: the position in the epoch of this loader cannot be saved, snapshots are only taken at the end of each epoch"
+        )
+
+    def _checkpoint_state(epoch, next_epoch, next_batch):
+        # the training state, resumed at batch next_batch of epoch next_epoch (gathered from all the ranks)
+        rank_state = {
+            "rng": rng_state(),
+            # training metrics since the start of the epoch or the last validation
+            "loss_metric": loss_metric.state,
+            "metrics": {k: m.state for k, m in all_metrics.items()},
+        }
+        return {
+            "epoch": epoch,
+            "model_state_dict": model.state_dict(),
+            "optimizer_state_dict": optimizer.state_dict(),
+            "scaler_state_dict": scaler.state_dict(),
+            "scheduler_state_dict": scheduler.state_dict() if scheduler else None,
+            "best_metric_fn_val": best_metric_fn_val,
+            "best_metric_fn": best_metric_fn,
+            "step": global_step,
+            "stale_validations": stale_validations,
+            "history": history,
+            "resume": {
+                "epoch": next_epoch,
+                "batch": next_batch,
+                "loader": train_dataloader.state_dict(next_batch)
+                if resumable
+                else None,
+                "ranks": all_gather_object(to_cpu(rank_state)),
+            },
+        }
+
+    def _save(state, **kwargs):
+        # every rank takes part in gathering the state (see _checkpoint_state), rank 0 writes it
+        if main:
+            checkpoint_manager.save(state, **kwargs)
+
+    def _resume(state):
+        if state["loader"] is not None:
+            train_dataloader.load_state_dict(state["loader"])
+        ranks = state["ranks"]
+        if len(ranks) != len(all_gather_object(None)):
+            log(
+                f"WARNING: resuming a snapshot of {len(ranks)} processes, the RNG states are not restored exactly"
             )
-        if scheduler:
-            scheduler.step()
-        # validation
-        model.eval()
-        with torch.no_grad():  # do not keep track of gradients
-            for (x, y) in eval_dataloader:
-                y_hat = model(x)  # forward pass
-                loss = loss_fn(y_hat, y)
+        rank_state = ranks[get_rank() % len(ranks)]
+        if rank_state["loss_metric"] is not None:
+            loss_metric.state = rank_state["loss_metric"].to(device)
+            for k, m in all_metrics.items():
+                m.state = rank_state["metrics"][k].to(device)
+        set_rng_state(rank_state["rng"])
+        return state["batch"]
+
+    def _stop(epoch, saved=True):
+        # preempted: the last snapshot is written before exiting
+        # (not saved: stopped in the middle of an epoch whose position cannot be saved)
+        if save_state and main:
+            checkpoint_manager.close()
+            if saved:
+                log(
+                    f"Training state saved to {checkpoint_manager.path(LAST)}, resume with --checkpoint_path"
+                )
+            elif checkpoint_manager.index["last"] is not None:
+                log(
+                    f"WARNING: the position in the epoch of this loader cannot be saved, resuming from {checkpoint_manager.path(LAST)} restarts epoch {epoch + 1}"
+                )
+            else:
+                log(
+                    f"WARNING: the position in the epoch of this loader cannot be saved, no training state was saved before epoch {epoch + 1}"
+                )
+        raise SystemExit(128 + (preemption.requested or signal.SIGTERM))
 
-                # log partial metrics
-                metrics["val_loss"].append(loss.item())
-                for k, fn in metric_fns.items():
-                    metrics["val_" + k].append(fn(y_hat, y).item())
-                for k, fn in best_metric_fn.items():
-                    metrics["val_" + k].append(fn(y_hat, y).item())
+    # per-step instrumentation, only traced by rank 0
+    profiler = StepProfiler(
+        device,
+        timing=profile,
+        trace_steps=trace_steps if main else None,
+        trace_dir=pjoin(model_save_path or "", "traces", model_name),
+        world_size=get_world_size(),
+    )
+
+    def _optimizer_step():
+        nonlocal global_step
+        global_step += 1
+        with phase("optimizer"):
+            scaler.step(optimizer)  # optimize weights
+            scaler.update()
+            optimizer.zero_grad()
+            if scheduler and scheduler_interval == "step":
+                scheduler.step()
+        profiler.step(global_step)
+
+    def _validate(epoch, next_epoch, next_batch):
+        # validates, logs and saves the checkpoint, returns whether training should stop early (see patience)
+        nonlocal best_metric_fn_val, stale_validations, pruned
+        train_metrics = _compute_metrics()
+        train_model.eval()
+        _reset_metrics()
+        with torch.inference_mode():  # no gradients nor version counters
+            for (x, y) in eval_dataloader:
+                with autocast(device_type, amp_dtype):
+                    # forward pass
+                    y_hat = d4_tta(step_model, x) if tta else step_model(x)
+                y_hat = y_hat.float()
+                with StepStats(y_hat, y):
+                    loss = loss_fn(y_hat, y)
+                    _update_metrics(loss, y_hat, y)
 
         # summarize metrics, log to tensorboard and display
-        history[epoch] = {k: sum(v) / len(v) for k, v in metrics.items()}
+        key = global_step if val_interval else epoch
+        history[key] = {**train_metrics, **_compute_metrics(prefix="val_")}
+        # the training metrics of the next validation start from here
+        _reset_metrics()
+        train_model.train()
+        profiler.reset()
 
-        for k, v in history[epoch].items():
-            writer.add_scalar(k, v, epoch)
-        for k, v in history[epoch].items():
+        if main:
+            for k, v in history[key].items():
+                writer.add_scalar(k, v, key)
+        for k, v in history[key].items():
             log(f"\t- {k} = {v:.4f}")
-        if interactive:
+        if interactive and main:
             show_val_samples(
                 x.detach().cpu().numpy(),
                 y.detach().cpu().numpy(),
@@ -177,7 +381,7 @@ def train(
             )
 
         best_metric_key = f"val_{list(best_metric_fn.keys())[0]}"
-        epoch_best_metric_fn_val = history[epoch][best_metric_key]
+        epoch_best_metric_fn_val = history[key][best_metric_key]
 
         # If a better value for the best metric is found, save the model
         if epoch_best_metric_fn_val > best_metric_fn_val:
@@ -185,49 +389,210 @@ def train(
                 f"New best batch {best_metric_key}: {epoch_best_metric_fn_val:.4f}\tPrevious best batch {best_metric_key}: {best_metric_fn_val:.4f}"
             )
             best_metric_fn_val = epoch_best_metric_fn_val
-            if save_state:
-                if model_save_path:
-                    best_model_path = pjoin(
-                        model_save_path,
-                        "checkpoints",
-                        model_name,
-                        f"best_{best_metric_key}_{best_metric_fn_val:4f}_epoch_{epoch}.pt",
-                    )
-                else:
-                    best_model_path = pjoin(
-                        "checkpoints",
-                        model_name,
-                        f"best_{best_metric_key}_{best_metric_fn_val:4f}_epoch_{epoch}.pt",
+            stale_validations = 0
+        else:
+            stale_validations += 1
+        if save_state:
+            # written in the background, as a top-k best checkpoint and/or last.pt
+            _save(
+                _checkpoint_state(epoch, next_epoch, next_batch),
+                epoch=epoch,
+                metric=best_metric_key,
+                value=epoch_best_metric_fn_val,
+                step=global_step if val_interval else None,
+            )
+        trial = Trial.current
+        if trial is not None and trial.report(key, history[key], best_metric_key):
+            pruned = True
+            return True
+        if patience is not None and stale_validations >= patience:
+            log(
+                f"Early stopping: no better {best_metric_key} in the last {stale_validations} validations"
+            )
+            return True
+        return False
+
+    with PreemptionHandler() as preemption, profiler:
+        profiler.trace_window(global_step)
+        for epoch in range(
+            checkpoint_epoch, n_epochs
+        ):  # loop over the dataset multiple times
+            if max_steps is not None and global_step >= max_steps:
+                break
+
+            # Add real-time logs
+            log(f"Epoch {epoch + 1}/{n_epochs}", print_message=False)
+            # e.g. the streaming dataset reshuffles its shards every epoch
+            if hasattr(train_dataloader.dataset, "set_epoch"):
+                train_dataloader.dataset.set_epoch(epoch)
+            # e.g. the order of the samples of the ResumableSampler
+            if hasattr(train_dataloader, "set_epoch"):
+                train_dataloader.set_epoch(epoch)
+
+            display_gpu_usage()
+
+            # training
+            train_model.train()
+            optimizer.zero_grad()  # zero out gradients
+            if not val_interval:
+                # the training metrics are the ones of the epoch (otherwise of the steps since the last validation)
+                _reset_metrics()
+            start_batch = 0
+            if resume:
+                # first epoch after resuming, from the batch after the snapshot
+                start_batch = _resume(resume)
+                resume = None
+            try:
+                n_batches = start_batch + len(train_dataloader)
+            except TypeError:  # unknown length, the last step may then be scaled down
+                n_batches = None
+            pbar = tqdm(
+                train_dataloader,
+                desc=f"Epoch {epoch+1}/{n_epochs}",
+                initial=start_batch,
+                total=n_batches,
+                disable=not main,
+            )
+            pending_step = False
+            stop_training = False
+            x = None
+            for i, (x, y) in enumerate(timed(pbar), start_batch):
+                # number of micro-batches in the current optimizer step (the last one of the epoch may be shorter),
+                # the length of the loader being only a hint: at least the micro-batches already run
+                step_start = i - i % accumulation_steps
+                step_size = (
+                    min(accumulation_steps, n_batches - step_start)
+                    if n_batches
+                    else accumulation_steps
+                )
+                step_size = max(step_size, i - step_start + 1)
+                profiler.count(len(y))
+                if batch_transform:
+                    with phase("augment"):
+                        x, y = batch_transform(x, y)
+                last_micro_batch = i - step_start + 1 == step_size
+                # with DDP, the gradients are only all-reduced on the last micro-batch of the step
+                sync_context = (
+                    train_model.no_sync()
+                    if ddp and not last_micro_batch
+                    else nullcontext()
+                )
+                with sync_context:
+                    if not parity_checked:
+                        with autocast(device_type, amp_dtype):
+                            step_model.check_parity(x)
+                        parity_checked = True
+                    with phase("forward"), autocast(device_type, amp_dtype):
+                        # forward pass, the fp32 logits in training (see precision.Float32Sigmoid)
+                        logits = train_model(x)
+                    y_hat = torch.sigmoid(logits)
+                    # the patches of y_hat and y are pooled once for the loss and the metrics,
+                    # the binary cross-entropy being computed from the logits
+                    with StepStats(y_hat, y, logits=logits):
+                        with phase("loss"):
+                            loss = loss_fn(y_hat, y)
+                        # accumulated on the device, without syncing
+                        with phase("metrics"):
+                            _update_metrics(loss, y_hat, y)
+                    # backward pass, the gradients of the step's micro-batches are averaged
+                    with phase("backward"):
+                        scaler.scale(loss / step_size).backward()
+                pending_step = True
+
+                if last_micro_batch:
+                    _optimizer_step()
+                    pending_step = False
+                    n_steps = i // accumulation_steps + 1
+                    if (n_steps - 1) % PROGRESS_INTERVAL == 0:
+                        pbar.set_postfix(_compute_metrics())
+                        if main:
+                            # throughput, peak memory and phase times since the last refresh
+                            for k, v in profiler.summary().items():
+                                writer.add_scalar(k, v, global_step)
+                    # the same decisions on every rank
+                    finished = max_steps is not None and global_step >= max_steps
+                    validate = finished or (
+                        val_interval and global_step % val_interval == 0
                     )
-                os.makedirs(os.path.dirname(best_model_path), exist_ok=True)
-                torch.save(
-                    {
-                        "epoch": epoch,
-                        "model_state_dict": model.state_dict(),
-                        "optimizer_state_dict": optimizer.state_dict(),
-                        "best_metric_fn_val": best_metric_fn_val,
-                        "best_metric_fn": best_metric_fn,
-                    },
-                    best_model_path,
+                    snapshot = snapshot_interval and n_steps % snapshot_interval == 0
+                    # preemption is only checked every few steps (a sync of all the ranks)
+                    stop = (
+                        validate or snapshot or n_steps % PROGRESS_INTERVAL == 0
+                    ) and any_rank(preemption.requested, device)
+                    if validate:
+                        # validated and saved in the middle of the epoch, a loader that cannot be resumed
+                        # from there restarting the epoch
+                        stop_training = (
+                            _validate(epoch, epoch, i + 1 if resumable else 0)
+                            or finished
+                        )
+                    elif save_state and resumable and (stop or snapshot):
+                        _save(_checkpoint_state(epoch, epoch, i + 1), epoch=epoch)
+                    if stop:
+                        _stop(epoch, saved=resumable)
+                    if stop_training:
+                        break
+            if stop_training:
+                break
+            if pending_step:
+                # last step of a loader that ended before its length (or without length),
+                # whose gradients were not all-reduced by DDP
+                if ddp:
+                    average_gradients(train_model)
+                _optimizer_step()
+            if interactive and main and x is not None:
+                if isinstance(x, (tuple, list)):
+                    # precomputed encoder features, whose first one is the image, see feature_cache.py
+                    x = x[0]
+                show_val_samples(
+                    x.detach().cpu().numpy(),
+                    y.detach().cpu().numpy(),
+                    y_hat.detach().cpu().numpy(),
+                    train=True,
+                    model_save_path=model_save_path,
+                    model_name=model_name,
                 )
+            if scheduler and scheduler_interval == "epoch":
+                scheduler.step()
+            # every epoch, or the steps after the last validation of the training
+            if not val_interval or (
+                epoch == n_epochs - 1 and global_step % val_interval != 0
+            ):
+                stop_training = _validate(epoch, epoch + 1, 0)
+            elif save_state:
+                _save(_checkpoint_state(epoch, epoch + 1, 0), epoch=epoch)
+            if any_rank(preemption.requested, device):
+                _stop(epoch)
+            if stop_training:
+                break
 
     log("Finished Training")
+    if pruned:
+        if save_state and main:
+            checkpoint_manager.close()
+        raise TrialPruned(f"{model_name} pruned after {len(history)} validations")
+    if not main:
+        return None
     # plot loss curves
     plt.plot([v["loss"] for k, v in history.items()], label="Training Loss")
     plt.plot([v["val_loss"] for k, v in history.items()], label="Validation Loss")
     plt.ylabel("Loss")
-    plt.xlabel("Epochs")
+    plt.xlabel("Steps" if val_interval else "Epochs")
     plt.legend()
     now = datetime.now()
     t = now.strftime("%Y-%m-%d_%H-%M-%S")
-    plt.savefig(f"./code/models/baselines/plots/loss_{model_name}_{t}.png")
+    os.makedirs(plot_dir, exist_ok=True)
+    plt.savefig(pjoin(plot_dir, f"loss_{model_name}_{t}.png"))
     if interactive:
         plt.show()
 
     if save_state:
+        # waits for the last checkpoint to be written
+        checkpoint_manager.close()
         if n_epochs != 0:
             # Here we check if the model was trained for more than 0 epochs
             # If so, we save the model with the best metric
             # If not the returned path will be empty for debugging purposes
+            best_model_path = checkpoint_manager.best_path
             log(f"Path to best model: {best_model_path}")
             return best_model_path
@@ -6,24 +6,25 @@ from consts import *
 import re
 import os
 import torch
+import torch.distributed
 from tqdm import tqdm
 from datetime import datetime
 from subprocess import Popen
-from sklearn.metrics import f1_score
+from manifest import load_images
+from crops import CropSampler, crop_batch
+from patches import PatchIndex
+from metrics import F1, PatchAccuracy, PatchF1
 
 
-def load_all_from_path(path: str):
+def load_all_from_path(path: str, as_uint8: bool = False):
     # loads all HxW .pngs contained in path as a 4D np.array of shape (n_images, H, W, 3)
     # images are loaded as floats with values in the interval [0., 1.]
-    return (
-        np.stack(
-            [
-                np.array(Image.open(f))
-                for f in tqdm(sorted(glob(path + "/*.png")), desc="Loading images")
-            ]
-        ).astype(np.float32)
-        / 255.0
-    )
+    # or kept as uint8 in [0, 255] if as_uint8 (4 times less memory, see to_float_tensor)
+    # the PNGs are decoded in parallel, see manifest.set_io_workers
+    images = load_images(sorted(glob(path + "/*.png")))
+    if as_uint8:
+        return images
+    return images.astype(np.float32) / 255.0
 
 
 def display_gpu_usage():
@@ -54,32 +55,22 @@ def show_first_n(imgs, masks, n=5):
 def image_to_patches(images, masks=None):
     # takes in a 4D np.array containing images and (optionally) a 4D np.array containing the segmentation masks
     # returns a 4D np.array with an ordered sequence of patches extracted from the image and (optionally) a np.array containing labels
-    n_images = images.shape[0]  # number of images
-    h, w = images.shape[1:3]  # shape of images
-    # make sure images can be patched exactly
-    assert (h % PATCH_SIZE) + (w % PATCH_SIZE) == 0
-
-    images = images[:, :, :, :3]
-
-    h_patches = h // PATCH_SIZE
-    w_patches = w // PATCH_SIZE
-
-    patches = images.reshape(
-        (n_images, h_patches, PATCH_SIZE, w_patches, PATCH_SIZE, -1)
-    )
-    patches = np.moveaxis(patches, 2, 3)
-    patches = patches.reshape(-1, PATCH_SIZE, PATCH_SIZE, 3)
+    # (this copies all the patches, use a PatchIndex to only copy them batch by batch)
+    index = PatchIndex(images, masks)
+    patches = index[:]
     if masks is None:
         return patches
-
-    masks = masks.reshape((n_images, h_patches, PATCH_SIZE, w_patches, PATCH_SIZE, -1))
-    masks = np.moveaxis(masks, 2, 3)
-    labels = np.mean(masks, (-1, -2, -3)) > CUTOFF  # compute labels
-    labels = labels.reshape(-1).astype(np.float32)
-    return patches, labels
+    return patches, index.labels
 
 
 def log(message: str, print_message=True):
+    # only the first process prints when distributed
+    if (
+        torch.distributed.is_available()
+        and torch.distributed.is_initialized()
+        and torch.distributed.get_rank() != 0
+    ):
+        return
     if print_message:
         print(message)
     # If OS is not Windows
@@ -127,15 +118,30 @@ def create_submission(labels, test_filenames, submission_filename):
                     )
 
 
-def extract_features(x):
+def extract_features(x, chunk_size=4096):
+    # x is an array of patches or a PatchIndex, which is read (and converted to floats) chunk by chunk
+    if isinstance(x, PatchIndex) or x.dtype == np.uint8:
+        return np.concatenate(
+            [
+                extract_features(to_float_array(x[i : i + chunk_size]))
+                for i in range(0, len(x), chunk_size)
+            ]
+        )
     return np.concatenate([np.mean(x, (-2, -3)), np.var(x, (-2, -3))], axis=1)
 
 
-def load_data(train_path, val_path):
-    train_images = load_all_from_path(os.path.join(train_path, "images"))
-    train_masks = load_all_from_path(os.path.join(train_path, "groundtruth"))
-    val_images = load_all_from_path(os.path.join(val_path, "images"))
-    val_masks = load_all_from_path(os.path.join(val_path, "groundtruth"))
+def to_float_array(x):
+    # uint8 arrays in [0, 255] are converted to float arrays in [0, 1]
+    if x.dtype == np.uint8:
+        return x.astype(np.float32) / 255.0
+    return x
+
+
+def load_data(train_path, val_path, as_uint8: bool = False):
+    train_images = load_all_from_path(os.path.join(train_path, "images"), as_uint8)
+    train_masks = load_all_from_path(os.path.join(train_path, "groundtruth"), as_uint8)
+    val_images = load_all_from_path(os.path.join(val_path, "images"), as_uint8)
+    val_masks = load_all_from_path(os.path.join(val_path, "groundtruth"), as_uint8)
 
     return train_images, train_masks, val_images, val_masks
 
@@ -155,72 +161,41 @@ def np_to_tensor(x, device):
         )
 
 
+def to_float_tensor(x):
+    # uint8 images and masks (in [0, 255]) and bool labels are only converted to floats in [0, 1]
+    # at the point of use, ideally once they are on the device
+    if x.dtype == torch.uint8:
+        return x.float() / 255.0
+    if x.dtype == torch.bool:
+        return x.float()
+    return x
+
+
 def get_best_available_device():
     return "cuda" if torch.cuda.is_available() else "cpu"
 
 
 def f1_score_fn(y_hat, y, threshold=CUTOFF):
-    y_hat = torch.where(
-        y_hat >= threshold, torch.ones_like(y_hat), torch.zeros_like(y_hat)
-    )
-    y = torch.where(y >= threshold, torch.ones_like(y), torch.zeros_like(y))
-
-    return _f1_score_fn(y_hat, y)
-
-
-def _f1_score_fn(y_hat, y):
-    return f1_score(
-        y_true=y.flatten().cpu().numpy(),
-        y_pred=y_hat.flatten().cpu().numpy(),
-    )
+    return F1(threshold=threshold)(y_hat, y)
 
 
 def patch_accuracy_fn(y_hat, y):
-    w = y_hat.shape[-1]
-    size = PATCH_SIZE if w > 250 else PATCH_SIZE // 2
     # computes accuracy weighted by patches (metric used on Kaggle for evaluation)
-    h_patches = y.shape[-2] // size
-    w_patches = y.shape[-1] // size
-    patches_hat = (
-        y_hat.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3)) > CUTOFF
-    )
-    patches = y.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3)) > CUTOFF
-    return (patches == patches_hat).float().mean()
+    return PatchAccuracy()(y_hat, y)
 
 
 def patch_f1_score_fn(y_hat, y):
-    w = y_hat.shape[-1]
-    size = PATCH_SIZE if w > 250 else PATCH_SIZE // 2
-    # computes accuracy weighted by patches (metric used on Kaggle for evaluation)
-    h_patches = y.shape[-2] // size
-    w_patches = y.shape[-1] // size
-    patches_hat = (
-        y_hat.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3)) > CUTOFF
-    )
-    patches = y.reshape(-1, 1, h_patches, size, w_patches, size).mean((-1, -3)) > CUTOFF
-
-    return _f1_score_fn(y=patches, y_hat=patches_hat)
+    # computes the F1 score of the patches (metric used on Kaggle for evaluation)
+    return PatchF1()(y_hat, y)
 
 
 def crop_to_size(images, labels, size=208):
-    # TODO this function is not at all modular
-    print(images.shape, labels.shape)
+    # the 4 corner crops of each (H, W, C) image and (H, W) label, crop k of image i being at 4 * i + k
     n, h, w, c = images.shape
-    cropped_images = np.zeros((4 * n, size, size, c), dtype=images.dtype)
-    cropped_labels = np.zeros((4 * n, size, size), dtype=labels.dtype)
-    for i, (image, label) in enumerate(zip(images, labels)):
-        cropped_images[i] = image[0:size, 0:size, :]
-        cropped_labels[i] = label[0:size, 0:size]
-
-        cropped_images[i + 1] = image[0:size, w - size :, :]
-        cropped_labels[i + 1] = label[0:size, w - size :]
-
-        cropped_images[i + 2] = image[h - size :, 0:size:, :]
-        cropped_labels[i + 2] = label[h - size :, 0:size]
-
-        cropped_images[i + 3] = image[h - size :, w - size :, :]
-        cropped_labels[i + 3] = label[h - size :, w - size :]
-    return cropped_images, cropped_labels
+    positions = CropSampler(size).positions_table(h, w, n)
+    cropped_images = crop_batch(np.moveaxis(images, -1, 1), positions, size)
+    cropped_labels = crop_batch(labels, positions, size)
+    return np.ascontiguousarray(np.moveaxis(cropped_images, 1, -1)), cropped_labels
 
 
 def crop_to_size_with_crop_index(image, label, index, size=208):
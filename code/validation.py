@@ -0,0 +1,90 @@
+import torch
+from augmentation import N_D4, d4_inverse, d4_transform
+from loaders import ResumableLoader, make_dataloader
+from memory_format import memory_format_of
+from utils import log
+
+"""
+Validation sets, in one of the VAL_MODES:
+- "augmented": the validation dataset augmented as the training one (6 transforms, with a random crop),
+  loaded and transformed again at every validation
+- "fixed": the non-augmented samples (e.g. the crops of the images), loaded once and kept as tensors on the
+  device, so that every validation sees exactly the same samples and costs no loading
+- "tta": the fixed samples, predicted as the mean of the predictions of their 8 D4 symmetries (see d4_tta)
+The fixed modes are evaluated in batches of their own size, which can be larger than the training one
+as there are neither activations nor gradients to keep.
+"""
+
+VAL_MODES = ["augmented", "fixed", "tta"]
+
+
+class FixedLoader(ResumableLoader):
+    # batches of (x, y) tensors already on the device, always in the same order
+    sampler = None
+
+    def __init__(self, x, y, batch_size: int):
+        self.x, self.y = x, y
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return (len(self.x) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for i in range(0, len(self.x), self.batch_size):
+            yield self.x[i : i + self.batch_size], self.y[i : i + self.batch_size]
+
+
+def materialize(dataset, batch_size: int, device, subset=None, **loader_kwargs):
+    """
+    Loads all the samples of dataset (or a fixed subset of them, see ResumableSampler) once,
+    as float tensors on the device, and returns a FixedLoader over them.
+    When distributed, each rank keeps its part of the samples.
+    """
+    loader = make_dataloader(
+        dataset,
+        batch_size,
+        device,
+        shuffle=False,
+        equal_ranks=False,
+        subset=subset,
+        **loader_kwargs,
+    )
+    xs, ys = [], []
+    with torch.no_grad():
+        for x, y in loader:
+            xs.append(x)
+            ys.append(y)
+    x, y = torch.cat(xs), torch.cat(ys)
+    size_mb = (x.numel() * x.element_size() + y.numel() * y.element_size()) / 2**20
+    log(f"Validation set of {len(x)} samples kept on {x.device} ({size_mb:.1f} MB)")
+    return FixedLoader(x, y, batch_size)
+
+
+def make_val_loader(
+    dataset, batch_size: int, device, mode: str = "augmented", subset=None, **kwargs
+):
+    # the validation loader of mode (see VAL_MODES), dataset being augmented only in "augmented" mode
+    assert mode in VAL_MODES, f"Unknown validation mode {mode}"
+    if mode == "augmented":
+        return make_dataloader(
+            dataset,
+            batch_size=batch_size,
+            device=device,
+            shuffle=True,
+            equal_ranks=False,
+            subset=subset,
+            **kwargs,
+        )
+    return materialize(dataset, batch_size, device, subset=subset, **kwargs)
+
+
+def d4_tta(model, x):
+    """
+    Test-time augmentation: the mean of the predictions of model on the 8 symmetries of the square
+    (B, C, H, W) batch x, each mapped back by the inverse symmetry. The 8 symmetries go through
+    a single forward pass, of a batch of 8 * B samples.
+    """
+    b = x.shape[0]
+    x_d4 = torch.cat([d4_transform(x, k) for k in range(N_D4)])
+    y_hat = model(x_d4.contiguous(memory_format=memory_format_of(x)))
+    return torch.stack([d4_inverse(p, k) for k, p in enumerate(y_hat.split(b))]).mean(0)
@@ -3,6 +3,10 @@ conda activate cil
 
 N_EPOCHS=200
 BATCH_SIZE=4
+# effective batch size of BATCH_SIZE * ACCUMULATION_STEPS
+ACCUMULATION_STEPS=1
+# training stops after PATIENCE epochs without a better validation metric
+PATIENCE=20
 
 python code/run.py swin-unet \
     --train-dir "data/training" \
@@ -10,6 +14,8 @@ python code/run.py swin-unet \
     --val-dir "data/validation" \
     --n_epochs $N_EPOCHS \
     --batch_size $BATCH_SIZE \
+    --accumulation-steps $ACCUMULATION_STEPS \
+    --patience $PATIENCE \
     --loss patch-f1 \
     --model-save-dir $SCRATCH
     --checkpoint_path /cluster/scratch/kpyszkowski/checkpoints/swin-unet/best_val_patch_f1_score_0.701689_epoch_36.pt